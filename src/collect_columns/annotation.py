@@ -0,0 +1,395 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Retrieval of attributes from GTF/GFF files.
+"""
+
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import (Container, Dict, Iterable, Iterator, List, Optional,
+                    Tuple)
+
+from .cache import cache_path, evict, file_key, touch
+from .compression import open_input
+
+# Increment when the layout of the attribute index changes.
+INDEX_VERSION = 3
+# The default maximum size of the attribute index cache, in megabytes.
+DEFAULT_CACHE_SIZE = 1000
+
+
+def _merge_attributes(merged: Dict[str, List[str]], attributes,
+                      keys) -> None:
+    """
+    Add the values of a record's attributes to the values collected so far
+    for a feature.
+    """
+    for attr in keys:
+        # Use lists to ensure the order stays the same. This way
+        # attributes which belong together will likely have to same
+        # position in their respective columns, assuming the available
+        # attributes for each record is consistent.
+        values = merged.setdefault(attr, [])
+        values += [a for a in attributes.get(attr, []) if a not in values]
+
+
+# A GTF attribute: a key followed by a value, either quoted or not, up to
+# the next ';'.
+_GTF_ATTRIBUTE = re.compile(
+    r'(?:^|;)\s*([^\s;"]+)\s+(?:"([^"]*)"|([^;"]*?))\s*(?=;|$)')
+# GTF attributes start with a key followed by whitespace, GFF3 attributes
+# with a key followed by a '='.
+_GTF_STYLE = re.compile(r'\s*[^\s=;"]+\s+\S')
+
+
+def _split_value(value: str, repeated_keys: bool = False) -> List[str]:
+    """
+    Split a value on commas, the way gffutils does: values with a ', ',
+    such as descriptions, are kept whole, as are all values of records in
+    which a key is repeated.
+    """
+    if not value:
+        return []
+    if repeated_keys or ", " in value:
+        return [value]
+    return value.split(",")
+
+
+class AttributeTokenizer(object):
+    """
+    Extracts attributes from the ninth column of GTF records without
+    parsing the whole record. Values are split the same way gffutils
+    splits them.
+    """
+    def values(self, text: str, key: str) -> List[str]:
+        """Return the values of one attribute."""
+        # Fast path for the common case of a single, quoted value without
+        # commas. The key must not be part of another attribute's value,
+        # which would follow an odd number of quotes.
+        quoted_key = key + ' "'
+        start = text.find(quoted_key)
+        if start != -1 and text.find(key, start + 1) == -1 and (
+                start == 0 or text[start - 1] in " \t;") and (
+                text.count('"', 0, start) % 2 == 0):
+            start += len(quoted_key)
+            end = text.find('"', start)
+            value = text[start:] if end == -1 else text[start:end]
+            if "," not in value:
+                return _split_value(value)
+        return self.all(text).get(key, [])
+
+    def all(self, text: str) -> Dict[str, List[str]]:
+        """Return the values of all attributes."""
+        matches = _GTF_ATTRIBUTE.findall(text)
+        repeated_keys = len(set(key for key, _, _ in matches)) != len(matches)
+        attributes = {}  # type: Dict[str, List[str]]
+        for key, quoted, unquoted in matches:
+            attributes.setdefault(key, []).extend(
+                _split_value(quoted or unquoted, repeated_keys))
+        return attributes
+
+
+def _parse_gff_line(line: str) -> dict:
+    """
+    Parse the attributes of a GFF record with gffutils. gffutils is only
+    imported once it is needed, as importing it takes longer than most
+    runs without -a.
+    """
+    import gffutils.feature
+    return gffutils.feature.feature_from_line(line).attributes
+
+
+def _read_records(gtf: Path, feature_attribute: str,
+                  keys: Optional[List[str]] = None,
+                  features: Optional[Container[str]] = None,
+                  feature_types: Optional[Container[str]] = None
+                  ) -> Iterator[Tuple[List[str], dict]]:
+    """
+    Yield the values of the feature attribute and the other attributes for
+    each record in a GTF/GFF file. GTF records are tokenized directly,
+    other lines (such as GFF3 records) are parsed with gffutils.
+    :param gtf: The path to the GTF/GFF file.
+    :param feature_attribute: The attribute used to match records with
+    features.
+    :param keys: The attributes to retrieve. If None, all attributes are
+    retrieved.
+    :param features: If given, records which do not belong to one of
+    these features are skipped without retrieving their attributes.
+    :param feature_types: If given, only records with one of these
+    feature types (third column) are read.
+    """
+    tokenizer = AttributeTokenizer()
+    with open_input(gtf) as in_file:
+        for line in in_file:
+            if feature_types is not None:
+                fields = line.split("\t", 3)
+                if len(fields) < 4 or fields[2] not in feature_types:
+                    continue
+            # Only the ninth column is needed, avoid splitting the others.
+            text = line[line.rfind("\t") + 1:].rstrip("\r\n")
+            if line.count("\t") == 8 and _GTF_STYLE.match(text):
+                record_features = tokenizer.values(text, feature_attribute)
+                if features is not None:
+                    record_features = [feature for feature in record_features
+                                       if feature in features]
+                if not record_features:
+                    continue
+                if keys is None:
+                    attributes = tokenizer.all(text)
+                else:
+                    attributes = {key: tokenizer.values(text, key)
+                                  for key in keys}
+            else:
+                attributes = _parse_gff_line(line)
+                record_features = [
+                    feature
+                    for feature in attributes.get(feature_attribute, [])
+                    if features is None or feature in features]
+            yield record_features, attributes
+
+
+def read_feature_order(gtf: Path, feature_attribute: str,
+                       features: Optional[Iterable[str]] = None,
+                       feature_types: Optional[Iterable[str]] = None
+                       ) -> Dict[str, int]:
+    """
+    Return the position of each feature in a GTF/GFF file: the features
+    are numbered in the order of their first records.
+    :param gtf: The path to the GTF/GFF file.
+    :param feature_attribute: The attribute used to match records with
+    features.
+    :param features: If given, only these features are numbered and the
+    file is only read until all of them have been found.
+    :param feature_types: If given, only records with one of these
+    feature types (third column) are used.
+    """
+    if feature_types is not None:
+        feature_types = set(feature_types)
+    order = {}  # type: Dict[str, int]
+    for record_features, _ in _read_records(gtf, feature_attribute, [],
+                                            features, feature_types):
+        for feature in record_features:
+            order.setdefault(feature, len(order))
+        if features is not None and len(order) == len(features):
+            break
+    return order
+
+
+def read_additional_attributes(gtf: Path, feature_attribute: str,
+                               additional_attributes: List[str],
+                               features: Optional[Iterable[str]] = None,
+                               cache_dir: Optional[Path] = None,
+                               cache_size: int = DEFAULT_CACHE_SIZE,
+                               feature_types: Optional[List[str]] = None,
+                               early_exit: bool = False
+                               ) -> Dict[str, Dict[str, str]]:
+    """
+    Retrieve attributes from the GTF/GFF for a set of features.
+    :param gtf: The path to the the GTF/GFF file.
+    :param feature_attribute: The attribute from the GTF/GFF used for
+    matching the feature records with the features.
+    :param additional_attributes: A list containing the keys of the
+    attributes which will be retrieved.
+    :param features: A collection of the features for which the
+    attributes should be retrieved. If None, the attributes of all
+    features are retrieved.
+    :param cache_dir: If given, the attributes are looked up in an index
+    of the GTF/GFF which is cached in this directory, see
+    cached_attribute_index.
+    :param cache_size: The maximum size of the cache directory in
+    megabytes.
+    :param feature_types: If given, only records with one of these
+    feature types (third column), for example 'gene', are used.
+    :param early_exit: Stop reading the GTF/GFF as soon as a record has
+    been found for each of the features. Later records of the same
+    features are then ignored, so this is meant to be used together with
+    feature_types which have one record per feature. Ignored if features
+    is None or cache_dir is given.
+    :return: A dictionary mapping features to attribute keys to values.
+    Multiple values for one attribute are separated by a ';'.
+    """
+    if feature_types is not None:
+        feature_types = set(feature_types)
+    if cache_dir is not None:
+        with cached_attribute_index(gtf, feature_attribute, cache_dir,
+                                    cache_size * 1000 ** 2,
+                                    feature_types) as index:
+            return index.lookup(additional_attributes, features)
+    stop_after = (len(features) if early_exit and features is not None
+                  else None)
+    attributes = {}
+    # The last record merged for each feature. Records of the same gene
+    # often have the same values, merging those again changes nothing.
+    last_records = {}
+    for record_features, record in _read_records(
+            gtf, feature_attribute, additional_attributes, features,
+            feature_types):
+        for feature in record_features:
+            if last_records.get(feature) != record:
+                _merge_attributes(attributes.setdefault(feature, {}),
+                                  record, additional_attributes)
+                last_records[feature] = record
+        if len(attributes) == stop_after:
+            break
+    return _join_attributes(attributes.items(), additional_attributes)
+
+
+def _join_attributes(attributes, additional_attributes: List[str]
+                     ) -> Dict[str, Dict[str, str]]:
+    """Turn the lists of attribute values into strings."""
+    return {feature: {attr: ";".join(values.get(attr, []))
+                      for attr in additional_attributes}
+            for feature, values in attributes}
+
+
+class AttributeIndex(object):
+    """
+    An on-disk index mapping the values of one attribute in a GTF/GFF
+    file to all attributes of the records with that value. The index is
+    stored as a SQLite database.
+    """
+    def __init__(self, path: Path):
+        import sqlite3
+        self.path = path
+        self.connection = sqlite3.connect(str(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def build(cls, gtf: Path, feature_attribute: str, path: Path,
+              feature_types: Optional[Container[str]] = None
+              ) -> "AttributeIndex":
+        """
+        Build an index for a GTF/GFF file.
+        :param gtf: The path to the GTF/GFF file.
+        :param feature_attribute: The attribute used as key.
+        :param path: The path the index will be written to. The index is
+        first written to a temporary file, which is moved into place once
+        it is complete.
+        :param feature_types: If given, only records with one of these
+        feature types are indexed.
+        """
+        import sqlite3
+        attributes = {}
+        for record_features, record in _read_records(
+                gtf, feature_attribute, feature_types=feature_types):
+            for feature in record_features:
+                _merge_attributes(attributes.setdefault(feature, {}),
+                                  record, record.keys())
+        fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=".",
+                                        suffix=".tmp")
+        os.close(fd)
+        try:
+            connection = sqlite3.connect(tmp_path)
+            with connection:
+                connection.execute(
+                    "CREATE TABLE attributes "
+                    "(feature TEXT PRIMARY KEY, attributes TEXT)")
+                connection.executemany(
+                    "INSERT INTO attributes VALUES (?, ?)",
+                    ((feature, json.dumps(values))
+                     for feature, values in attributes.items()))
+            connection.close()
+            os.replace(tmp_path, str(path))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return cls(path)
+
+    def get(self, feature: str) -> Optional[Dict[str, List[str]]]:
+        """
+        Return the attributes for a feature, mapping attribute keys to
+        lists of values, or None if the feature is not in the index.
+        """
+        row = self.connection.execute(
+            "SELECT attributes FROM attributes WHERE feature = ?",
+            (feature,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, List[str]]]]:
+        """Yield the (feature, attributes) pairs for all features."""
+        for feature, values in self.connection.execute(
+                "SELECT feature, attributes FROM attributes"):
+            yield feature, json.loads(values)
+
+    def lookup(self, additional_attributes: List[str],
+               features: Optional[Iterable[str]] = None
+               ) -> Dict[str, Dict[str, str]]:
+        """
+        Retrieve attributes for a set of features, in the same form as
+        read_additional_attributes.
+        :param additional_attributes: The keys of the attributes to
+        retrieve.
+        :param features: The features to look up. If None, the attributes
+        of all features are retrieved.
+        """
+        if features is None:
+            attributes = self.items()
+        else:
+            attributes = ((feature, self.get(feature))
+                          for feature in features)
+        return _join_attributes(
+            ((feature, values) for feature, values in attributes
+             if values is not None),
+            additional_attributes)
+
+
+def cached_attribute_index(gtf: Path, feature_attribute: str,
+                           cache_dir: Path, max_size: int,
+                           feature_types: Optional[Iterable[str]] = None
+                           ) -> AttributeIndex:
+    """
+    Open the cached index for a GTF/GFF file, building it if it does not
+    exist yet. Indices are identified by the path, size and modification
+    time of the GTF/GFF file. The least recently used indices are removed
+    once the cache directory exceeds max_size bytes.
+    :param gtf: The path to the GTF/GFF file.
+    :param feature_attribute: The attribute used as key.
+    :param cache_dir: The cache directory.
+    :param max_size: The maximum size of the cache directory in bytes.
+    :param feature_types: If given, only records with one of these
+    feature types are indexed. Each selection of types gets its own
+    index.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if feature_types is not None:
+        feature_types = set(feature_types)
+    path = cache_path(cache_dir, [
+        INDEX_VERSION, file_key(gtf), feature_attribute,
+        None if feature_types is None else sorted(feature_types)], ".sqlite")
+    if path.exists():
+        touch(path)
+        index = AttributeIndex(path)
+    else:
+        index = AttributeIndex.build(gtf, feature_attribute, path,
+                                     feature_types)
+    evict(cache_dir, max_size, ".sqlite", keep=path)
+    return index
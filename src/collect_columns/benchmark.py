@@ -0,0 +1,513 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmarks for collect-columns. Run with
+`python -m collect_columns.benchmark {sum,threads,gtf,read,cohort,startup}`.
+"""
+
+import argparse
+import csv
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import gffutils
+
+from .annotation import read_additional_attributes
+from .collect_columns import (add_additional_attributes, collect_columns,
+                              merge_tables, parse_table)
+from .formats import write_merged_text
+from .merged_table import ParsedTable
+from .stats import peak_rss
+
+
+def write_sparse_tables(directory: Path, n_tables: int, n_features: int,
+                        features_per_table: int,
+                        seed: int = 0) -> List[Path]:
+    """
+    Write a set of headerless, tab separated count tables, each containing
+    a random subset of the features.
+    :param directory: The directory the tables will be written to.
+    :param n_tables: The number of tables.
+    :param n_features: The total number of distinct features.
+    :param features_per_table: The number of features in each table.
+    :param seed: The seed for the random number generator.
+    """
+    rng = random.Random(seed)
+    features = ["feature_{}".format(i) for i in range(n_features)]
+    tables = []
+    for i in range(n_tables):
+        path = directory / "table_{}.tsv".format(i)
+        with path.open("w") as table_file:
+            for feature in rng.sample(features, features_per_table):
+                table_file.write("{}\t{}\n".format(feature,
+                                                   rng.randint(0, 1000)))
+        tables.append(path)
+    return tables
+
+
+def write_cohort(directory: Path, n_samples: int, n_features: int,
+                 duplicate_rate: float = 0.0, sparsity: float = 0.0,
+                 seed: int = 0) -> Tuple[List[Path], int]:
+    """
+    Write a count table with a header for each sample in a synthetic
+    cohort. The features are the gene ids used by write_gtf. Returns the
+    paths to the tables and the total number of records in them.
+    :param directory: The directory the tables will be written to.
+    :param n_samples: The number of samples.
+    :param n_features: The number of distinct features in the cohort.
+    :param duplicate_rate: The fraction of records which are followed by a
+    second record for the same feature.
+    :param sparsity: The fraction of features missing from each table.
+    :param seed: The seed for the random number generator.
+    """
+    rng = random.Random(seed)
+    features = ["ENSG{:011d}.1".format(i) for i in range(n_features)]
+    tables = []
+    records = 0
+    for sample in range(n_samples):
+        path = directory / "sample_{}.tsv".format(sample)
+        lines = ["gene_id\tcount\n"]
+        for feature in features:
+            if rng.random() < sparsity:
+                continue
+            lines.append("{}\t{}\n".format(feature, rng.randint(0, 5000)))
+            if rng.random() < duplicate_rate:
+                lines.append("{}\t{}\n".format(feature,
+                                               rng.randint(0, 5000)))
+        with path.open("w") as table_file:
+            table_file.writelines(lines)
+        tables.append(path)
+        records += len(lines) - 1
+    return tables, records
+
+
+def write_featurecounts_table(path: Path, n_features: int,
+                              seed: int = 0) -> int:
+    """
+    Write a table in the featureCounts format: a comment line, a header
+    and per feature six annotation columns followed by the count. Returns
+    the number of lines.
+    :param path: The path the table will be written to.
+    :param n_features: The number of features.
+    :param seed: The seed for the random number generator.
+    """
+    rng = random.Random(seed)
+    with path.open("w") as table_file:
+        table_file.write("# Program:featureCounts v2.0.1\n")
+        table_file.write("Geneid\tChr\tStart\tEnd\tStrand\tLength\t"
+                         "sample.bam\n")
+        for i in range(n_features):
+            exons = rng.randint(1, 10)
+            starts = sorted(rng.randint(1, 10 ** 8) for _ in range(exons))
+            table_file.write("ENSG{:011d}.1\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                i, ";".join(["chr1"] * exons), ";".join(map(str, starts)),
+                ";".join(str(start + 500) for start in starts),
+                ";".join(["+"] * exons), 500 * exons, rng.randint(0, 5000)))
+    return n_features + 2
+
+
+def write_gtf(path: Path, n_genes: int, transcripts_per_gene: int = 3,
+              exons_per_transcript: int = 4) -> int:
+    """
+    Write a GTF file with gene, transcript and exon records laid out like
+    those in GENCODE. Returns the number of lines written.
+    :param path: The path the GTF file will be written to.
+    :param n_genes: The number of genes.
+    :param transcripts_per_gene: The number of transcripts per gene.
+    :param exons_per_transcript: The number of exons per transcript.
+    """
+    lines = 0
+    with path.open("w") as gtf_file:
+        gtf_file.write("##description: synthetic GENCODE-like annotation\n")
+        for gene in range(n_genes):
+            start = gene * 10000 + 1
+            gene_id = 'gene_id "ENSG{:011d}.1";'.format(gene)
+            gene_attributes = (
+                'gene_type "protein_coding"; gene_name "GENE{0}";'.format(
+                    gene))
+            gtf_file.write(
+                "chr1\tHAVANA\tgene\t{}\t{}\t.\t+\t.\t{} {} level 2; "
+                'hgnc_id "HGNC:{}"; havana_gene "OTTHUMG{:011d}.1";\n'
+                .format(start, start + 9000, gene_id, gene_attributes, gene,
+                        gene))
+            lines += 1
+            for transcript in range(transcripts_per_gene):
+                number = gene * transcripts_per_gene + transcript
+                transcript_attributes = (
+                    '{} transcript_id "ENST{:011d}.1"; {} transcript_type '
+                    '"protein_coding"; transcript_name "GENE{}-{}"; level 2; '
+                    'transcript_support_level "1"; hgnc_id "HGNC:{}"; '
+                    'tag "basic"; tag "CCDS"; havana_gene '
+                    '"OTTHUMG{:011d}.1"; havana_transcript '
+                    '"OTTHUMT{:011d}.1";'.format(
+                        gene_id, number, gene_attributes, gene,
+                        201 + transcript, gene, gene, number))
+                gtf_file.write(
+                    "chr1\tHAVANA\ttranscript\t{}\t{}\t.\t+\t.\t{}\n"
+                    .format(start, start + 9000, transcript_attributes))
+                lines += 1
+                for exon in range(exons_per_transcript):
+                    exon_start = start + exon * 2000
+                    gtf_file.write(
+                        "chr1\tHAVANA\texon\t{}\t{}\t.\t+\t.\t{} "
+                        'exon_number {}; exon_id "ENSE{:011d}.1";\n'.format(
+                            exon_start, exon_start + 500,
+                            transcript_attributes, exon + 1,
+                            number * exons_per_transcript + exon))
+                    lines += 1
+    return lines + 1
+
+
+def benchmark_sum_on_duplicate_id(table_counts: List[int], n_features: int,
+                                  features_per_table: int
+                                  ) -> List[Tuple[int, float]]:
+    """
+    Time collect_columns with sum_on_duplicate_id set for increasing
+    numbers of sparse tables. Returns a list of (number of tables,
+    seconds) pairs. The time per table should stay roughly constant.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tables = write_sparse_tables(Path(tmpdir), max(table_counts),
+                                     n_features, features_per_table)
+        for count in table_counts:
+            names = [table.name for table in tables[:count]]
+            start = time.perf_counter()
+            collect_columns(tables[:count], 0, 1, "\t", names, False, True)
+            results.append((count, time.perf_counter() - start))
+    return results
+
+
+def benchmark_threads(thread_counts: List[int], n_tables: int,
+                      n_features: int) -> List[Tuple[int, float]]:
+    """
+    Time merge_tables with different numbers of parsing processes. Returns
+    a list of (number of processes, seconds) pairs.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tables = write_sparse_tables(Path(tmpdir), n_tables, n_features,
+                                     n_features)
+        names = [table.name for table in tables]
+        for threads in thread_counts:
+            start = time.perf_counter()
+            merge_tables(tables, 0, 1, "\t", names, False, False, threads)
+            results.append((threads, time.perf_counter() - start))
+    return results
+
+
+def _read_attributes_with_gffutils(gtf: Path, feature_attribute: str,
+                                   additional_attributes: List[str],
+                                   features: set) -> dict:
+    """Read attributes by parsing every line with gffutils."""
+    attributes = {}
+    with gtf.open("r") as in_file:
+        for line in in_file:
+            record = gffutils.feature.feature_from_line(line).attributes
+            for feature in record.get(feature_attribute, []):
+                if feature in features:
+                    for attr in additional_attributes:
+                        values = attributes.setdefault(
+                            feature, {}).setdefault(attr, [])
+                        values += [a for a in record.get(attr, [])
+                                   if a not in values]
+    return attributes
+
+
+def benchmark_gtf(n_genes: int, n_features: int,
+                  additional_attributes: List[str]
+                  ) -> List[Tuple[str, float, int]]:
+    """
+    Time retrieving attributes from a synthetic GTF file, both with
+    read_additional_attributes and by parsing every line with gffutils.
+    Returns a list of (method, seconds, lines) tuples.
+    :param n_genes: The number of genes in the GTF file.
+    :param n_features: The number of genes in the merged table.
+    :param additional_attributes: The attributes to retrieve.
+    """
+    features = set("ENSG{:011d}.1".format(gene)
+                   for gene in range(min(n_features, n_genes)))
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gtf = Path(tmpdir) / "annotation.gtf"
+        lines = write_gtf(gtf, n_genes)
+        for method, function in (
+                ("gffutils", _read_attributes_with_gffutils),
+                ("tokenizer", read_additional_attributes)):
+            start = time.perf_counter()
+            function(gtf, "gene_id", additional_attributes, features)
+            results.append((method, time.perf_counter() - start, lines))
+    return results
+
+
+def _read_table_with_csv(table: Path, feature_column: int,
+                         value_column: int, sep: str, has_header: bool):
+    """Read a table by splitting every line into all fields with csv."""
+    with table.open("r") as table_file:
+        reader = csv.reader(table_file, delimiter=sep)
+        if has_header is True:
+            next(reader)
+        for record in reader:
+            yield record[feature_column], record[value_column]
+
+
+def benchmark_read(n_features: int) -> List[Tuple[str, float, int]]:
+    """
+    Time parsing the feature ids and counts from a wide, featureCounts
+    style table, both with parse_table and by splitting every line with
+    csv. Returns a list of (method, seconds, lines) tuples.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        table = Path(tmpdir) / "sample.featureCounts"
+        lines = write_featurecounts_table(table, n_features)
+        # The comment line is skipped as a header, the real header is
+        # parsed as a record, so the values can not be summed.
+        for method, function in (
+                ("csv", lambda: ParsedTable.from_records(
+                    _read_table_with_csv(table, 0, 6, "\t", True), False)),
+                ("parse_table", lambda: parse_table(
+                    table, 0, 6, "\t", True, False))):
+            start = time.perf_counter()
+            function()
+            results.append((method, time.perf_counter() - start, lines))
+    return results
+
+
+def _run_main(args: List[str]) -> Tuple[float, int]:
+    """
+    Run the command line tool in a new process. Returns the wall time and
+    the peak resident set size of that process in bytes.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "collect_columns.collect_columns"] + args)
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    peak = usage.ru_maxrss
+    return seconds, peak if sys.platform == "darwin" else peak * 1024
+
+
+def benchmark_cohort(n_samples: int, n_features: int,
+                     duplicate_rate: float, sparsity: float,
+                     additional_attributes: List[str]
+                     ) -> List[Tuple[str, float, int, int]]:
+    """
+    Time merging a synthetic cohort with the command line tool as a
+    whole, followed by its stages: parsing and merging the tables with
+    -S, adding attributes from a GTF file and writing the output. Returns
+    a list of (stage, seconds, peak RSS in bytes, rows) tuples. The
+    command line tool runs in its own process, the peak RSS of the
+    separate stages is that of the benchmark process up to the end of
+    the stage.
+    :param n_samples: The number of samples (tables).
+    :param n_features: The number of distinct features.
+    :param duplicate_rate: The fraction of records which are duplicated.
+    :param sparsity: The fraction of features missing from each table.
+    :param additional_attributes: The attributes to retrieve from the
+    GTF file.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = Path(tmpdir)
+        tables, records = write_cohort(directory, n_samples, n_features,
+                                       duplicate_rate, sparsity)
+        gtf = directory / "annotation.gtf"
+        gtf_lines = write_gtf(gtf, n_features)
+        output = directory / "merged.tsv"
+        names = [table.stem for table in tables]
+
+        # The command line tool runs first, the peak RSS of a new process
+        # includes that of its parent at the time it was started.
+        seconds, peak = _run_main(
+            [str(output)] + [str(path) for path in tables] +
+            ["-H", "-S", "-g", str(gtf), "-a"] + additional_attributes)
+        results.append(("main", seconds, peak, records))
+        start = time.perf_counter()
+        table = merge_tables(tables, 0, 1, "\t", names, True, True)
+        results.append(("merge", time.perf_counter() - start, peak_rss(),
+                        records))
+        start = time.perf_counter()
+        add_additional_attributes(table, gtf, "gene_id",
+                                  additional_attributes)
+        results.append(("annotate", time.perf_counter() - start,
+                        peak_rss(), gtf_lines))
+        start = time.perf_counter()
+        write_merged_text(output, table, additional_attributes, names, "\t")
+        results.append(("write", time.perf_counter() - start, peak_rss(),
+                        len(table)))
+    return results
+
+
+def import_profile(module: str) -> Tuple[float, List[str]]:
+    """
+    Import a module in a new Python process. Returns the time the import
+    took and the names of all modules loaded by then.
+    """
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import {}\n"
+            "print(time.perf_counter() - start)\n"
+            "print(' '.join(sorted(sys.modules)))").format(module)
+    output = subprocess.run([sys.executable, "-c", code],
+                            stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+    seconds, modules = output.splitlines()
+    return float(seconds), modules.split()
+
+
+def benchmark_startup(runs: int) -> List[Tuple[str, float]]:
+    """
+    Time importing the command line tool and running it on two small
+    tables, without and with attributes from a GTF file. Returns a list
+    of (step, seconds) tuples, with the best time of the given number of
+    runs.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = Path(tmpdir)
+        tables = write_sparse_tables(directory, 2, 100, 100)
+        gtf = directory / "annotation.gtf"
+        write_gtf(gtf, 100)
+        arguments = [str(directory / "merged.tsv")] + [str(table)
+                                                       for table in tables]
+        steps = [
+            ("import", lambda: import_profile(
+                "collect_columns.collect_columns")[0]),
+            ("run", lambda: _run_main(arguments)[0]),
+            ("run_annotated", lambda: _run_main(
+                arguments + ["-g", str(gtf), "-a", "gene_name"])[0])]
+        return [(step, min(function() for _ in range(runs)))
+                for step, function in steps]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark collect-columns on synthetic tables.")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+    sum_parser = subparsers.add_parser(
+        "sum", help="Time merging sparse tables with -S for increasing "
+                    "numbers of tables.")
+    sum_parser.add_argument("--features", type=int, default=60000,
+                            help="The total number of distinct features.")
+    sum_parser.add_argument("--features-per-table", type=int, default=2000,
+                            help="The number of features in each table.")
+    sum_parser.add_argument("--tables", type=int, nargs="+",
+                            default=[50, 100, 200, 400],
+                            help="The numbers of tables to time.")
+    threads_parser = subparsers.add_parser(
+        "threads", help="Time parsing tables with increasing numbers of "
+                        "processes.")
+    threads_parser.add_argument("--features", type=int, default=60000,
+                                help="The number of features per table.")
+    threads_parser.add_argument("--tables", type=int, default=64,
+                                help="The number of tables.")
+    threads_parser.add_argument("--threads", type=int, nargs="+",
+                                default=[1, 2, 4, 8],
+                                help="The numbers of processes to time.")
+    gtf_parser = subparsers.add_parser(
+        "gtf", help="Time retrieving attributes from a GTF file.")
+    gtf_parser.add_argument("--genes", type=int, default=20000,
+                            help="The number of genes in the GTF file.")
+    gtf_parser.add_argument("--features", type=int, default=20000,
+                            help="The number of genes in the merged table.")
+    gtf_parser.add_argument("--attributes", nargs="+",
+                            default=["gene_name", "gene_type"],
+                            help="The attributes to retrieve.")
+    read_parser = subparsers.add_parser(
+        "read", help="Time reading a wide, featureCounts style table.")
+    read_parser.add_argument("--features", type=int, default=500000,
+                             help="The number of features in the table.")
+    cohort_parser = subparsers.add_parser(
+        "cohort", help="Time the stages of merging a synthetic cohort and "
+                       "report the wall time, peak memory use and "
+                       "throughput of each.")
+    cohort_parser.add_argument("--samples", type=int, default=100,
+                               help="The number of samples.")
+    cohort_parser.add_argument("--features", type=int, default=60000,
+                               help="The number of distinct features.")
+    cohort_parser.add_argument("--duplicate-rate", type=float, default=0.0,
+                               help="The fraction of records which are "
+                                    "duplicated.")
+    cohort_parser.add_argument("--sparsity", type=float, default=0.0,
+                               help="The fraction of features missing from "
+                                    "each table.")
+    cohort_parser.add_argument("--attributes", nargs="+",
+                               default=["gene_name", "gene_type"],
+                               help="The attributes to retrieve.")
+    startup_parser = subparsers.add_parser(
+        "startup", help="Time importing and running the command line tool "
+                        "on small tables.")
+    startup_parser.add_argument("--runs", type=int, default=5,
+                                help="The number of runs, the best time "
+                                     "is reported.")
+    args = parser.parse_args()
+    if args.benchmark == "sum":
+        print("tables\tseconds\tms/table")
+        for count, seconds in benchmark_sum_on_duplicate_id(
+                args.tables, args.features, args.features_per_table):
+            print("{}\t{:.3f}\t{:.3f}".format(
+                count, seconds, seconds / count * 1000))
+    elif args.benchmark == "threads":
+        print("threads\tseconds\tspeedup")
+        results = benchmark_threads(args.threads, args.tables,
+                                    args.features)
+        for threads, seconds in results:
+            print("{}\t{:.3f}\t{:.2f}".format(
+                threads, seconds, results[0][1] / seconds))
+    elif args.benchmark == "gtf":
+        print("method\tseconds\tlines/s\tspeedup")
+        results = benchmark_gtf(args.genes, args.features, args.attributes)
+        for method, seconds, lines in results:
+            print("{}\t{:.3f}\t{:.0f}\t{:.2f}".format(
+                method, seconds, lines / seconds, results[0][1] / seconds))
+    elif args.benchmark == "cohort":
+        print("stage\tseconds\tpeak_rss_mb\trows\trows/s")
+        for stage, seconds, peak, rows in benchmark_cohort(
+                args.samples, args.features, args.duplicate_rate,
+                args.sparsity, args.attributes):
+            print("{}\t{:.3f}\t{}\t{}\t{:.0f}".format(
+                stage, seconds,
+                "NA" if peak is None else "{:.1f}".format(peak / 1024 ** 2),
+                rows, rows / seconds))
+    elif args.benchmark == "read":
+        print("method\tseconds\tlines/s\tspeedup")
+        results = benchmark_read(args.features)
+        for method, seconds, lines in results:
+            print("{}\t{:.3f}\t{:.0f}\t{:.2f}".format(
+                method, seconds, lines / seconds, results[0][1] / seconds))
+    elif args.benchmark == "startup":
+        print("step\tseconds")
+        for step, seconds in benchmark_startup(args.runs):
+            print("{}\t{:.3f}".format(step, seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Helpers for the on-disk caches, which store one file per entry in a cache
+directory and evict the least recently used entries when the directory
+grows too large.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+
+def file_key(path: Path) -> list:
+    """
+    Return a JSON serializable key identifying the current version of a
+    file, based on its absolute path, size and modification time.
+    """
+    stat = path.stat()
+    return [str(path.resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+def content_key(path: Path, data: Optional[bytes] = None) -> str:
+    """
+    Return a key identifying the contents of a file: the SHA-256 digest
+    of its bytes. Unlike file_key this stays the same when the file is
+    copied, moved or touched. If the file has already been read, its
+    contents may be given as data.
+    """
+    if data is not None:
+        return hashlib.sha256(data).hexdigest()
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 ** 2), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir: Path, key, suffix: str) -> Path:
+    """
+    Return the path of the cache entry for a key.
+    :param cache_dir: The cache directory.
+    :param key: A JSON serializable key.
+    :param suffix: The file extension of the entry.
+    """
+    digest = hashlib.sha256(
+        json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return cache_dir / (digest + suffix)
+
+
+def write_entry(path: Path, data: bytes):
+    """
+    Write a cache entry. The data is first written to a temporary file,
+    which is moved into place once it is complete, so concurrent readers
+    never see a partial entry.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=".",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def touch(path: Path):
+    """Mark a cache entry as used."""
+    os.utime(str(path))
+
+
+def _is_entry(path: Path, suffix: Optional[str]) -> bool:
+    """
+    Whether or not a file is a cache entry: named by cache_path, with the
+    given suffix if any.
+    """
+    name = path.name
+    digest, dot, extension = name.partition(".")
+    return (len(digest) == 64 and dot == "." and
+            all(c in "0123456789abcdef" for c in digest) and
+            (suffix is None or "." + extension == suffix) and
+            path.is_file())
+
+
+def evict(cache_dir: Path, max_size: int, suffix: Optional[str] = None,
+          keep: Optional[Path] = None):
+    """
+    Remove the least recently used entries from a cache directory until
+    their total size is at most max_size bytes. Only files named by
+    cache_path are considered, other files in the directory are left
+    alone.
+    :param cache_dir: The cache directory.
+    :param max_size: The maximum total size in bytes.
+    :param suffix: If given, only the entries with this file extension
+    are considered, so caches sharing a directory do not evict each
+    other's entries.
+    :param keep: An entry which should never be removed, for example the
+    one which is currently in use.
+    """
+    entries = []
+    for path in cache_dir.iterdir():
+        if _is_entry(path, suffix):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            # Removed by a concurrent process.
+            pass
+        total -= size
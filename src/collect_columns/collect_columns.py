@@ -20,17 +20,52 @@
 
 import argparse
 import csv
+import heapq
+import io
+import locale
+import mmap
+import os
+import re
+import stat
+import sys
+from contextlib import ExitStack
+from itertools import groupby, repeat
+from operator import itemgetter
 from pathlib import Path
-from typing import List
-from warnings import warn
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple, Union
 
-import gffutils
+from .annotation import (DEFAULT_CACHE_SIZE, read_additional_attributes,
+                         read_feature_order)
+from .cache import cache_path, content_key, evict, touch, write_entry
+from .compression import (data_compression_type, decompress, open_input,
+                          output_compression_error)
+from .formats import (COMPRESSED_EXTENSIONS, FORMATS, output_format,
+                      read_merged_table, write_merged_text, write_table,
+                      write_text)
+from .merged_table import (DUPLICATE_POLICIES, NUMERIC_POLICIES,
+                           PARSED_TABLE_VERSION, MergedTable, ParsedTable,
+                           StringColumn, duplicate_policy, report_duplicates)
+from .prefetch import read_ahead
+from .selection import FeatureSelection
+from .shards import Shard, combine_shards, combined_features
+from .stats import RunStats
+
+
+# The typecodes of the arrays used for numeric value types.
+VALUE_TYPECODES = {"int": "q", "float": "d"}
+
+# The output formats which store typed columns.
+TYPED_FORMATS = ("native", "parquet", "feather")
+
+
+_DIGITS = re.compile(r"(\d+)")
 
 
 def collect_columns(count_tables: List[Path], feature_column: int,
                     value_column: int, sep: str, names: List[str],
                     tables_have_headers: bool,
-                    sum_on_duplicate_id: bool) -> dict:
+                    sum_on_duplicate_id: bool,
+                    on_duplicate: Optional[str] = None) -> dict:
     """
     Retrieve a column from each in a set of tables and put them into a
     single table, mapping the rows based on other column.
@@ -46,88 +81,616 @@ def collect_columns(count_tables: List[Path], feature_column: int,
     :param tables_have_headers: Whether or not the tables have a header.
     :param sum_on_duplicate_id: Whether or not values should be added up
     if multiple rows exist with the same feature id.
+    :param on_duplicate: What to do if multiple rows exist with the same
+    feature id, one of 'last', 'first', 'sum', 'max', 'mean' or 'error'.
+    Overrides sum_on_duplicate_id. Features which occur multiple times
+    are reported in one warning per table for 'last' and 'first'.
+    """
+    # Summed values are kept as floats while merging and are only turned
+    # into strings once, when the dictionary is created.
+    return merge_tables(count_tables, feature_column, value_column, sep,
+                        names, tables_have_headers, sum_on_duplicate_id,
+                        on_duplicate=on_duplicate).to_dict()
+
+
+def read_table(table: Path, feature_column: int, value_column: int,
+               sep: str, has_header: bool) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the (feature, value) pairs from a table.
+    :param table: The path to the table, which may be gzip, bgzip or
+    zstd compressed.
+    :param feature_column: The position of the column with the feature
+    ids.
+    :param value_column: The position of the column with the values of
+    interest.
+    :param sep: The separator used in the table.
+    :param has_header: Whether or not the table has a header.
+    """
+    return read_columns(table, [feature_column, value_column], sep,
+                        has_header)
+
+
+def read_columns(table: Path, columns: List[int], sep: str,
+                 has_header: bool, data: Optional[bytes] = None
+                 ) -> Iterator[Tuple[str, ...]]:
+    """
+    Yield a tuple with the given columns for each record in a table. Takes
+    the same arguments as read_table.
+    :param columns: The positions of at least two columns.
+    :param data: The contents of the table, if it has already been read.
     """
-    # If no sample names are given use table basenames instead.
-    merged_table = {}
-    for i, table in enumerate(count_tables):
-        reader = csv.reader(table.open(), delimiter=sep)
-        column_name = names[i]
-        if tables_have_headers is True:
+    if can_split_table(table, *columns, data=data):
+        encoding = locale.getpreferredencoding(False)
+        for fields in split_columns(table, columns, sep, has_header, data):
+            yield tuple(field.decode(encoding) for field in fields)
+        return
+    fields = itemgetter(*columns)
+    with _open_text(table, data) as table_file:
+        reader = csv.reader(table_file, delimiter=sep)
+        if has_header is True:
             next(reader)
         for record in reader:
-            feature = record[feature_column]
-            value = (float(record[value_column]) if sum_on_duplicate_id
-                     else record[value_column])
-            try:
-                if column_name in merged_table[feature].keys():
-                    if sum_on_duplicate_id:
-                        merged_table[feature][column_name] += value
-                    else:
-                        warn("duplicate value for row {} in {}, will "
-                             "overwrite previous value".format(feature,
-                                                               column_name))
-                        merged_table[feature][column_name] = value
-                else:
-                    merged_table[feature][column_name] = value
-            # If feature key does not have a dict yet, create the dict.
-            except KeyError:
-                merged_table[feature] = {column_name: value}
-
-        if sum_on_duplicate_id:
-            for feature_id in merged_table.keys():
-                try:
-                    merged_table[feature_id][column_name] = str(
-                        merged_table[feature_id][column_name])
-                except KeyError:
-                    pass
+            yield fields(record)
+
+
+def _open_text(table: Path, data: Optional[bytes]) -> TextIO:
+    """
+    Open a table in text mode, or its contents if it has already been
+    read.
+    """
+    if data is None:
+        return open_input(table)
+    return io.TextIOWrapper(io.BytesIO(decompress(data)))
+
+
+def read_header(table: Path, sep: str, data: Optional[bytes] = None
+                ) -> List[str]:
+    """Read the column names from the first line of a table."""
+    with _open_text(table, data) as table_file:
+        return next(csv.reader(table_file, delimiter=sep), [])
+
+
+def resolve_columns(table: Path, columns: List[Union[int, str]], sep: str,
+                    has_header: bool, data: Optional[bytes] = None
+                    ) -> List[int]:
+    """
+    Convert column names to positions using the header of a table.
+    Positions are returned as is. Raises a ValueError if a column name is
+    used for a table without a header or is not in its header. The
+    contents of the table may be given as data.
+    """
+    if all(isinstance(column, int) for column in columns):
+        return list(columns)
+    if not has_header:
+        raise ValueError("Columns can only be given by name for tables "
+                         "with a header.")
+    header = read_header(table, sep, data)
+    positions = []
+    for column in columns:
+        if isinstance(column, int):
+            positions.append(column)
+        elif column in header:
+            positions.append(header.index(column))
+        else:
+            raise ValueError("{} has no column named {}.".format(table,
+                                                                 column))
+    return positions
+
+
+def is_regular_file(path: Path) -> bool:
+    """
+    Whether or not a path is a regular file, rather than for instance a
+    pipe from a process substitution, which can only be read once.
+    """
+    return stat.S_ISREG(os.stat(str(path)).st_mode)
+
+
+def can_split_table(table: Path, *columns: int,
+                    data: Optional[bytes] = None) -> bool:
+    """
+    Whether or not a table can be read with split_columns: it should be
+    uncompressed, not empty and not contain quoted fields, which can only
+    be parsed by the csv module. Takes the positions of the columns which
+    will be read and, if it has already been read, the contents of the
+    table.
+    """
+    if any(column < 0 for column in columns):
+        return False
+    if data is not None:
+        return (data != b"" and data_compression_type(data) is None and
+                data.find(b'"') == -1)
+    if not is_regular_file(table):
+        # Pipes can not be memory mapped, nor be opened twice.
+        return False
+    with table.open("rb") as table_file:
+        start = table_file.read(4)
+        if start == b"" or data_compression_type(start) is not None:
+            return False
+        with mmap.mmap(table_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            return data.find(b'"') == -1
+
+
+def split_columns(table: Path, columns: List[int], sep: str,
+                  has_header: bool, data: Optional[bytes] = None
+                  ) -> Iterator[Tuple[bytes, ...]]:
+    """
+    Yield a tuple with the given columns, as undecoded bytes, for each
+    record in a table. The table is memory mapped, unless its contents
+    are given, and each line is only split up to the last column needed.
+    Takes the same arguments as read_columns, the table should meet the
+    requirements checked by can_split_table.
+    """
+    separator = sep.encode(locale.getpreferredencoding(False))
+    maxsplit = max(columns) + 1
+    fields_of_interest = itemgetter(*columns)
+    if data is not None:
+        contents = io.BytesIO(data)
+    else:
+        with table.open("rb") as table_file:
+            if is_regular_file(table):
+                contents = mmap.mmap(table_file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            else:
+                contents = io.BytesIO(table_file.read())
+    with contents:
+        lines = iter(contents.readline, b"")
+        if has_header is True:
+            next(lines, None)
+        for line in lines:
+            fields = line.split(separator, maxsplit)
+            if len(fields) <= maxsplit:
+                # The last field holds the line ending and may be needed.
+                fields[-1] = fields[-1].rstrip(b"\r\n")
+            yield fields_of_interest(fields)
+
+
+def parse_table(table: Path, feature_column: int,
+                value_column: Union[int, str], sep: str, has_header: bool,
+                numeric: bool, cache_dir: Optional[Path] = None,
+                typecode: str = "d",
+                selection: Optional[FeatureSelection] = None
+                ) -> ParsedTable:
+    """
+    Read a table into a ParsedTable. Takes the same arguments as
+    read_table.
+    :param numeric: Whether or not the values should be converted to
+    numbers.
+    :param cache_dir: If given, the parsed table is stored in this
+    directory and reused when a table with the same contents is parsed
+    with the same arguments.
+    :param typecode: The type of the numbers: 'd' for floats, 'q' for
+    integers.
+    :param selection: If given, only the records of the selected features
+    are kept.
+    """
+    return parse_columns(table, feature_column, [value_column], sep,
+                         has_header, numeric, cache_dir, typecode,
+                         selection)[0]
+
+
+def parse_columns(table: Path, feature_column: int,
+                  value_columns: List[Union[int, str]], sep: str,
+                  has_header: bool, numeric: bool,
+                  cache_dir: Optional[Path] = None,
+                  typecode: str = "d",
+                  selection: Optional[FeatureSelection] = None,
+                  data: Optional[bytes] = None
+                  ) -> List[ParsedTable]:
+    """
+    Read several value columns from a table in a single pass, into one
+    ParsedTable per column. Takes the same arguments as parse_table.
+    :param value_columns: The positions of the value columns, or their
+    names in the header.
+    :param data: The contents of the table, if it has already been read.
+    """
+    if data is None and (cache_dir is not None or not all(
+            isinstance(column, int) for column in value_columns)) and (
+            not is_regular_file(table)):
+        # The header and the cache key are read before the records, so a
+        # pipe is read into memory first.
+        data = table.read_bytes()
+    value_columns = resolve_columns(table, value_columns, sep, has_header,
+                                    data)
+    if cache_dir is None:
+        return _parse_columns(table, feature_column, value_columns, sep,
+                              has_header, numeric, typecode, selection,
+                              data)
+    # Each column is cached on its own, so it can be reused by runs which
+    # read other combinations of columns.
+    key = content_key(table, data)
+    paths = [cache_path(cache_dir, [
+        PARSED_TABLE_VERSION, key, feature_column, value_column, sep,
+        has_header, numeric and typecode,
+        None if selection is None else selection.key()], ".parsed")
+        for value_column in value_columns]
+    try:
+        parsed_tables = [ParsedTable.from_bytes(path.read_bytes())
+                         for path in paths]
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        for path in paths:
+            touch(path)
+        return parsed_tables
+    parsed_tables = _parse_columns(table, feature_column, value_columns,
+                                   sep, has_header, numeric, typecode,
+                                   selection, data)
+    for path, parsed_table in zip(paths, parsed_tables):
+        try:
+            write_entry(path, parsed_table.to_bytes())
+        except ValueError:
+            # Tables with NUL characters cannot be stored, these are
+            # parsed every time.
+            break
+    return parsed_tables
+
+
+def _parse_columns(table: Path, feature_column: int,
+                   value_columns: List[int], sep: str, has_header: bool,
+                   numeric: bool, typecode: str,
+                   selection: Optional[FeatureSelection],
+                   data: Optional[bytes] = None) -> List[ParsedTable]:
+    columns = [feature_column] + value_columns
+    encoding = None
+    if can_split_table(table, *columns, data=data):
+        # Each distinct feature is only decoded once and numbers are
+        # converted straight from bytes.
+        encoding = locale.getpreferredencoding(False)
+        records = split_columns(table, columns, sep, has_header, data)
+    else:
+        records = read_columns(table, columns, sep, has_header, data)
+    if selection is not None:
+        records = selection.filter(records, encoding)
+    if len(value_columns) == 1:
+        return [ParsedTable.from_records(records, numeric, encoding,
+                                         typecode)]
+    return ParsedTable.from_rows(records, len(value_columns), numeric,
+                                 encoding, typecode)
+
+
+def value_column_names(names: List[str],
+                       value_columns: List[Union[int, str]]) -> List[str]:
+    """
+    Name the merged columns for each value column and sample. For a
+    single value column these are the sample names, otherwise the sample
+    names are prefixed with the value column, as given: 'TPM_sample1',
+    'TPM_sample2', 'NumReads_sample1' and so on.
+    """
+    if len(value_columns) == 1:
+        return list(names)
+    return ["{}_{}".format(value_column, name)
+            for value_column in value_columns for name in names]
+
+
+def merge_tables(count_tables: List[Path], feature_column: int,
+                 value_column: Union[int, str, List[Union[int, str]]],
+                 sep: str, names: List[str],
+                 tables_have_headers: bool, sum_on_duplicate_id: bool,
+                 threads: int = 1,
+                 merged_table: Optional[MergedTable] = None,
+                 cache_dir: Optional[Path] = None,
+                 cache_size: int = DEFAULT_CACHE_SIZE,
+                 stats: Optional[RunStats] = None,
+                 on_duplicate: Optional[str] = None,
+                 value_type: Optional[str] = None,
+                 selection: Optional[FeatureSelection] = None,
+                 prefetch: int = 0, sparse: bool = False) -> MergedTable:
+    """
+    Retrieve a column from each in a set of tables and put them into a
+    single columnar table, mapping the rows based on other column. Takes
+    the same arguments as collect_columns.
+    :param threads: The number of processes used to parse the tables. The
+    tables are always merged in the order they are given.
+    :param merged_table: An existing table to which the columns will be
+    added. Features which are not yet in this table are added as new rows,
+    which have no value in the existing columns. A new table is created
+    if not given.
+    :param cache_dir: If given, the parsed tables are cached in this
+    directory, see parse_table.
+    :param cache_size: The maximum size of the cache directory in
+    megabytes.
+    :param stats: If given, the number of records and duplicate feature
+    ids in each table are recorded in it.
+    :param on_duplicate: What to do if multiple rows exist with the same
+    feature id, see collect_columns.
+    :param value_type: The type of the values: 'string', 'int' or 'float'.
+    Numbers are stored in typed arrays. Defaults to 'float' if the values
+    of duplicate features are reduced to one number and to 'string'
+    otherwise.
+    :param selection: If given, only the selected features are read from
+    the tables.
+    :param prefetch: The number of tables which are read ahead, in as
+    many threads, while a table is parsed. Only used if the tables are
+    parsed in a single process, with multiple processes each process
+    reads its own tables.
+    :param sparse: Store only the non-zero values of each column, see
+    SparseColumn. Requires numeric values.
+    If value_column is a list of positions or header names, all of these
+    columns are read in a single pass over each table. The merged columns
+    are named as returned by value_column_names.
+    """
+    value_columns = (value_column if isinstance(value_column, list)
+                     else [value_column])
+    column_names = value_column_names(names, value_columns)
+    policy = duplicate_policy(sum_on_duplicate_id, on_duplicate)
+    if value_type is None:
+        value_type = "float" if policy in NUMERIC_POLICIES else "string"
+    elif value_type == "string" and policy in NUMERIC_POLICIES:
+        raise ValueError("String values cannot be reduced with the {} "
+                         "duplicate policy.".format(policy))
+    parse_arguments = (repeat(feature_column), repeat(value_columns),
+                       repeat(sep), repeat(tables_have_headers),
+                       repeat(value_type != "string"), repeat(cache_dir),
+                       repeat(VALUE_TYPECODES.get(value_type, "d")),
+                       repeat(selection))
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    if merged_table is None:
+        merged_table = MergedTable()
+    else:
+        for column_name in column_names:
+            if column_name in merged_table.columns:
+                raise ValueError("The table already has a column named "
+                                 "{}.".format(column_name))
+    if threads > 1:
+        # multiprocessing is only imported when it is used, see
+        # test_imports.
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(threads)
+        parsed_tables = executor.map(parse_columns, count_tables,
+                                     *parse_arguments)
+    elif prefetch > 0:
+        executor = None
+        parsed_tables = map(parse_columns, count_tables, *parse_arguments,
+                            read_ahead(count_tables, prefetch))
+    else:
+        executor = None
+        parsed_tables = map(parse_columns, count_tables, *parse_arguments)
+    try:
+        for i, (table, parsed_columns) in enumerate(zip(count_tables,
+                                                        parsed_tables)):
+            for j, parsed_table in enumerate(parsed_columns):
+                merged_table.add_parsed_table(
+                    column_names[j * len(names) + i], parsed_table,
+                    sum_on_duplicate_id, policy, sparse)
+            if stats is not None:
+                stats.add_input(table, names[i], parsed_columns[0])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if cache_dir is not None:
+        evict(cache_dir, cache_size * 1000 ** 2, ".parsed")
     return merged_table
 
 
-def add_additional_attributes(table: dict, gtf: Path,
+def tables_are_sorted(count_tables: List[Path], feature_column: int,
+                      sep: str, tables_have_headers: bool) -> bool:
+    """
+    Check whether all tables are sorted by feature id. Only one record per
+    table is kept in memory. Tables which are not regular files, such as
+    pipes, are considered unsorted.
+    :param count_tables: A list of paths to the tables to be checked.
+    :param feature_column: The position of the column with the feature
+    ids.
+    :param sep: The separator used in the tables.
+    :param tables_have_headers: Whether or not the tables have a header.
+    """
+    if not all(map(is_regular_file, count_tables)):
+        # Checking would use up the contents of a pipe.
+        return False
+    for table in count_tables:
+        previous = None
+        for feature, _ in read_table(table, feature_column, feature_column,
+                                     sep, tables_have_headers):
+            if previous is not None and feature < previous:
+                return False
+            previous = feature
+    return True
+
+
+def _sorted_table_values(table: Path, feature_column: int,
+                         value_column: Union[int, str], sep: str,
+                         has_header: bool, column_name: str, policy: str,
+                         duplicates: Optional[list] = None,
+                         selection: Optional[FeatureSelection] = None,
+                         value_type: Optional[str] = None,
+                         counts: Optional[List[int]] = None
+                         ) -> Iterator[Tuple[str, Union[str, int, float]]]:
+    """
+    Yield one (feature, value) pair per feature from a table which is
+    sorted by feature id, reducing the values of duplicate feature ids
+    according to the duplicate policy. The duplicate features are
+    reported once the whole table has been read and, if given, added to
+    duplicates as (column name, feature, number of records) tuples. Only
+    the records of features in selection are used, if given. The values
+    are converted to value_type, with the same default as merge_tables.
+    If given, counts is set to the number of records and the number of
+    features read, once the whole table has been read.
+    """
+    if value_type is None:
+        value_type = "float" if policy in NUMERIC_POLICIES else "string"
+    convert = {"int": int, "float": float}.get(value_type)
+    previous = None
+    table_duplicates = []
+    records_read = features_read = 0
+    value_column, = resolve_columns(table, [value_column], sep, has_header)
+    records = read_table(table, feature_column, value_column, sep,
+                         has_header)
+    if selection is not None:
+        records = selection.filter(records)
+    for feature, group in groupby(records, key=itemgetter(0)):
+        if previous is not None and feature < previous:
+            raise ValueError(
+                "{} is not sorted by feature id: {} comes after {}.".format(
+                    table, feature, previous))
+        previous = feature
+        values = [value for _, value in group]
+        records_read += len(values)
+        features_read += 1
+        if convert is not None:
+            values = list(map(convert, values))
+        if len(values) > 1:
+            if policy == "error":
+                report_duplicates(column_name, [(feature, len(values))],
+                                  policy)
+            table_duplicates.append((feature, len(values)))
+        if policy == "sum":
+            yield feature, sum(values)
+        elif policy == "max":
+            yield feature, max(values)
+        elif policy == "mean":
+            yield feature, sum(values) / len(values)
+        elif policy == "first":
+            yield feature, values[0]
+        else:
+            yield feature, values[-1]
+    report_duplicates(column_name, table_duplicates, policy)
+    if duplicates is not None:
+        duplicates.extend((column_name, feature, count)
+                          for feature, count in table_duplicates)
+    if counts is not None:
+        counts[:] = [records_read, features_read]
+
+
+def _tag_values(index: int, values: Iterator[Tuple[str, Union[str, float]]]
+                ) -> Iterator[Tuple[str, int, Union[str, float]]]:
+    """
+    Add the index of a table to its (feature, value) pairs, so that the
+    pairs of multiple tables are sorted by feature id and then by table.
+    """
+    for feature, value in values:
+        yield feature, index, value
+
+
+def stream_sorted_tables(count_tables: List[Path], feature_column: int,
+                         value_column: Union[int, str], sep: str,
+                         names: List[str],
+                         tables_have_headers: bool,
+                         sum_on_duplicate_id: bool,
+                         on_duplicate: Optional[str] = None,
+                         duplicates: Optional[list] = None,
+                         selection: Optional[FeatureSelection] = None,
+                         value_type: Optional[str] = None,
+                         stats: Optional[RunStats] = None
+                         ) -> Iterator[list]:
+    """
+    Merge tables which are sorted by feature id, without keeping the
+    merged table in memory. Takes the same arguments as collect_columns.
+    :param duplicates: If given, (column name, feature, number of records)
+    tuples are added to it for features which occur multiple times in a
+    table.
+    :param selection: If given, only the selected features are merged.
+    :param value_type: The type of the values, see merge_tables.
+    :param stats: If given, the records read from each table are recorded
+    in it once all tables have been read.
+    Yields the rows of the merged table in sorted order, each as a list
+    starting with the feature id and followed by the value from each
+    table. Missing values are None. Raises a ValueError if a table turns
+    out not to be sorted.
+    """
+    policy = duplicate_policy(sum_on_duplicate_id, on_duplicate)
+    if value_type == "string" and policy in NUMERIC_POLICIES:
+        raise ValueError("String values cannot be reduced with the {} "
+                         "duplicate policy.".format(policy))
+    counts = [[0, 0] for _ in count_tables]
+    streams = [_tag_values(i, _sorted_table_values(
+                   table, feature_column, value_column, sep,
+                   tables_have_headers, column_name, policy, duplicates,
+                   selection, value_type, counts[i]))
+               for i, (table, column_name) in enumerate(zip(count_tables,
+                                                            names))]
+    for feature, group in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        row = [feature] + [None] * len(count_tables)
+        for _, i, value in group:
+            row[i + 1] = value
+        yield row
+    if stats is not None:
+        for table, column_name, (records, features) in zip(
+                count_tables, names, counts):
+            stats.add_input_counts(table, column_name, records, features)
+
+
+def read_feature_lengths(count_tables: List[Path], feature_column: int,
+                         length_column: int, sep: str,
+                         tables_have_headers: bool) -> Dict[str, float]:
+    """
+    Read the lengths of the features from a column in the tables. If a
+    feature occurs in multiple tables, the length in the last table is
+    used.
+    :param count_tables: A list of paths to the tables.
+    :param feature_column: The position of the column with the feature
+    ids.
+    :param length_column: The position of the column with the lengths.
+    :param sep: The separator used in the tables.
+    :param tables_have_headers: Whether or not the tables have a header.
+    """
+    lengths = {}
+    for table in count_tables:
+        for feature, length in read_table(table, feature_column,
+                                          length_column, sep,
+                                          tables_have_headers):
+            lengths[feature] = float(length)
+    return lengths
+
+
+def add_additional_attributes(table: Union[dict, MergedTable], gtf: Path,
                               feature_attribute: str,
-                              additional_attributes: List[str]):
+                              additional_attributes: List[str],
+                              cache_dir: Optional[Path] = None,
+                              cache_size: int = DEFAULT_CACHE_SIZE,
+                              feature_types: Optional[List[str]] = None,
+                              early_exit: bool = False,
+                              features: Optional[List[str]] = None):
     """
     Retrieve additional attributes from the GTF/GFF and add them to the
     table.
-    :param table: The pandas DataFrame to which the additional
-    attributes will be added.
+    :param table: The table to which the additional attributes will be
+    added, either a MergedTable or a dictionary as returned by
+    collect_columns.
     :param gtf: The path to the the GTF/GFF file.
     :param feature_attribute: The attribute from the GTF/GFF used for
     matching the feature records with the rows in the table.
     :param additional_attributes: A list containing the keys of the
     attributes which will be added to the table.
+    :param cache_dir: If given, the attributes are looked up in an index
+    of the GTF/GFF which is cached in this directory.
+    :param cache_size: The maximum size of the cache directory in
+    megabytes.
+    :param feature_types: If given, only GTF/GFF records with one of these
+    feature types (third column) are used.
+    :param early_exit: Stop reading the GTF/GFF as soon as a record has
+    been found for each feature in the table.
+    :param features: If given, the attributes are only retrieved for these
+    features. The existing values of the attributes for the other
+    features are kept.
     """
-    # Create dictionary mapping attributes to features
-    with gtf.open("r") as in_file:
-        for line in in_file:
-            record = gffutils.feature.feature_from_line(line)
-            for attr in additional_attributes:
-                for feature in record.attributes.get(feature_attribute, []):
-                    if feature in table.keys():
-                        # Use lists to ensure the order stays the same.
-                        # This way attributes which belong together
-                        # will likely have to same position in their
-                        # respective columns, assuming the available
-                        # attributes for each record is consistent.
-                        try:
-                            table[feature][attr] += (
-                                [a for a in record.attributes.get(attr, [])
-                                 if a not in table[feature][attr]])
-                        except KeyError:
-                            table[feature][attr] = (
-                                [a for a in record.attributes.get(attr, [])])
-    # Turn lists into strings
-    for feature in table.keys():
-        for attribute in additional_attributes:
-            try:
-                table[feature][attribute] = ";".join(table[feature][attribute])
-            except KeyError:
-                pass
+    attributes = read_additional_attributes(
+        gtf, feature_attribute, additional_attributes,
+        table.keys() if features is None else features,
+        cache_dir, cache_size, feature_types, early_exit)
+    if isinstance(table, MergedTable):
+        for attr in additional_attributes:
+            values = {feature: feature_values[attr]
+                      for feature, feature_values in attributes.items()}
+            if features is None or attr not in table.columns:
+                table.add_values(attr, values)
+            else:
+                table.update_values(attr, values)
+    else:
+        for feature, values in attributes.items():
+            table[feature].update(values)
     return table
 
 
 def main():
-    args = parse_args()
+    if sys.argv[1:2] == ["combine"]:
+        combine(parse_combine_args(sys.argv[2:]))
+        return
+    if sys.argv[1:2] == ["partial"]:
+        args = parse_args(sys.argv[2:], partial=True)
+    else:
+        args = parse_args()
     if args.names is None:
         names = [path.name for path in args.table]
     elif len(args.names) == len(args.table):
@@ -136,46 +699,403 @@ def main():
         raise ValueError(
             "The number of names did not match the number of inputs.")
 
-    merged_table = collect_columns(args.table, args.feature_column,
-                                   args.value_column, args.sep, names,
-                                   args.header, args.sum_on_duplicate_id)
+    stats = RunStats()
+    duplicates = []
+    selection = None
+    if args.features_file is not None:
+        selection = FeatureSelection.from_file(args.features_file,
+                                               args.feature_regex)
+    elif args.feature_regex is not None:
+        selection = FeatureSelection(pattern=args.feature_regex)
+    additional_attributes = args.additional_attributes or []
+    sorted_inputs = args.sorted_inputs or (
+        args.detect_sorted_inputs and args.output_format == "text" and
+        args.append_to is None and not derived_values(args) and
+        len(args.value_column) == 1 and not args.sparse and
+        args.sort in (None, "lexical") and
+        tables_are_sorted(args.table, args.feature_column, args.sep,
+                          args.header))
 
-    if args.additional_attributes is not None:
-        merged_table = add_additional_attributes(
-            merged_table, args.gtf, args.feature_attribute,
-            args.additional_attributes)
-        names = args.additional_attributes + names
+    if sorted_inputs:
+        rows = stream_sorted_tables(args.table, args.feature_column,
+                                    args.value_column[0], args.sep, names,
+                                    args.header, args.sum_on_duplicate_id,
+                                    args.on_duplicate, duplicates, selection,
+                                    args.value_type, stats)
+        if additional_attributes:
+            with stats.stage("annotate"):
+                attributes = read_additional_attributes(
+                    args.gtf, args.feature_attribute, additional_attributes,
+                    cache_dir=args.gtf_cache,
+                    cache_size=args.gtf_cache_size,
+                    feature_types=args.feature_type)
+            rows = ([row[0]] + [attributes.get(row[0], {}).get(attr)
+                                for attr in additional_attributes] +
+                    row[1:] for row in rows)
+        # The tables are read while the output is written.
+        with stats.stage("merge_and_write"):
+            write_text(args.output,
+                       ["feature"] + additional_attributes + names, rows,
+                       args.sep)
+    else:
+        merged_table = None
+        new_features = None
+        if args.append_to is not None:
+            with stats.stage("read_existing"):
+                merged_table, existing_attributes, existing_names = (
+                    read_merged_table(args.append_to, args.sep,
+                                      additional_attributes))
+                if args.value_type is None:
+                    args.value_type = append_value_type(
+                        merged_table, existing_names, args)
+                if (args.value_type in VALUE_TYPECODES or
+                        derived_values(args) or args.sparse or
+                        args.output_format == "mtx"):
+                    # Text tables are read back as strings.
+                    for name in existing_names:
+                        merged_table.convert_to_numeric(
+                            name, VALUE_TYPECODES.get(args.value_type, "d"))
+            existing_size = len(merged_table)
+        with stats.stage("merge"):
+            merged_table = merge_tables(
+                args.table, args.feature_column, args.value_column, args.sep,
+                names, args.header, args.sum_on_duplicate_id, args.threads,
+                merged_table, args.parse_cache, args.parse_cache_size, stats,
+                args.on_duplicate, args.value_type, selection, args.prefetch,
+                args.sparse)
+        duplicates = merged_table.duplicates
+        column_names = value_column_names(names, args.value_column)
+        if additional_attributes:
+            if args.append_to is not None and all(
+                    attr in existing_attributes
+                    for attr in additional_attributes):
+                # Only the features added by the new tables need to be
+                # looked up, the others were annotated when the table was
+                # created.
+                new_features = merged_table.features[existing_size:]
+            with stats.stage("annotate"):
+                merged_table = add_additional_attributes(
+                    merged_table, args.gtf, args.feature_attribute,
+                    additional_attributes, args.gtf_cache,
+                    args.gtf_cache_size, args.feature_type, args.early_exit,
+                    new_features)
+        if args.append_to is not None:
+            additional_attributes = additional_attributes + [
+                attr for attr in existing_attributes
+                if attr not in additional_attributes]
+            column_names = existing_names + column_names
+        if derived_values(args):
+            with stats.stage("derive"):
+                merged_table = derive_values(merged_table, column_names,
+                                             args)
+        if args.sort is not None:
+            with stats.stage("sort"):
+                feature_order = None
+                if args.sort == "gtf-order":
+                    feature_order = read_feature_order(
+                        args.gtf, args.feature_attribute,
+                        merged_table.keys(), args.feature_type)
+                merged_table = sort_table(merged_table, args.sort,
+                                          feature_order)
+        outputs = [(args.output, merged_table, column_names)]
+        if args.separate_outputs and len(args.value_column) > 1:
+            # One output per value column, with the sample names as
+            # headers.
+            outputs = []
+            for j, value_column in enumerate(args.value_column):
+                renamed = dict(zip(
+                    names, column_names[j * len(names):(j + 1) * len(names)]))
+                renamed.update((attr, attr) for attr in additional_attributes)
+                outputs.append((column_output_path(args.output, value_column),
+                                merged_table.view(renamed), names))
+        with stats.stage("write"):
+            for output, table, output_names in outputs:
+                if args.output_format == "text":
+                    # Compression releases the GIL, so it can overlap with
+                    # formatting the next rows.
+                    write_merged_text(
+                        output, table, additional_attributes, output_names,
+                        args.sep,
+                        background=output.suffix in COMPRESSED_EXTENSIONS)
+                else:
+                    write_table(table, output, additional_attributes,
+                                output_names, args.output_format)
 
-    with args.output.open("w", newline="") as output_file:
-        writer = csv.writer(output_file, delimiter=args.sep)
-        writer.writerow(["feature"] + names)
-        for feature, values in merged_table.items():
-            row = [feature] + [values.get(column_name)
-                               for column_name in names]
-            writer.writerow(row)
+    if args.duplicates_file is not None:
+        write_text(args.duplicates_file, ["column", "feature", "records"],
+                   duplicates, "\t")
+    if args.profile is not None:
+        stats.write(args.profile)
+    if args.verbose_stats:
+        stats.write(sys.stderr)
 
 
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="Retrieves a column from a set of tables and puts "
-                    "them into a single table.\n"
-                    "Optionally, additional attributes may be retrieved from "
-                    "a GTF or GFF file, which will be added as additional "
-                    "column in the merged table as well.")
+def column_output_path(output: Path, value_column: Union[int, str]
+                       ) -> Path:
+    """
+    The path of the output for one value column: the value column is
+    inserted before the extensions of the output path, so 'merged.tsv.gz'
+    becomes 'merged.TPM.tsv.gz'.
+    """
+    stem, dot, extensions = output.name.partition(".")
+    return output.with_name("{}.{}{}{}".format(stem, value_column, dot,
+                                               extensions))
+
+
+def parse_column(value: str) -> Union[int, str]:
+    """Parse a column given on the command line as a position or name."""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def combine(args: argparse.Namespace):
+    """
+    Combine the shards written by `collect-columns partial` into a single
+    delimited table, in one pass over the shards. The output is the same
+    as that of a single run over all tables, if the shards were made from
+    consecutive subsets of the tables and are given in the same order.
+    """
+    additional_attributes = args.additional_attributes or []
+    with ExitStack() as stack:
+        shards = [stack.enter_context(Shard(path)) for path in args.shard]
+        names = [name for shard in shards for name in shard.column_names]
+        repeated = sorted(set(name for name in names
+                              if names.count(name) > 1))
+        if repeated:
+            raise ValueError("Multiple shards have columns named: "
+                             "{}.".format(", ".join(repeated)))
+        features = combined_features(shards)
+        if additional_attributes:
+            attributes = read_additional_attributes(
+                args.gtf, args.feature_attribute, additional_attributes,
+                features, args.gtf_cache, args.gtf_cache_size,
+                args.feature_type, args.early_exit)
+        if args.sort is not None:
+            feature_order = None
+            if args.sort == "gtf-order":
+                feature_order = read_feature_order(
+                    args.gtf, args.feature_attribute, features,
+                    args.feature_type)
+            features = [features[i] for i in sort_order(
+                features, args.sort, feature_order)]
+        rows = combine_shards(shards, features)
+        if additional_attributes:
+            rows = ([row[0]] + [attributes.get(row[0], {}).get(attr)
+                                for attr in additional_attributes] +
+                    row[1:] for row in rows)
+        write_text(args.output, ["feature"] + additional_attributes + names,
+                   rows, args.sep)
+
+
+def column_value_type(table: MergedTable, names: List[str]
+                      ) -> Optional[str]:
+    """
+    Return the value type of the given columns of a table: 'string' if any
+    of them stores strings, 'int' if they all store integers, otherwise
+    'float'. Returns None if the table has none of the columns.
+    """
+    columns = [table.columns[name] for name in names
+               if name in table.columns]
+    if not columns:
+        return None
+    if any(isinstance(column, StringColumn) for column in columns):
+        return "string"
+    if all(column.values.typecode == "q" for column in columns):
+        return "int"
+    return "float"
+
+
+def append_value_type(table: MergedTable, names: List[str],
+                      args: argparse.Namespace) -> Optional[str]:
+    """
+    Return the value type for the columns appended to an existing table if
+    none was given, so the new columns get the type of the existing ones.
+    Tables read from delimited text do not store types, their values are
+    read back as strings. These become floats if the output stores typed
+    columns, like the default for new binary outputs.
+    :param table: The existing table.
+    :param names: The names of the existing value columns.
+    :param args: The parsed command line arguments.
+    """
+    value_type = None
+    if output_format(args.append_to) != "text":
+        value_type = column_value_type(table, names)
+    numeric_policy = (args.sum_on_duplicate_id or
+                      args.on_duplicate in NUMERIC_POLICIES)
+    if value_type == "string" and numeric_policy:
+        # The new values are added up or averaged, merge_tables picks the
+        # type.
+        return None
+    if value_type is None and args.output_format in TYPED_FORMATS:
+        return "float"
+    return value_type
+
+
+def derived_values(args: argparse.Namespace) -> bool:
+    """Whether or not totals, filters or normalization were requested."""
+    return (args.totals is not None or args.min_count is not None or
+            args.normalize is not None)
+
+
+def derive_values(table: MergedTable, column_names: List[str],
+                  args: argparse.Namespace) -> MergedTable:
+    """
+    Write the totals of the value columns, filter the rows and normalize
+    the values as requested on the command line. The totals, filters and
+    normalization use the values before normalization. Returns the
+    filtered table.
+    """
+    if args.totals is not None:
+        write_text(args.totals, ["column", "total"],
+                   zip(column_names, table.totals(column_names)), "\t")
+    rows = None
+    if args.min_count is not None:
+        rows = table.filter_rows(column_names, args.min_count,
+                                 args.min_samples)
+    if args.normalize is not None:
+        lengths = None
+        if args.normalize == "tpm":
+            lengths = read_feature_lengths(args.table, args.feature_column,
+                                           args.length_column, args.sep,
+                                           args.header)
+        table.normalize(column_names, args.normalize, lengths)
+    if rows is not None:
+        table = table.select_rows(rows)
+    return table
+
+
+def natural_key(feature: str) -> list:
+    """
+    Sort key which orders the numbers in feature ids by value, so that
+    'gene2' comes before 'gene10'.
+    """
+    return [int(part) if i % 2 else part
+            for i, part in enumerate(_DIGITS.split(feature))]
+
+
+def sort_table(table: MergedTable, method: str,
+               feature_order: Optional[Dict[str, int]] = None
+               ) -> MergedTable:
+    """
+    Return a copy of the table with its rows sorted. Only the row numbers
+    are sorted, the values are copied once in the new order.
+    :param table: The merged table.
+    :param method: 'lexical' to sort by feature id, 'natural' to sort the
+    numbers in feature ids by value or 'gtf-order' to sort by
+    feature_order. Features without a position in feature_order come
+    last, in the order they were encountered.
+    :param feature_order: The position of each feature, for example in a
+    GTF/GFF file as returned by read_feature_order.
+    """
+    return table.select_rows(sort_order(table.features, method,
+                                        feature_order))
+
+
+def sort_order(features: List[str], method: str,
+               feature_order: Optional[Dict[str, int]] = None
+               ) -> List[int]:
+    """
+    Return the positions of the features in sorted order. Takes the same
+    arguments as sort_table.
+    """
+    if method == "lexical":
+        key = features.__getitem__
+    elif method == "natural":
+        def key(row):
+            return natural_key(features[row])
+    elif method == "gtf-order":
+        last = len(feature_order)
+
+        def key(row):
+            return feature_order.get(features[row], last)
+    else:
+        raise ValueError("Unknown sort method: {}".format(method))
+    return sorted(range(len(features)), key=key)
+
+
+def check_outputs(parser: argparse.ArgumentParser,
+                  outputs: List[Optional[Path]]):
+    """
+    Stop with an error if an output can not be compressed as its file name
+    asks, rather than after the tables have been merged.
+    """
+    for output in outputs:
+        if output is not None:
+            error = output_compression_error(output)
+            if error is not None:
+                parser.error("{}: {}".format(output, error))
+
+
+def parse_args(argv: Optional[List[str]] = None, partial: bool = False):
+    if partial:
+        parser = argparse.ArgumentParser(
+            prog="collect-columns partial",
+            description="Merges a subset of the tables into a native "
+                        "shard, to be combined with the shards of the "
+                        "other tables by 'collect-columns combine'.")
+    else:
+        parser = argparse.ArgumentParser(
+            description="Retrieves a column from a set of tables and puts "
+                        "them into a single table.\n"
+                        "Optionally, additional attributes may be retrieved "
+                        "from a GTF or GFF file, which will be added as "
+                        "additional column in the merged table as well.\n"
+                        "Large sets of tables can be merged in parts with "
+                        "'collect-columns partial' and 'collect-columns "
+                        "combine', see their --help.")
     # positional
     parser.add_argument("output", type=Path,
-                        help="The path the output will be written to.")
+                        help="The path the output will be written to. The "
+                             "output is compressed if the path ends with "
+                             "'.gz', '.bgz' or '.zst'.")
     parser.add_argument("table", type=Path, nargs="+",
-                        help="The tables to be merged.")
+                        help="The tables to be merged. These may be gzip, "
+                             "bgzip or zstd compressed.")
     # optional
+    parser.add_argument("--output-format", choices=FORMATS,
+                        help="The format of the output. 'text' is a "
+                             "delimited table, 'native' a typed, columnar "
+                             "binary file which collect-columns can read "
+                             "back, 'parquet' and 'feather' require "
+                             "pyarrow, 'mtx' a Matrix Market file with the "
+                             "non-zero values and two files with the "
+                             "feature ids and column names. By default the "
+                             "format is based on the extension of the "
+                             "output path: '.ccm' for native, '.parquet' "
+                             "for parquet, '.feather' or '.arrow' for "
+                             "feather, '.mtx' (optionally compressed) for "
+                             "mtx and text otherwise.")
+    parser.add_argument("--append-to", type=Path, metavar="FILE",
+                        help="A merged table produced by an earlier run, "
+                             "either a native file or text with the same "
+                             "separator. The columns of the given tables "
+                             "are added to it, new features will have no "
+                             "value for the existing columns. Existing "
+                             "annotation columns are kept as is and are "
+                             "only looked up for new features when given "
+                             "with -a again. The result is written to the "
+                             "output path, which may be the same file.")
     parser.add_argument("-f", "--feature-column", type=int, default=0,
                         metavar="I",
                         help="The position of the column with the "
                              "(unique) feature ids. Default to 0.")
-    parser.add_argument("-c", "--value-column", type=int, default=1,
-                        metavar="I",
+    parser.add_argument("-c", "--value-column", type=parse_column, nargs="+",
+                        default=[1], metavar="COLUMN",
                         help="The position of the column with the "
-                             "values of interest. Defaults to 1.")
+                             "values of interest, or its name in the "
+                             "header (requires -H). Several columns may be "
+                             "given, these are all read in a single pass "
+                             "over each table and the merged columns are "
+                             "named '<column>_<name>', unless "
+                             "--separate-outputs is set. Defaults to 1.")
+    parser.add_argument("--separate-outputs", action="store_true",
+                        help="With multiple value columns, write one "
+                             "output per value column instead of a single "
+                             "wide table. The value column is inserted "
+                             "before the extension of the output path, for "
+                             "example 'merged.TPM.tsv'.")
     parser.add_argument("-s", "--sep", "--separator", type=str, default="\t",
                         help="The separator used in the tables. This "
                              "will also be used in the output table. "
@@ -195,6 +1115,117 @@ def parse_args():
                              "The values will become floats if this flag is "
                              "set. By default only the last value will be "
                              "taken and a warning will be give.")
+    parser.add_argument("--features-file", type=Path, metavar="FILE",
+                        help="A file with one feature id per line. Only "
+                             "these features are read from the tables.")
+    parser.add_argument("--feature-regex", type=str, metavar="REGEX",
+                        help="A regular expression. Only features whose "
+                             "id contains a match are read from the "
+                             "tables. If given with --features-file, "
+                             "features should meet both.")
+    parser.add_argument("--on-duplicate", choices=DUPLICATE_POLICIES,
+                        help="What to do if multiple rows exist with the "
+                             "same feature id: keep the last or first value, "
+                             "add up the values, take the maximum or mean "
+                             "(the values will become floats) or stop with "
+                             "an error. Features which occur multiple times "
+                             "are reported in one warning per table. "
+                             "Defaults to 'sum' if -S is set, otherwise to "
+                             "'last'.")
+    parser.add_argument("--duplicates-file", type=Path, metavar="FILE",
+                        help="Write the features which occur multiple "
+                             "times in a table to this file, as tab "
+                             "separated column name, feature id and number "
+                             "of rows.")
+    parser.add_argument("--value-type", choices=["string", "int", "float"],
+                        help="The type of the values. Integers and floats "
+                             "are stored as 64 bit numbers. Defaults to "
+                             "'float' if the values of duplicate feature "
+                             "ids are added up or averaged (see -S and "
+                             "--on-duplicate) or if the output is native, "
+                             "parquet or feather, otherwise to 'string'. "
+                             "With --append-to the new columns get the "
+                             "type of the existing ones.")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Only store the non-zero values, so memory "
+                             "use scales with the number of non-zero "
+                             "values. Missing values are considered zero "
+                             "and are written as 0 in text output. "
+                             "Requires numeric values.")
+    parser.add_argument("--totals", type=Path, metavar="FILE",
+                        help="Write the sum of each column to this file. "
+                             "Requires numeric values.")
+    parser.add_argument("--min-count", type=float, metavar="N",
+                        help="Only output features with a value of at "
+                             "least N in at least --min-samples columns. "
+                             "Requires numeric values.")
+    parser.add_argument("--min-samples", type=int, default=1, metavar="M",
+                        help="See --min-count. Defaults to 1.")
+    parser.add_argument("--normalize", choices=["cpm", "tpm"],
+                        help="Output counts per million or transcripts "
+                             "per million instead of the values. Totals "
+                             "and filters use the values before "
+                             "normalization. 'tpm' requires "
+                             "--length-column. Requires numeric values.")
+    parser.add_argument("--length-column", type=int, metavar="I",
+                        help="The position of the column with the lengths "
+                             "of the features, used for --normalize tpm. "
+                             "The tables will be read a second time.")
+    parser.add_argument("-j", "--threads", type=int, default=1, metavar="N",
+                        help="The number of processes used to parse the "
+                             "tables. Defaults to 1.")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N",
+                        help="Read the next N tables, in as many threads, "
+                             "while a table is parsed. This hides the "
+                             "latency of opening and reading files on "
+                             "network file systems. The tables are still "
+                             "merged in order. Only used when the tables "
+                             "are parsed in a single process and not with "
+                             "--sorted-inputs. Defaults to 0.")
+    parser.add_argument("--parse-cache", type=Path, metavar="DIR",
+                        help="A directory in which the parsed tables will "
+                             "be stored. Later runs reuse them for tables "
+                             "with the same contents, parsed with the same "
+                             "-f, -c, -s, -H and -S options. Not used with "
+                             "--sorted-inputs.")
+    parser.add_argument("--parse-cache-size", type=int, metavar="MB",
+                        default=DEFAULT_CACHE_SIZE,
+                        help="The maximum size of the --parse-cache "
+                             "directory in megabytes. The least recently "
+                             "used tables are removed when it grows "
+                             "larger. Defaults to {}.".format(
+                                 DEFAULT_CACHE_SIZE))
+    parser.add_argument("--sort", choices=["lexical", "natural",
+                                           "gtf-order"],
+                        help="Sort the output by feature id ('lexical'), "
+                             "by feature id with numbers compared by value "
+                             "('natural', so 'gene2' comes before "
+                             "'gene10') or in the order of the features in "
+                             "the GTF/GFF file given with -g "
+                             "('gtf-order'). By default the features are "
+                             "written in the order they are encountered "
+                             "in the tables.")
+    parser.add_argument("--sorted-inputs", action="store_true",
+                        help="Indicates that all tables are sorted by "
+                             "feature id. The tables will be merged while "
+                             "they are read, without keeping the merged "
+                             "table in memory. The output will be sorted by "
+                             "feature id. An error is raised if a table "
+                             "turns out not to be sorted.")
+    parser.add_argument("--detect-sorted-inputs", action="store_true",
+                        help="Check whether all tables are sorted by "
+                             "feature id and, if so, merge them as with "
+                             "--sorted-inputs. This requires reading the "
+                             "tables twice.")
+    parser.add_argument("--profile", type=Path, metavar="FILE",
+                        help="Write statistics on the run to this file as "
+                             "JSON: the wall time and peak memory use of "
+                             "each stage and the size, number of records "
+                             "and number of duplicate feature ids of each "
+                             "table.")
+    parser.add_argument("--verbose-stats", action="store_true",
+                        help="Print the statistics described for --profile "
+                             "to stderr.")
     parser.add_argument("-a", "--additional-attributes", type=str, nargs="+",
                         metavar="ATTR",
                         help="A list of attributes which will be added "
@@ -207,17 +1238,179 @@ def parse_args():
                         help="The GTF or GFF file from which the "
                              "additional attributes (see -a) will be "
                              "retrieved. Ignored if -a is not specified. "
-                             "Required if -a is specified.")
+                             "Required if -a is specified. May be gzip, "
+                             "bgzip or zstd compressed.")
     parser.add_argument("-F", "--feature-attribute", type=str, metavar="ATTR",
                         default="gene_id",
                         help="The attribute from the GTF/GFF used for "
                              "matching the feature records with the rows in "
                              "the table. Ignored if -a is not "
                              "specified. Defaults to 'gene_id'.")
-    args = parser.parse_args()
+    parser.add_argument("-t", "--feature-type", type=str, nargs="+",
+                        metavar="TYPE",
+                        help="Only use GTF/GFF records with one of these "
+                             "feature types (third column), for example "
+                             "'gene'. By default all records are used.")
+    parser.add_argument("--early-exit", action="store_true",
+                        help="Stop reading the GTF/GFF as soon as a record "
+                             "has been found for every feature in the "
+                             "merged table. Later records for the same "
+                             "features are ignored, so this is meant to be "
+                             "used with -t for feature types which have a "
+                             "single record per feature. Ignored with "
+                             "--sorted-inputs and --gtf-cache.")
+    parser.add_argument("--gtf-cache", type=Path, metavar="DIR",
+                        help="A directory in which an index of the GTF or "
+                             "GFF file will be stored. Later runs with the "
+                             "same (unchanged) file and -F attribute will "
+                             "use this index instead of reading the whole "
+                             "file.")
+    parser.add_argument("--gtf-cache-size", type=int, metavar="MB",
+                        default=DEFAULT_CACHE_SIZE,
+                        help="The maximum size of the --gtf-cache "
+                             "directory in megabytes. The least recently "
+                             "used indices are removed when it grows "
+                             "larger. Defaults to {}.".format(
+                                 DEFAULT_CACHE_SIZE))
+    args = parser.parse_args(argv)
+    if partial:
+        unsupported = [
+            ("-a", args.additional_attributes is not None),
+            ("--totals, --min-count and --normalize", derived_values(args)),
+            ("--sort", args.sort is not None),
+            ("--sorted-inputs", args.sorted_inputs),
+            ("--detect-sorted-inputs", args.detect_sorted_inputs),
+            ("--append-to", args.append_to is not None),
+            ("--separate-outputs", args.separate_outputs),
+            ("--output-format " + str(args.output_format),
+             args.output_format not in (None, "native"))]
+        for option, given in unsupported:
+            if given:
+                parser.error("{} cannot be used with partial".format(
+                    option))
+        args.output_format = "native"
+    if args.additional_attributes is not None and args.gtf is None:
+        parser.error("the following argument is required if -a is "
+                     "specified: -g")
+    if (args.sum_on_duplicate_id and args.on_duplicate is not None and
+            args.on_duplicate != "sum"):
+        parser.error("-S cannot be combined with --on-duplicate {}".format(
+            args.on_duplicate))
+    numeric_policy = (args.sum_on_duplicate_id or
+                      args.on_duplicate in NUMERIC_POLICIES)
+    if args.value_type == "string" and numeric_policy:
+        parser.error("string values cannot be added up or averaged")
+    if derived_values(args):
+        if args.value_type in (None, "string") and not numeric_policy:
+            parser.error("--totals, --min-count and --normalize require "
+                         "numeric values, see --value-type")
+        if args.sorted_inputs:
+            parser.error("--totals, --min-count and --normalize cannot be "
+                         "used with --sorted-inputs")
+    if args.sort == "gtf-order" and args.gtf is None:
+        parser.error("--sort gtf-order requires -g")
+    if args.sorted_inputs and args.sort not in (None, "lexical"):
+        parser.error("--sorted-inputs can only be used with --sort "
+                     "lexical")
+    if args.feature_regex is not None:
+        try:
+            re.compile(args.feature_regex)
+        except re.error as error:
+            parser.error("invalid --feature-regex: {}".format(error))
+    if not args.header and any(isinstance(value_column, str)
+                               for value_column in args.value_column):
+        parser.error("value columns can only be given by name with -H")
+    if len(set(args.value_column)) != len(args.value_column):
+        parser.error("each value column can only be given once")
+    if len(args.value_column) > 1:
+        if args.sorted_inputs:
+            parser.error("--sorted-inputs can only be used with a single "
+                         "value column")
+        if args.separate_outputs and args.append_to is not None:
+            parser.error("--separate-outputs cannot be used with "
+                         "--append-to")
+    if args.normalize == "tpm" and args.length_column is None:
+        parser.error("--normalize tpm requires --length-column")
+    if args.output_format is None:
+        args.output_format = output_format(args.output)
+    if args.sorted_inputs and args.output_format != "text":
+        parser.error("--sorted-inputs can only be used with text output")
+    if args.sorted_inputs and args.append_to is not None:
+        parser.error("--sorted-inputs cannot be used with --append-to")
+    if args.sparse or args.output_format == "mtx":
+        if args.value_type in (None, "string") and not numeric_policy:
+            parser.error("--sparse and mtx output require numeric values, "
+                         "see --value-type")
+        if args.sorted_inputs:
+            parser.error("--sparse cannot be used with --sorted-inputs")
+    check_outputs(parser, [args.output, args.totals, args.duplicates_file])
+    if (args.value_type is None and not partial and
+            args.append_to is None and args.output_format in TYPED_FORMATS):
+        # Binary outputs store typed columns, so readers do not have to
+        # parse the values again. Shards keep the values as they are, so
+        # combining them gives the same result as a single run. Appended
+        # columns get the type of the existing ones, see main.
+        args.value_type = "float"
+    return args
+
+
+def parse_combine_args(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="collect-columns combine",
+        description="Combines the native shards written by "
+                    "'collect-columns partial' into a single table. The "
+                    "shards are read in one pass, column by column, so "
+                    "only the feature ids are held in memory. The result "
+                    "is the same as that of a single run over all tables "
+                    "if the shards are given in the order of their tables.")
+    parser.add_argument("output", type=Path,
+                        help="The path the output will be written to. The "
+                             "output is compressed if the path ends with "
+                             "'.gz', '.bgz' or '.zst'.")
+    parser.add_argument("shard", type=Path, nargs="+",
+                        help="The shards to be combined.")
+    parser.add_argument("-s", "--sep", "--separator", type=str, default="\t",
+                        help="The separator used in the output table. "
+                             "Defaults to a tab.")
+    parser.add_argument("--sort", choices=["lexical", "natural",
+                                           "gtf-order"],
+                        help="Sort the output, see collect-columns --help.")
+    parser.add_argument("-a", "--additional-attributes", type=str, nargs="+",
+                        metavar="ATTR",
+                        help="A list of attributes which will be added "
+                             "to the combined table, see collect-columns "
+                             "--help. Requires -g to be specified.")
+    parser.add_argument("-g", "--gtf", "--gff", type=Path, metavar="FILE",
+                        help="The GTF or GFF file from which the "
+                             "additional attributes (see -a) will be "
+                             "retrieved.")
+    parser.add_argument("-F", "--feature-attribute", type=str, metavar="ATTR",
+                        default="gene_id",
+                        help="The attribute from the GTF/GFF used for "
+                             "matching the feature records with the rows in "
+                             "the table. Defaults to 'gene_id'.")
+    parser.add_argument("-t", "--feature-type", type=str, nargs="+",
+                        metavar="TYPE",
+                        help="Only use GTF/GFF records with one of these "
+                             "feature types.")
+    parser.add_argument("--early-exit", action="store_true",
+                        help="Stop reading the GTF/GFF as soon as a record "
+                             "has been found for every feature.")
+    parser.add_argument("--gtf-cache", type=Path, metavar="DIR",
+                        help="A directory in which an index of the GTF or "
+                             "GFF file will be stored.")
+    parser.add_argument("--gtf-cache-size", type=int, metavar="MB",
+                        default=DEFAULT_CACHE_SIZE,
+                        help="The maximum size of the --gtf-cache "
+                             "directory in megabytes. Defaults to "
+                             "{}.".format(DEFAULT_CACHE_SIZE))
+    args = parser.parse_args(argv)
     if args.additional_attributes is not None and args.gtf is None:
         parser.error("the following argument is required if -a is "
                      "specified: -g")
+    if args.sort == "gtf-order" and args.gtf is None:
+        parser.error("--sort gtf-order requires -g")
+    check_outputs(parser, [args.output])
     return args
 
 
@@ -0,0 +1,311 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Transparent reading and writing of gzip, bgzip and zstd compressed files.
+
+Decompression runs outside of the thread doing the parsing, so the two
+overlap: in a pigz or zstd subprocess when one is available, otherwise in
+a background thread (zlib and zstandard release the GIL while working).
+"""
+
+import gzip
+import io
+import os
+import queue
+import shutil
+import stat
+import subprocess
+import threading
+from pathlib import Path
+from typing import BinaryIO, Optional, TextIO
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# The size of the chunks passed from the decompression thread.
+CHUNK_SIZE = 1024 * 1024
+# The number of decompressed chunks buffered ahead of the reader.
+MAX_CHUNKS = 8
+
+
+def compression_type(path: Path) -> Optional[str]:
+    """
+    Return 'gzip' or 'zstd' if a file is compressed with one of those
+    (bgzip files are gzip files), None otherwise. The type is determined
+    from the first bytes of the file, not from its extension.
+    """
+    with path.open("rb") as handle:
+        return data_compression_type(handle.read(4))
+
+
+def data_compression_type(data: bytes) -> Optional[str]:
+    """
+    Return the compression of data read from the start of a file, see
+    compression_type.
+    """
+    if data.startswith(GZIP_MAGIC):
+        return "gzip"
+    if data.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+class _ProcessReader(io.RawIOBase):
+    """Reads the output of a subprocess, checking its exit status."""
+    def __init__(self, args: list):
+        self.args = args
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.process.stdout.readinto(buffer)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        complete = self.process.stdout.read(1) == b""
+        self.process.stdout.close()
+        if not complete:
+            # Closed before reaching the end, stop the process.
+            self.process.terminate()
+            self.process.wait()
+        elif self.process.wait() != 0:
+            raise OSError("{} exited with status {}".format(
+                " ".join(self.args), self.process.returncode))
+
+
+class _ThreadedReader(io.RawIOBase):
+    """
+    Reads a binary stream in a background thread, keeping up to
+    MAX_CHUNKS chunks buffered ahead of the reader.
+    """
+    def __init__(self, raw: BinaryIO):
+        self.raw = raw
+        self.queue = queue.Queue(MAX_CHUNKS)
+        self.chunk = memoryview(b"")
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.stopped.is_set():
+                chunk = self.raw.read(CHUNK_SIZE)
+                self.queue.put(chunk)
+                if not chunk:
+                    break
+        except BaseException as error:
+            self.queue.put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk and not self.eof:
+            item = self.queue.get()
+            if isinstance(item, BaseException):
+                self.eof = True
+                raise item
+            self.chunk = memoryview(item)
+            self.eof = not item
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.stopped.set()
+        # Unblock the thread if it is waiting for room in the queue.
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.raw.close()
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def open_input_binary(path: Path) -> BinaryIO:
+    """
+    Open a file for reading in binary mode, decompressing it if it is
+    gzip, bgzip or zstd compressed. The file is only opened once, so
+    pipes such as process substitutions can be read as well.
+    """
+    handle = path.open("rb")
+    try:
+        # peek does not consume the bytes, which a pipe can not give back.
+        compression = data_compression_type(handle.peek(4)[:4])
+        regular = stat.S_ISREG(os.fstat(handle.fileno()).st_mode)
+        if compression == "gzip":
+            pigz = shutil.which("pigz")
+            if pigz is not None and regular:
+                handle.close()
+                return io.BufferedReader(
+                    _ProcessReader([pigz, "-dc", str(path)]))
+            return io.BufferedReader(_ThreadedReader(
+                gzip.GzipFile(fileobj=handle, mode="rb")))
+        if compression == "zstd":
+            zstandard = _zstandard()
+            if zstandard is not None:
+                return io.BufferedReader(_ThreadedReader(
+                    zstandard.ZstdDecompressor().stream_reader(
+                        handle, read_across_frames=True, closefd=True)))
+            zstd = shutil.which("zstd")
+            if zstd is not None and regular:
+                handle.close()
+                return io.BufferedReader(
+                    _ProcessReader([zstd, "-dcq", str(path)]))
+            if not regular:
+                raise ImportError("Reading zstd compressed pipes requires "
+                                  "the zstandard package.")
+            raise ImportError("Reading zstd compressed files requires "
+                              "either the zstandard package or the zstd "
+                              "executable.")
+    except BaseException:
+        handle.close()
+        raise
+    return handle
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Decompress the contents of a gzip, bgzip or zstd compressed file which
+    has been read into memory. Other data is returned as is.
+    """
+    compression = data_compression_type(data)
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        zstandard = _zstandard()
+        if zstandard is not None:
+            with zstandard.ZstdDecompressor().stream_reader(
+                    io.BytesIO(data), read_across_frames=True) as reader:
+                return reader.read()
+        zstd = shutil.which("zstd")
+        if zstd is not None:
+            return subprocess.run([zstd, "-dcq"], input=data,
+                                  stdout=subprocess.PIPE,
+                                  check=True).stdout
+        raise ImportError("Reading zstd compressed files requires either "
+                          "the zstandard package or the zstd executable.")
+    return data
+
+
+def open_input(path: Path) -> TextIO:
+    """
+    Open a file for reading in text mode, decompressing it if it is gzip,
+    bgzip or zstd compressed.
+    """
+    return io.TextIOWrapper(open_input_binary(path))
+
+
+class _ProcessWriter(io.RawIOBase):
+    """
+    Writes to the input of a subprocess whose output goes to a file,
+    checking its exit status.
+    """
+    def __init__(self, args: list, path: Path):
+        self.args = args
+        self.output = path.open("wb")
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                        stdout=self.output)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.process.stdin.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.process.stdin.close()
+        status = self.process.wait()
+        self.output.close()
+        if status != 0:
+            raise OSError("{} exited with status {}".format(
+                " ".join(self.args), status))
+
+
+def output_compression_error(path: Path) -> Optional[str]:
+    """
+    Return why the output can not be compressed as its file name asks,
+    or None if it can. This allows checking the outputs before any work
+    is done, open_output only fails once the output is written.
+    """
+    if path.suffix == ".bgz" and shutil.which("bgzip") is None:
+        return "writing bgzip compressed files requires the bgzip executable"
+    if (path.suffix == ".zst" and shutil.which("zstd") is None and
+            _zstandard() is None):
+        return ("writing zstd compressed files requires either the "
+                "zstandard package or the zstd executable")
+    return None
+
+
+def open_output(path: Path) -> TextIO:
+    """
+    Open a file for writing in text mode, as with open(path, "w",
+    newline=""). The output is compressed if the file name ends with
+    '.gz' or '.bgz' (gzip and bgzip respectively) or '.zst' (zstd).
+    """
+    suffix = path.suffix
+    if suffix == ".gz":
+        pigz = shutil.which("pigz")
+        if pigz is not None:
+            binary = io.BufferedWriter(_ProcessWriter([pigz, "-c"], path))
+        else:
+            binary = gzip.open(str(path), "wb")
+    elif suffix == ".bgz":
+        bgzip = shutil.which("bgzip")
+        if bgzip is None:
+            raise OSError("Writing bgzip compressed files requires the "
+                          "bgzip executable.")
+        binary = io.BufferedWriter(_ProcessWriter([bgzip, "-c"], path))
+    elif suffix == ".zst":
+        zstandard = _zstandard()
+        if zstandard is not None:
+            binary = zstandard.ZstdCompressor().stream_writer(
+                path.open("wb"), closefd=True)
+        else:
+            zstd = shutil.which("zstd")
+            if zstd is None:
+                raise ImportError(
+                    "Writing zstd compressed files requires either the "
+                    "zstandard package or the zstd executable.")
+            binary = io.BufferedWriter(_ProcessWriter([zstd, "-cq"], path))
+    else:
+        return path.open("w", newline="")
+    return io.TextIOWrapper(binary, newline="")
@@ -0,0 +1,590 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Output formats for the merged table.
+
+Besides delimited text, the merged table can be written as a typed,
+columnar binary file: Parquet or Feather (these require pyarrow) or the
+dependency free "collect-columns matrix" format (.ccm), which can also be
+read back with read_native. Numeric tables can also be written as sparse
+Matrix Market files.
+"""
+
+import csv
+import json
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import compress, repeat
+from operator import eq
+from pathlib import Path
+from typing import Iterable, Iterator, List, TextIO, Tuple
+
+from .compression import open_input, open_output
+from .merged_table import (MISSING, MergedTable, SparseColumn,
+                           StringColumn, StringPool, decode_strings,
+                           encode_strings)
+
+FORMATS = ["text", "native", "parquet", "feather", "mtx"]
+EXTENSIONS = {".ccm": "native", ".parquet": "parquet",
+              ".feather": "feather", ".arrow": "feather", ".mtx": "mtx"}
+# Extensions of compressed outputs, see open_output.
+COMPRESSED_EXTENSIONS = {".gz", ".bgz", ".zst"}
+# The number of rows formatted at a time by write_merged_text.
+BATCH_ROWS = 4096
+# The characters which occur in formatted numbers. Numbers only need to be
+# quoted if the separator is one of these.
+NUMBER_CHARACTERS = "0123456789.-+einfa"
+# The most formatted numbers write_merged_text remembers per value type.
+MAX_FORMATTED = 1 << 16
+# The bits of -0.0, as an integer.
+NEGATIVE_ZERO = array("q", array("d", [-0.0]).tobytes())[0]
+
+NATIVE_MAGIC = b"CCMATRIX"
+NATIVE_VERSION = 1
+# Blocks in native files start at a multiple of this many bytes, so that
+# they can be used in place when the file is memory mapped.
+ALIGNMENT = 8
+NUMERIC_TYPES = {"d": "float64", "q": "int64"}
+TYPECODES = {name: typecode for typecode, name in NUMERIC_TYPES.items()}
+
+
+def output_format(path: Path) -> str:
+    """
+    Determine the output format from the extension of a path. Matrix
+    Market files may be compressed.
+    """
+    if (path.suffix in COMPRESSED_EXTENSIONS and
+            path.with_suffix("").suffix == ".mtx"):
+        return "mtx"
+    return EXTENSIONS.get(path.suffix, "text")
+
+
+def write_text(output: Path, header: List[str], rows: Iterable[list],
+               sep: str):
+    """
+    Write the merged table as delimited text.
+    :param output: The path the table will be written to.
+    :param header: The column names.
+    :param rows: The rows of the table.
+    :param sep: The separator.
+    """
+    with open_output(output) as output_file:
+        writer = csv.writer(output_file, delimiter=sep)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def _quote(field: str, sep: str) -> str:
+    """Quote a field the way csv.writer does with the default dialect."""
+    if sep in field or '"' in field or "\r" in field or "\n" in field:
+        return '"{}"'.format(field.replace('"', '""'))
+    return field
+
+
+class _Formatted(dict):
+    """
+    The formatted strings of numbers, as csv.writer would write them.
+    Counts repeat a lot, so looking them up is much faster than formatting
+    each of them.
+    """
+    def __init__(self, sep: str):
+        super().__init__()
+        self.sep = sep
+        self.quote = sep in NUMBER_CHARACTERS
+
+    def format(self, value) -> str:
+        if self.quote:
+            return _quote(str(value), self.sep)
+        return str(value)
+
+    def __missing__(self, value) -> str:
+        if len(self) >= MAX_FORMATTED:
+            self.clear()
+        # -0.0 equals 0.0, so only the positive zero is cached and
+        # _text_cells formats negative zeros itself.
+        cell = self[value] = self.format(abs(value) if value == 0 else value)
+        return cell
+
+
+def _text_cells(column, start: int, stop: int, pool_cells: List[str],
+                formatted: _Formatted) -> List[str]:
+    """
+    Format the values of a column for the rows from start to stop, as
+    csv.writer would.
+    :param pool_cells: The formatted strings of the string pool, followed
+    by an empty string for missing values.
+    :param formatted: The formatted numbers for the value type of the
+    column.
+    """
+    size = stop - start
+    if column is None:
+        return [""] * size
+    if isinstance(column, StringColumn):
+        # MISSING is -1, which is the empty string at the end.
+        cells = list(map(pool_cells.__getitem__, column.codes[start:stop]))
+        cells.extend([""] * (size - len(cells)))
+        return cells
+    if isinstance(column, SparseColumn):
+        first = bisect_left(column.rows, start)
+        last = bisect_left(column.rows, stop)
+        zero = 0.0 if column.values.typecode == "d" else 0
+        cells = [formatted[zero]] * size
+        for row, value in zip(column.rows[first:last],
+                              column.values[first:last]):
+            cells[row - start] = formatted.format(value)
+        return cells
+    values = column.values[start:stop]
+    cells = list(map(formatted.__getitem__, values))
+    if values.typecode == "d":
+        # -0.0 equals 0.0, so it may have been looked up as 0.0.
+        bits = array("q", values.tobytes())
+        if NEGATIVE_ZERO in bits:
+            for i in compress(range(len(bits)),
+                              map(eq, bits, repeat(NEGATIVE_ZERO))):
+                cells[i] = formatted.format(values[i])
+    mask = column.mask[start:stop]
+    i = mask.find(0)
+    while i != -1:
+        cells[i] = ""
+        i = mask.find(0, i + 1)
+    cells.extend([""] * (size - len(cells)))
+    return cells
+
+
+def _write_batches(output_file: TextIO, batches: Iterable[str],
+                   background: bool):
+    """
+    Write batches of text to a file. In a background thread, if requested,
+    which formats the next batch while the current one is written.
+    """
+    if not background:
+        for batch in batches:
+            output_file.write(batch)
+        return
+    import queue
+    import threading
+    pending = queue.Queue(4)
+    errors = []
+
+    def write():
+        while True:
+            batch = pending.get()
+            if batch is None:
+                return
+            if not errors:
+                try:
+                    output_file.write(batch)
+                except BaseException as error:
+                    errors.append(error)
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    try:
+        for batch in batches:
+            if errors:
+                break
+            pending.put(batch)
+    finally:
+        pending.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def write_merged_text(output: Path, table: MergedTable,
+                      annotation_names: List[str], column_names: List[str],
+                      sep: str, background: bool = False):
+    """
+    Write the merged table as delimited text, with the same result as
+    write_text with the rows from table.iter_rows. The values are
+    formatted column by column, BATCH_ROWS rows at a time, and each batch
+    is written at once.
+    :param output: The path the table will be written to.
+    :param table: The merged table.
+    :param annotation_names: The names of the annotation columns.
+    :param column_names: The names of the value columns.
+    :param sep: The separator.
+    :param background: Write the batches in a background thread.
+    """
+    names = annotation_names + column_names
+    if not names:
+        # csv.writer quotes empty rows with a single field, keep that to
+        # csv.writer itself.
+        write_text(output, ["feature"], table.iter_rows([]), sep)
+        return
+    columns = [table.columns.get(name) for name in names]
+    pool_cells = [_quote(string, sep) for string in table.pool.strings]
+    pool_cells.append("")
+    # Integers and floats that are equal must be formatted separately.
+    formatted = {}
+    column_formats = [
+        formatted.setdefault(column.values.typecode, _Formatted(sep))
+        if column is not None and not isinstance(column, StringColumn)
+        else None
+        for column in columns]
+    special = {sep, '"', "\r", "\n"}
+
+    def batches() -> Iterator[str]:
+        for start in range(0, len(table), BATCH_ROWS):
+            stop = min(start + BATCH_ROWS, len(table))
+            features = table.features[start:stop]
+            if not special.isdisjoint("".join(features)):
+                features = [_quote(feature, sep) for feature in features]
+            cells = [features]
+            cells.extend(
+                _text_cells(column, start, stop, pool_cells, column_formatted)
+                for column, column_formatted in zip(columns, column_formats))
+            yield "\r\n".join(map(sep.join, zip(*cells))) + "\r\n"
+
+    with open_output(output) as output_file:
+        csv.writer(output_file, delimiter=sep).writerow(["feature"] + names)
+        _write_batches(output_file, batches(), background)
+
+
+def _padded(column, size: int):
+    """
+    Return the values (and, for numeric columns, the mask) of a column,
+    padded with missing values to the given number of rows.
+    """
+    if isinstance(column, SparseColumn):
+        column = column.to_dense(size)
+    if isinstance(column, StringColumn):
+        codes = array("i", column.codes)
+        codes.extend(array("i", [MISSING]) * (size - len(codes)))
+        return codes, None
+    values = array(column.values.typecode, column.values)
+    values.extend(array(values.typecode, [0]) * (size - len(values)))
+    return values, column.mask + bytes(size - len(column.mask))
+
+
+def write_native(table: MergedTable, output: Path,
+                 annotation_names: List[str], column_names: List[str]):
+    """
+    Write the merged table in the native binary format: a magic string,
+    the length of a JSON header and the header itself, followed by the
+    blocks it describes. Numeric columns are stored as arrays of 64 bit
+    numbers with a byte mask marking the cells with a value, string
+    columns as 32 bit codes into one list of strings. Strings are stored
+    as NUL separated UTF-8.
+    :param table: The merged table.
+    :param output: The path the table will be written to.
+    :param annotation_names: The names of the annotation columns, such as
+    the additional GTF/GFF attributes.
+    :param column_names: The names of the value columns.
+    """
+    size = len(table)
+    blocks = []
+
+    def add_block(data) -> dict:
+        offset = sum(len(block) for block in blocks)
+        blocks.append(data)
+        padding = -len(data) % ALIGNMENT
+        if padding:
+            blocks.append(bytes(padding))
+        return {"offset": offset, "length": len(data)}
+
+    features = add_block(encode_strings(table.features))
+    strings = add_block(encode_strings(table.pool.strings))
+    columns = []
+    for name in annotation_names + column_names:
+        column = table.columns.get(name)
+        if column is None:
+            column = StringColumn(table.pool)
+        values, mask = _padded(column, size)
+        description = {"name": name,
+                       "annotation": name in annotation_names,
+                       "values": add_block(values.tobytes())}
+        if mask is None:
+            description["type"] = "string"
+        else:
+            description["type"] = NUMERIC_TYPES[values.typecode]
+            description["mask"] = add_block(bytes(mask))
+        columns.append(description)
+    header = json.dumps({
+        "version": NATIVE_VERSION, "byteorder": sys.byteorder,
+        "rows": size, "features": features,
+        "strings": dict(strings, count=len(table.pool.strings)),
+        "columns": columns}).encode("utf-8")
+    header += b" " * (-(len(NATIVE_MAGIC) + 8 + len(header)) % ALIGNMENT)
+    with output.open("wb") as output_file:
+        output_file.write(NATIVE_MAGIC)
+        output_file.write(struct.pack("<Q", len(header)))
+        output_file.write(header)
+        for block in blocks:
+            output_file.write(block)
+
+
+def read_native_header(handle) -> Tuple[dict, int]:
+    """
+    Read the header of a native file. Returns the header and the offset
+    of the first block.
+    """
+    if handle.read(len(NATIVE_MAGIC)) != NATIVE_MAGIC:
+        raise ValueError("Not a collect-columns matrix file.")
+    length, = struct.unpack("<Q", handle.read(8))
+    header = json.loads(handle.read(length).decode("utf-8"))
+    if header["version"] > NATIVE_VERSION:
+        raise ValueError("Unsupported collect-columns matrix version: "
+                         "{}.".format(header["version"]))
+    return header, len(NATIVE_MAGIC) + 8 + length
+
+
+def read_native(path: Path) -> Tuple[MergedTable, List[str], List[str]]:
+    """
+    Read a file written by write_native. Returns the table, the names of
+    the annotation columns and the names of the value columns.
+    """
+    with path.open("rb") as handle:
+        header, start = read_native_header(handle)
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _read_native_blocks(header, memoryview(data)[start:])
+
+
+def _read_native_blocks(header: dict, data: memoryview
+                        ) -> Tuple[MergedTable, List[str], List[str]]:
+    def block(description: dict) -> memoryview:
+        offset = description["offset"]
+        return data[offset:offset + description["length"]]
+
+    def numbers(typecode: str, description: dict) -> array:
+        values = array(typecode)
+        values.frombytes(block(description))
+        if header["byteorder"] != sys.byteorder:
+            values.byteswap()
+        return values
+
+    table = MergedTable()
+    table.features = decode_strings(block(header["features"]),
+                                    header["rows"])
+    table.rows = {feature: row for row, feature in enumerate(table.features)}
+    table.pool = StringPool()
+    table.pool.strings = decode_strings(block(header["strings"]),
+                                        header["strings"]["count"])
+    table.pool.codes = {string: code
+                        for code, string in enumerate(table.pool.strings)}
+    annotation_names = []
+    column_names = []
+    for description in header["columns"]:
+        if description["type"] == "string":
+            column = table.new_string_column(description["name"])
+            column.codes = numbers("i", description["values"])
+        else:
+            column = table.new_numeric_column(
+                description["name"], TYPECODES[description["type"]])
+            column.values = numbers(column.values.typecode,
+                                    description["values"])
+            column.mask = bytearray(block(description["mask"]))
+        if description["annotation"]:
+            annotation_names.append(description["name"])
+        else:
+            column_names.append(description["name"])
+    data.release()
+    return table, annotation_names, column_names
+
+
+def read_text(path: Path, sep: str, annotation_names: List[str]
+              ) -> Tuple[MergedTable, List[str], List[str]]:
+    """
+    Read a merged table written as delimited text. The first column
+    should contain the features, empty cells are considered missing.
+    Returns the table, the names of the annotation columns and the names
+    of the value columns.
+    :param path: The path to the table.
+    :param sep: The separator used in the table.
+    :param annotation_names: The names of the columns which should be
+    considered annotation columns, rather than value columns.
+    """
+    table = MergedTable()
+    with open_input(path) as table_file:
+        reader = csv.reader(table_file, delimiter=sep)
+        header = next(reader)
+        columns = [table.new_string_column(name) for name in header[1:]]
+        for line in reader:
+            row = table.row(line[0])
+            for column, value in zip(columns, line[1:]):
+                if value != "":
+                    column.set(row, value)
+    names = header[1:]
+    return (table, [name for name in names if name in annotation_names],
+            [name for name in names if name not in annotation_names])
+
+
+def read_merged_table(path: Path, sep: str, annotation_names: List[str]
+                      ) -> Tuple[MergedTable, List[str], List[str]]:
+    """
+    Read a merged table from a native file or from delimited text.
+    Returns the table, the names of the annotation columns and the names
+    of the value columns.
+    :param path: The path to the table.
+    :param sep: The separator used if the table is delimited text.
+    :param annotation_names: The names of the columns which should be
+    considered annotation columns if the table is delimited text. Native
+    files store which columns are annotation columns.
+    """
+    with path.open("rb") as handle:
+        magic = handle.read(len(NATIVE_MAGIC))
+    if magic == NATIVE_MAGIC:
+        return read_native(path)
+    if output_format(path) != "text":
+        raise ValueError("Cannot read {}, only native and text tables can "
+                         "be read.".format(path))
+    return read_text(path, sep, annotation_names)
+
+
+def _arrow_column(column, size: int):
+    """Convert a column to a pyarrow array."""
+    import pyarrow
+    import pyarrow.compute
+    values, mask = _padded(column, size)
+    if mask is None:
+        codes = pyarrow.py_buffer(values)
+        valid = pyarrow.compute.not_equal(
+            pyarrow.Array.from_buffers(pyarrow.int32(), size, [None, codes]),
+            MISSING)
+        indices = pyarrow.Array.from_buffers(
+            pyarrow.int32(), size, [valid.buffers()[1], codes])
+        dictionary = pyarrow.array(column.pool.strings, pyarrow.string())
+        return pyarrow.DictionaryArray.from_arrays(
+            indices, dictionary).dictionary_decode()
+    valid = pyarrow.compute.not_equal(
+        pyarrow.Array.from_buffers(pyarrow.uint8(), size,
+                                   [None, pyarrow.py_buffer(mask)]), 0)
+    arrow_type = (pyarrow.float64() if values.typecode == "d"
+                  else pyarrow.int64())
+    return pyarrow.Array.from_buffers(
+        arrow_type, size, [valid.buffers()[1], pyarrow.py_buffer(values)])
+
+
+def write_arrow(table: MergedTable, output: Path,
+                annotation_names: List[str], column_names: List[str],
+                output_format: str):
+    """
+    Write the merged table as a Parquet or Feather file. Requires pyarrow
+    to be installed.
+    :param table: The merged table.
+    :param output: The path the table will be written to.
+    :param annotation_names: The names of the annotation columns.
+    :param column_names: The names of the value columns.
+    :param output_format: Either 'parquet' or 'feather'.
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Writing {} files requires pyarrow to be "
+                          "installed.".format(output_format))
+    size = len(table)
+    names = annotation_names + column_names
+    arrays = [pyarrow.array(table.features, pyarrow.string())]
+    for name in names:
+        column = table.columns.get(name)
+        if column is None:
+            arrays.append(pyarrow.nulls(size, pyarrow.string()))
+        else:
+            arrays.append(_arrow_column(column, size))
+    arrow_table = pyarrow.Table.from_arrays(arrays, ["feature"] + names)
+    if output_format == "parquet":
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(arrow_table, str(output))
+    else:
+        import pyarrow.feather
+        pyarrow.feather.write_feather(arrow_table, str(output))
+
+
+def matrix_market_label_paths(output: Path) -> Tuple[Path, Path]:
+    """
+    Return the paths of the files with the row and column labels of a
+    Matrix Market file: 'counts.mtx.gz' has its labels in
+    'counts.features.tsv' and 'counts.samples.tsv'.
+    """
+    name = output.name
+    for extension in sorted(COMPRESSED_EXTENSIONS) + [".mtx"]:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return (output.with_name(name + ".features.tsv"),
+            output.with_name(name + ".samples.tsv"))
+
+
+def _nonzero(column) -> Iterator[Tuple[int, object]]:
+    """Yield the (row, value) pairs of the non-zero values in a column."""
+    if isinstance(column, SparseColumn):
+        return zip(column.rows, column.values)
+    return ((row, value) for row, (value, present)
+            in enumerate(zip(column.values, column.mask))
+            if present and value)
+
+
+def write_matrix_market(table: MergedTable, output: Path,
+                        annotation_names: List[str],
+                        column_names: List[str]):
+    """
+    Write the value columns of a merged table as a Matrix Market
+    coordinate file, with one entry per non-zero value. Missing values
+    are left out, like zeros. The features, followed by their
+    annotations, and the column names are written to the label files
+    returned by matrix_market_label_paths, one per line. The value columns
+    should be numeric.
+    :param table: The merged table.
+    :param output: The path the matrix will be written to.
+    :param annotation_names: The names of the annotation columns.
+    :param column_names: The names of the value columns.
+    """
+    columns = [table.numeric_column(name) for name in column_names]
+    field = ("integer" if all(column.values.typecode == "q"
+                              for column in columns) else "real")
+    entries = sum(sum(1 for _ in _nonzero(column)) for column in columns)
+    with open_output(output) as output_file:
+        output_file.write("%%MatrixMarket matrix coordinate {} general\n"
+                          "{} {} {}\n".format(field, len(table),
+                                              len(columns), entries))
+        for i, column in enumerate(columns, 1):
+            output_file.writelines("{} {} {}\n".format(row + 1, i, value)
+                                   for row, value in _nonzero(column))
+    features_path, samples_path = matrix_market_label_paths(output)
+    with open_output(features_path) as features_file:
+        writer = csv.writer(features_file, delimiter="\t")
+        writer.writerows(table.iter_rows(annotation_names))
+    with open_output(samples_path) as samples_file:
+        samples_file.writelines(name + "\n" for name in column_names)
+
+
+def write_table(table: MergedTable, output: Path,
+                annotation_names: List[str], column_names: List[str],
+                output_format: str):
+    """
+    Write the merged table in one of the formats other than text.
+    :param table: The merged table.
+    :param output: The path the table will be written to.
+    :param annotation_names: The names of the annotation columns.
+    :param column_names: The names of the value columns.
+    :param output_format: 'native', 'parquet', 'feather' or 'mtx'.
+    """
+    if output_format == "native":
+        write_native(table, output, annotation_names, column_names)
+    elif output_format == "mtx":
+        write_matrix_market(table, output, annotation_names, column_names)
+    elif output_format in ("parquet", "feather"):
+        write_arrow(table, output, annotation_names, column_names,
+                    output_format)
+    else:
+        raise ValueError("Unknown output format: {}".format(output_format))
@@ -0,0 +1,754 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import compress, repeat
+from operator import truediv
+from typing import (AnyStr, Dict, Iterable, Iterator, List, Optional,
+                    Tuple, Union)
+from warnings import warn
+
+# Code used in string columns for cells without a value.
+MISSING = -1
+# Version of the serialized ParsedTable format, see ParsedTable.to_bytes.
+PARSED_TABLE_VERSION = 3
+# What to do with the values of features which occur multiple times in a
+# table: keep the last or first value, reduce them to one number or raise
+# an error.
+DUPLICATE_POLICIES = ["last", "first", "sum", "max", "mean", "error"]
+NUMERIC_POLICIES = {"sum", "max", "mean"}
+# The number of duplicate features named in a warning.
+REPORTED_DUPLICATES = 5
+
+
+def duplicate_policy(sum_on_duplicate_id: bool,
+                     on_duplicate: Optional[str] = None) -> str:
+    """
+    Return the duplicate policy to use: on_duplicate if given, otherwise
+    'sum' if sum_on_duplicate_id is set and 'last' if not.
+    """
+    if on_duplicate is not None:
+        if on_duplicate not in DUPLICATE_POLICIES:
+            raise ValueError("Unknown duplicate policy: {}".format(
+                on_duplicate))
+        return on_duplicate
+    return "sum" if sum_on_duplicate_id else "last"
+
+
+def report_duplicates(column_name: str, duplicates: List[Tuple[str, int]],
+                      policy: str):
+    """
+    Report the duplicate features of a table in one message: a warning
+    if only the last or first value is kept, a ValueError for the 'error'
+    policy. Reducing the values to one number is not reported.
+    :param column_name: The name of the table's column.
+    :param duplicates: (feature, number of records) pairs.
+    :param policy: The duplicate policy.
+    """
+    if not duplicates or policy in NUMERIC_POLICIES:
+        return
+    features = ", ".join(feature for feature, _ in
+                         duplicates[:REPORTED_DUPLICATES])
+    if len(duplicates) > REPORTED_DUPLICATES:
+        features += ", ..."
+    message = "duplicate values for {} row{} in {}".format(
+        len(duplicates), "" if len(duplicates) == 1 else "s", column_name)
+    if policy == "error":
+        raise ValueError("{}: {}".format(message, features))
+    warn("{}, only the {} value is kept: {}".format(message, policy,
+                                                    features))
+
+
+class StringPool(object):
+    """
+    Stores every distinct string value once and hands out integer codes
+    for them, so string columns only need to store the codes.
+    """
+    def __init__(self):
+        self.strings = []  # type: List[str]
+        self.codes = {}  # type: Dict[str, int]
+
+    def code(self, value: str) -> int:
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = len(self.strings)
+            self.codes[value] = code
+            self.strings.append(value)
+            return code
+
+
+class StringColumn(object):
+    """
+    A column of string values, stored as codes into a shared StringPool.
+    Rows past the end of the column are considered missing.
+    """
+    def __init__(self, pool: StringPool):
+        self.pool = pool
+        self.codes = array("i")
+
+    def __len__(self):
+        return len(self.codes)
+
+    def set(self, row: int, value: str):
+        code = self.pool.code(value)
+        size = len(self.codes)
+        if row < size:
+            self.codes[row] = code
+        else:
+            self.codes.extend(repeat(MISSING, row - size))
+            self.codes.append(code)
+
+    def get(self, row: int) -> Optional[str]:
+        try:
+            code = self.codes[row]
+        except IndexError:
+            return None
+        return None if code == MISSING else self.pool.strings[code]
+
+    def has(self, row: int) -> bool:
+        return row < len(self.codes) and self.codes[row] != MISSING
+
+    def present_rows(self) -> Iterator[int]:
+        """Yield the numbers of the rows which have a value."""
+        return compress(range(len(self.codes)),
+                        map(MISSING.__ne__, self.codes))
+
+
+class NumericColumn(object):
+    """
+    A column of numbers, stored in a typed array. A separate mask keeps
+    track of which cells have a value. Rows past the end of the column
+    are considered missing.
+    """
+    def __init__(self, typecode: str = "d"):
+        self.values = array(typecode)
+        self.mask = bytearray()
+
+    def __len__(self):
+        return len(self.values)
+
+    def set(self, row: int, value):
+        size = len(self.values)
+        if row < size:
+            self.values[row] = value
+            self.mask[row] = 1
+        else:
+            self.values.extend(repeat(0, row - size))
+            self.values.append(value)
+            self.mask.extend(bytes(row - size))
+            self.mask.append(1)
+
+    def add(self, row: int, value):
+        if self.has(row):
+            self.values[row] += value
+        else:
+            self.set(row, value)
+
+    def get(self, row: int):
+        if self.has(row):
+            return self.values[row]
+        return None
+
+    def has(self, row: int) -> bool:
+        return row < len(self.mask) and self.mask[row] == 1
+
+    def present_rows(self) -> Iterator[int]:
+        """Yield the numbers of the rows which have a value."""
+        return compress(range(len(self.mask)), self.mask)
+
+
+class SparseColumn(object):
+    """
+    A column of numbers of which only the non-zero values are stored, as
+    row numbers in increasing order and the values of those rows. All
+    other rows are zero, a sparse column has no missing values.
+    """
+    def __init__(self, typecode: str = "d"):
+        self.rows = array("l")
+        self.values = array(typecode)
+
+    @classmethod
+    def from_values(cls, rows: Iterable[int], values: array
+                    ) -> "SparseColumn":
+        """Create a column from the values of the given rows."""
+        column = cls(values.typecode)
+        entries = sorted((row, value) for row, value in zip(rows, values)
+                         if value)
+        column.rows.extend(row for row, _ in entries)
+        column.values.extend(value for _, value in entries)
+        return column
+
+    def get(self, row: int):
+        i = bisect_left(self.rows, row)
+        if i < len(self.rows) and self.rows[i] == row:
+            return self.values[i]
+        return 0.0 if self.values.typecode == "d" else 0
+
+    def present_rows(self) -> Iterator[int]:
+        """Yield the numbers of the rows with a non-zero value."""
+        return iter(self.rows)
+
+    def to_dense(self, size: int) -> NumericColumn:
+        """Convert the column to a NumericColumn with the given size."""
+        column = NumericColumn(self.values.typecode)
+        column.values = array(self.values.typecode, [0]) * size
+        for row, value in zip(self.rows, self.values):
+            column.values[row] = value
+        column.mask = bytearray(b"\x01") * size
+        return column
+
+
+class ParsedTable(object):
+    """
+    The records read from a single table. Each distinct feature is stored
+    once, the records refer to them by their index in `features`.
+    """
+    def __init__(self, features: List[str], indices: array, values):
+        self.features = features
+        self.indices = indices
+        self.values = values
+
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[AnyStr, AnyStr]],
+                     numeric: bool,
+                     encoding: Optional[str] = None,
+                     typecode: str = "d") -> "ParsedTable":
+        """
+        Create a ParsedTable from (feature, value) pairs.
+        :param records: An iterable of (feature, value) pairs.
+        :param numeric: Whether or not the values should be stored as
+        numbers, rather than strings.
+        :param encoding: If given, the features and values are bytes in
+        this encoding. Each distinct feature is only decoded once.
+        :param typecode: The type of the numbers: 'd' for floats, 'q' for
+        integers.
+        """
+        feature_indices = {}  # type: Dict[AnyStr, int]
+        indices = array("l")
+        values = array(typecode) if numeric else []
+        convert = int if typecode == "q" else float
+        # Bound methods save an attribute lookup per record.
+        index = feature_indices.setdefault
+        append_index = indices.append
+        append_value = values.append
+        if numeric:
+            for feature, value in records:
+                append_index(index(feature, len(feature_indices)))
+                append_value(convert(value))
+        else:
+            for feature, value in records:
+                append_index(index(feature, len(feature_indices)))
+                append_value(value)
+        features = _ordered_features(feature_indices, encoding)
+        if encoding is not None and not numeric:
+            values = [value.decode(encoding) for value in values]
+        return cls(features, indices, values)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple], count: int, numeric: bool,
+                  encoding: Optional[str] = None,
+                  typecode: str = "d") -> List["ParsedTable"]:
+        """
+        Create one ParsedTable per value column from rows with a feature
+        followed by count values. The tables share their features and
+        indices. Takes the same arguments as from_records.
+        """
+        feature_indices = {}  # type: Dict[AnyStr, int]
+        indices = array("l")
+        columns = [array(typecode) if numeric else []
+                   for _ in range(count)]
+        convert = int if typecode == "q" else float
+        index = feature_indices.setdefault
+        append_index = indices.append
+        appends = [values.append for values in columns]
+        for row in rows:
+            append_index(index(row[0], len(feature_indices)))
+            if numeric:
+                for append, value in zip(appends, row[1:]):
+                    append(convert(value))
+            else:
+                for append, value in zip(appends, row[1:]):
+                    append(value)
+        features = _ordered_features(feature_indices, encoding)
+        if encoding is not None and not numeric:
+            columns = [[value.decode(encoding) for value in values]
+                       for values in columns]
+        return [cls(features, indices, values) for values in columns]
+
+    def reduce(self, policy: str) -> Tuple[list, List[Tuple[str, int]]]:
+        """
+        Reduce the values to one per feature in a single pass.
+        Returns the values, in the same order as `features`, and a list
+        of (feature, number of records) pairs for the features with
+        multiple records.
+        :param policy: One of DUPLICATE_POLICIES. The values should be
+        numbers for 'sum', 'max' and 'mean', the means are floats. For
+        'error' the values of duplicate features are those of the last
+        record.
+        """
+        size = len(self.features)
+        if len(self.indices) == size:
+            # Every feature occurs once, in order.
+            if policy == "mean" and isinstance(self.values, array):
+                return array("d", self.values), []
+            return self.values, []
+        counts = array("l", [0]) * size
+        for index in self.indices:
+            counts[index] += 1
+        if isinstance(self.values, array):
+            values = array(self.values.typecode, [0]) * size
+        else:
+            values = [None] * size
+        if policy == "max":
+            seen = bytearray(size)
+            for index, value in zip(self.indices, self.values):
+                if not seen[index] or value > values[index]:
+                    values[index] = value
+                    seen[index] = 1
+        elif policy in NUMERIC_POLICIES:
+            for index, value in zip(self.indices, self.values):
+                values[index] += value
+            if policy == "mean":
+                values = array("d", map(truediv, values, counts))
+        elif policy == "first":
+            for index, value in zip(reversed(self.indices),
+                                    reversed(self.values)):
+                values[index] = value
+        else:
+            for index, value in zip(self.indices, self.values):
+                values[index] = value
+        duplicates = [(feature, count)
+                      for feature, count in zip(self.features, counts)
+                      if count > 1]
+        return values, duplicates
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the table: a line with a JSON header followed by the
+        features as NUL separated UTF-8, the indices and the values, as
+        either an array of numbers or NUL separated UTF-8. Raises a
+        ValueError if a string contains a NUL character.
+        """
+        features = encode_strings(self.features)
+        indices = self.indices.tobytes()
+        numeric = isinstance(self.values, array)
+        values = (self.values.tobytes() if numeric
+                  else encode_strings(self.values))
+        header = json.dumps({
+            "version": PARSED_TABLE_VERSION, "byteorder": sys.byteorder,
+            "typecode": self.indices.typecode,
+            "values": self.values.typecode if numeric else None,
+            "features": [len(self.features), len(features)],
+            "records": [len(self.indices), len(indices)]}).encode("utf-8")
+        return b"".join([header, b"\n", features, indices, values])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ParsedTable":
+        """Deserialize a table serialized with to_bytes."""
+        end = data.index(b"\n")
+        header = json.loads(data[:end].decode("utf-8"))
+        if (header["version"] != PARSED_TABLE_VERSION or
+                header["byteorder"] != sys.byteorder):
+            raise ValueError("Incompatible parsed table.")
+        feature_count, features_length = header["features"]
+        record_count, indices_length = header["records"]
+        start = end + 1
+        features = decode_strings(data[start:start + features_length],
+                                  feature_count)
+        start += features_length
+        indices = array(header["typecode"])
+        indices.frombytes(data[start:start + indices_length])
+        start += indices_length
+        if header["values"] is not None:
+            values = array(header["values"])
+            values.frombytes(data[start:])
+        else:
+            values = decode_strings(data[start:], record_count)
+        return cls(features, indices, values)
+
+
+def _ordered_features(feature_indices: Dict, encoding: Optional[str]
+                      ) -> List[str]:
+    """
+    List the features of a {feature: index} dictionary by index, decoded
+    if an encoding is given.
+    """
+    features = [None] * len(feature_indices)  # type: List
+    for feature, i in feature_indices.items():
+        features[i] = feature
+    if encoding is not None:
+        features = [feature.decode(encoding) for feature in features]
+    return features
+
+
+def encode_strings(strings: List[str]) -> bytes:
+    """Encode a list of strings as NUL separated UTF-8."""
+    for string in strings:
+        if "\0" in string:
+            raise ValueError("{!r} contains a NUL character.".format(string))
+    return "\0".join(strings).encode("utf-8")
+
+
+def decode_strings(data, count: int) -> List[str]:
+    """Decode count NUL separated UTF-8 strings from a bytes-like object."""
+    if count == 0:
+        return []
+    return bytes(data).decode("utf-8").split("\0")
+
+
+class MergedTable(object):
+    """
+    A merged table stored column by column. Every feature is assigned a
+    row number the first time it is encountered, each column stores its
+    values in a compact array indexed by that row number.
+    """
+    def __init__(self):
+        self.features = []  # type: List[str]
+        self.rows = {}  # type: Dict[str, int]
+        self.columns = {}
+        self.pool = StringPool()
+        # (column name, feature, number of records) for each feature
+        # which occurred multiple times in a table.
+        self.duplicates = []  # type: List[Tuple[str, str, int]]
+
+    def __len__(self):
+        return len(self.features)
+
+    def __contains__(self, feature):
+        return feature in self.rows
+
+    def keys(self):
+        return self.rows.keys()
+
+    def row(self, feature: str) -> int:
+        """
+        Return the row number for a feature, assigning a new row to
+        features which have not been seen before.
+        """
+        try:
+            return self.rows[feature]
+        except KeyError:
+            row = len(self.features)
+            self.rows[feature] = row
+            self.features.append(feature)
+            return row
+
+    def new_string_column(self, name: str) -> StringColumn:
+        column = StringColumn(self.pool)
+        self.columns[name] = column
+        return column
+
+    def new_numeric_column(self, name: str,
+                           typecode: str = "d") -> NumericColumn:
+        column = NumericColumn(typecode)
+        self.columns[name] = column
+        return column
+
+    def add_table(self, column_name: str, records: Iterable[Tuple[str, str]],
+                  sum_on_duplicate_id: bool,
+                  on_duplicate: Optional[str] = None):
+        """
+        Add a column to the table.
+        :param column_name: The name of the new column.
+        :param records: An iterable of (feature, value) pairs.
+        :param sum_on_duplicate_id: Whether or not values should be added
+        up if multiple records exist with the same feature id. The values
+        are stored as floats if set, as strings otherwise.
+        :param on_duplicate: One of DUPLICATE_POLICIES, overrides
+        sum_on_duplicate_id. The values are stored as floats for 'sum',
+        'max' and 'mean'.
+        """
+        policy = duplicate_policy(sum_on_duplicate_id, on_duplicate)
+        self.add_parsed_table(
+            column_name,
+            ParsedTable.from_records(records, policy in NUMERIC_POLICIES),
+            sum_on_duplicate_id, policy)
+
+    def add_parsed_table(self, column_name: str, table: ParsedTable,
+                         sum_on_duplicate_id: bool,
+                         on_duplicate: Optional[str] = None,
+                         sparse: bool = False):
+        """
+        Add a column to the table from a ParsedTable. Duplicate features
+        are recorded in `duplicates` and reported once for the table, see
+        report_duplicates.
+        :param column_name: The name of the new column.
+        :param table: The parsed table, its values should be floats if
+        sum_on_duplicate_id is set or on_duplicate is 'sum', 'max' or
+        'mean'.
+        :param sum_on_duplicate_id: Whether or not values should be added
+        up if multiple records exist with the same feature id.
+        :param on_duplicate: One of DUPLICATE_POLICIES, overrides
+        sum_on_duplicate_id.
+        :param sparse: Store the values in a SparseColumn, which requires
+        numeric values.
+        """
+        policy = duplicate_policy(sum_on_duplicate_id, on_duplicate)
+        values, duplicates = table.reduce(policy)
+        report_duplicates(column_name, duplicates, policy)
+        self.duplicates.extend((column_name, feature, count)
+                               for feature, count in duplicates)
+        if sparse:
+            if not isinstance(values, array):
+                raise ValueError("Sparse columns require numeric values.")
+            self.columns[column_name] = SparseColumn.from_values(
+                map(self.row, table.features), values)
+            return
+        if isinstance(values, array):
+            column = self.new_numeric_column(column_name, values.typecode)
+        else:
+            column = self.new_string_column(column_name)
+        for feature, value in zip(table.features, values):
+            column.set(self.row(feature), value)
+
+    def add_values(self, column_name: str, values: Dict[str, str]):
+        """
+        Add a string column for a set of features already in the table.
+        :param column_name: The name of the new column.
+        :param values: A dictionary mapping features to values.
+        """
+        column = self.new_string_column(column_name)
+        for feature, value in values.items():
+            column.set(self.rows[feature], value)
+
+    def update_values(self, column_name: str, values: Dict[str, str]):
+        """
+        Set values in an existing string column for a set of features
+        already in the table.
+        :param column_name: The name of the column.
+        :param values: A dictionary mapping features to values.
+        """
+        column = self.columns[column_name]
+        for feature, value in values.items():
+            column.set(self.rows[feature], value)
+
+    def numeric_column(self, name: str
+                       ) -> Union[NumericColumn, SparseColumn]:
+        """
+        Return a numeric or sparse column, raising a TypeError for string
+        columns.
+        """
+        column = self.columns[name]
+        if isinstance(column, StringColumn):
+            raise TypeError("Column {} is not numeric.".format(name))
+        return column
+
+    def convert_to_numeric(self, name: str, typecode: str = "d"):
+        """
+        Replace a string column with a numeric column, for instance one
+        read back from delimited text. Numeric columns are left as they
+        are. Raises a ValueError if a value is not a number.
+        :param name: The name of the column.
+        :param typecode: The type of the numbers: 'd' for floats, 'q' for
+        integers.
+        """
+        column = self.columns[name]
+        if not isinstance(column, StringColumn):
+            return
+        convert = int if typecode == "q" else float
+        numeric = NumericColumn(typecode)
+        for row in column.present_rows():
+            value = column.get(row)
+            try:
+                numeric.set(row, convert(value))
+            except ValueError:
+                raise ValueError(
+                    "Column {} is not numeric, it contains {!r} for "
+                    "{}.".format(name, value, self.features[row])) from None
+        self.columns[name] = numeric
+
+    def totals(self, column_names: List[str]) -> List:
+        """Return the sum of the values in each of the given columns."""
+        return [sum(self.numeric_column(name).values)
+                for name in column_names]
+
+    def filter_rows(self, column_names: List[str], min_value: float,
+                    min_columns: int) -> List[int]:
+        """
+        Return the numbers of the rows which have a value of at least
+        min_value in at least min_columns of the given columns.
+        """
+        passing = array("l", [0]) * len(self.features)
+        at_least = float(min_value).__le__
+        for name in column_names:
+            column = self.numeric_column(name)
+            if isinstance(column, SparseColumn):
+                if at_least(0):
+                    # The rows which are not stored are zero.
+                    column = column.to_dense(len(self.features))
+                else:
+                    for row in compress(column.rows,
+                                        map(at_least, column.values)):
+                        passing[row] += 1
+                    continue
+            for row in compress(range(len(column)),
+                                map(at_least, column.values)):
+                passing[row] += column.mask[row]
+        return [row for row, count in enumerate(passing)
+                if count >= min_columns]
+
+    def normalize(self, column_names: List[str], method: str,
+                  lengths: Optional[Dict[str, float]] = None):
+        """
+        Replace the values in the given columns by counts per million
+        ('cpm') or transcripts per million ('tpm'). Missing values stay
+        missing.
+        :param column_names: The names of the columns.
+        :param method: Either 'cpm' or 'tpm'.
+        :param lengths: The lengths of the features, required for 'tpm'.
+        """
+        if method == "tpm":
+            try:
+                row_lengths = array("d", (lengths[feature]
+                                          for feature in self.features))
+            except KeyError as error:
+                raise ValueError("No length is known for {}.".format(
+                    error.args[0]))
+        for name in column_names:
+            column = self.numeric_column(name)
+            values = array("d", column.values)
+            if isinstance(column, SparseColumn):
+                if method == "tpm":
+                    values = array("d", map(
+                        truediv, values, map(row_lengths.__getitem__,
+                                             column.rows)))
+                total = sum(values)
+                scale = 1e6 / total if total else 0.0
+                normalized = SparseColumn()
+                normalized.rows = column.rows
+                normalized.values = array("d", map(scale.__mul__, values))
+                self.columns[name] = normalized
+                continue
+            if method == "tpm":
+                values = array("d", map(truediv, values, row_lengths))
+            elif method != "cpm":
+                raise ValueError("Unknown normalization: {}".format(method))
+            total = sum(values)
+            scale = 1e6 / total if total else 0.0
+            normalized = self.new_numeric_column(name)
+            normalized.values = array("d", map(scale.__mul__, values))
+            normalized.mask = column.mask
+
+    def select_rows(self, rows: List[int]) -> "MergedTable":
+        """
+        Return a new table with only the given rows, in the given order.
+        The string pool is shared with this table.
+        """
+        table = MergedTable()
+        table.pool = self.pool
+        for row in rows:
+            table.row(self.features[row])
+        positions = None
+        for name, column in self.columns.items():
+            if isinstance(column, SparseColumn):
+                if positions is None:
+                    positions = array("l", [-1]) * len(self.features)
+                    for position, row in enumerate(rows):
+                        positions[row] = position
+                kept = [(positions[row], value) for row, value
+                        in zip(column.rows, column.values)
+                        if positions[row] != -1]
+                table.columns[name] = SparseColumn.from_values(
+                    (position for position, _ in kept),
+                    array(column.values.typecode,
+                          (value for _, value in kept)))
+            elif isinstance(column, StringColumn):
+                selected = table.new_string_column(name)
+                selected.codes = array("i", (
+                    column.codes[row] if row < len(column) else MISSING
+                    for row in rows))
+            else:
+                selected = table.new_numeric_column(
+                    name, column.values.typecode)
+                selected.values = array(column.values.typecode, (
+                    column.values[row] if row < len(column) else 0
+                    for row in rows))
+                selected.mask = bytearray(
+                    column.mask[row] if row < len(column) else 0
+                    for row in rows)
+        return table
+
+    def view(self, columns: Dict[str, str]) -> "MergedTable":
+        """
+        Return a table which shares its rows and string pool with this
+        one and has the given columns, as a {new name: name} dictionary.
+        The columns are not copied.
+        """
+        table = MergedTable()
+        table.features = self.features
+        table.rows = self.rows
+        table.pool = self.pool
+        table.columns = {new_name: self.columns[name]
+                         for new_name, name in columns.items()
+                         if name in self.columns}
+        return table
+
+    def iter_rows(self, column_names: List[str]) -> Iterator[list]:
+        """
+        Yield the rows of the table in the order the features were
+        encountered, each as a list starting with the feature id and
+        followed by the values for the given columns. Missing values are
+        None.
+        """
+        columns = [self.columns.get(name) for name in column_names]
+        for row, feature in enumerate(self.features):
+            yield [feature] + [None if column is None else column.get(row)
+                               for column in columns]
+
+    def to_dict(self) -> dict:
+        """
+        Convert the table to a dictionary of dictionaries, mapping
+        features to column names to values, as returned by
+        collect_columns. All values are converted to strings.
+        """
+        table = {feature: {} for feature in self.features}
+        for name, column in self.columns.items():
+            for row in column.present_rows():
+                table[self.features[row]][name] = str(column.get(row))
+        return table
+
+    def to_numpy(self, column_names: List[str]):
+        """
+        Convert numeric columns to a NumPy matrix with one row per feature
+        and one column per name. Missing values become NaN. Requires NumPy
+        to be installed.
+        """
+        import numpy
+        matrix = numpy.full((len(self.features), len(column_names)),
+                            numpy.nan)
+        for i, name in enumerate(column_names):
+            column = self.numeric_column(name)
+            if isinstance(column, SparseColumn):
+                matrix[:, i] = 0
+                rows = numpy.frombuffer(column.rows,
+                                        dtype=column.rows.typecode)
+                matrix[rows, i] = numpy.frombuffer(
+                    column.values, dtype=column.values.typecode)
+                continue
+            size = len(column)
+            values = numpy.frombuffer(column.values,
+                                      dtype=column.values.typecode)
+            mask = numpy.frombuffer(bytes(column.mask), dtype=bool)
+            matrix[:size, i] = numpy.where(mask, values, numpy.nan)
+        return matrix
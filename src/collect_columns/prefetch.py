@@ -0,0 +1,64 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Reading files ahead of the code processing them. On network and parallel
+file systems opening a file and reading its first block can take longer
+than parsing it, so the next files are read in a pool of threads while
+the current one is being processed.
+"""
+
+from collections import deque
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+
+def read_ahead(paths: Iterable[Path], ahead: int,
+               read: Callable[[Path], bytes] = Path.read_bytes
+               ) -> Iterator[bytes]:
+    """
+    Yield the contents of files in the given order, reading up to `ahead`
+    files ahead in as many threads. At most ahead + 1 files are held in
+    memory at a time.
+    :param paths: The paths to the files.
+    :param ahead: The number of files which are read ahead.
+    :param read: The function used to read a file.
+    """
+    # concurrent.futures is only imported when it is used, see
+    # test_imports.
+    from concurrent.futures import ThreadPoolExecutor
+    paths = iter(paths)
+    pending = deque()
+    executor = ThreadPoolExecutor(ahead)
+    try:
+        for path in islice(paths, ahead):
+            pending.append(executor.submit(read, path))
+        while pending:
+            contents = pending.popleft().result()
+            # Start on the next file before the current one is processed.
+            for path in islice(paths, 1):
+                pending.append(executor.submit(read, path))
+            yield contents
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
@@ -0,0 +1,115 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Selection of the features to be read from the tables.
+"""
+
+import hashlib
+import re
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+
+from .compression import open_input
+
+
+class FeatureSelection(object):
+    """
+    Selects features by id, from a set of ids and/or a regular expression
+    which should match somewhere in the id. If both are given, features
+    should meet both criteria.
+    """
+    def __init__(self, features: Optional[Iterable[str]] = None,
+                 pattern: Optional[str] = None):
+        self.features = None if features is None else frozenset(features)
+        self.pattern = pattern
+        # The ids and compiled regular expression per encoding.
+        self._criteria_cache = {}
+
+    @classmethod
+    def from_file(cls, path: Path,
+                  pattern: Optional[str] = None) -> "FeatureSelection":
+        """
+        Create a selection from a file with one feature id per line.
+        Empty lines are ignored.
+        :param path: The path to the file, which may be compressed.
+        :param pattern: A regular expression the ids should also match.
+        """
+        with open_input(path) as features_file:
+            features = [line.strip() for line in features_file]
+        return cls((feature for feature in features if feature), pattern)
+
+    def key(self) -> list:
+        """Return a JSON serializable key identifying the selection."""
+        digest = None
+        if self.features is not None:
+            digest = hashlib.sha256(
+                "\n".join(sorted(self.features)).encode()).hexdigest()
+        return [digest, self.pattern]
+
+    def _criteria(self, encoding: Optional[str]):
+        """
+        Return the set of ids, as bytes in the given encoding or as strings
+        if it is None, and the compiled regular expression. The regular
+        expression always matches strings, so that it behaves the same
+        for every table.
+        """
+        try:
+            return self._criteria_cache[encoding]
+        except KeyError:
+            features = self.features
+            if encoding is not None and features is not None:
+                features = frozenset(feature.encode(encoding)
+                                     for feature in features)
+            criteria = (features, None if self.pattern is None
+                        else re.compile(self.pattern))
+            self._criteria_cache[encoding] = criteria
+            return criteria
+
+    def filter(self, records: Iterable[Tuple], encoding: Optional[str] = None
+               ) -> Iterator[Tuple]:
+        """
+        Yield the (feature, value) pairs of the selected features.
+        :param records: The (feature, value) pairs.
+        :param encoding: If given, the features are bytes in this encoding.
+        Each distinct feature is only decoded once to be matched with the
+        regular expression.
+        """
+        features, regex = self._criteria(encoding)
+        if features is not None:
+            records = (record for record in records if record[0] in features)
+        if regex is not None:
+            search = regex.search
+            if encoding is not None:
+                matches = {}
+
+                def selected(feature: bytes) -> bool:
+                    try:
+                        return matches[feature]
+                    except KeyError:
+                        match = matches[feature] = bool(
+                            search(feature.decode(encoding)))
+                        return match
+
+                records = (record for record in records
+                           if selected(record[0]))
+            else:
+                records = (record for record in records if search(record[0]))
+        return records
@@ -0,0 +1,159 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Combining merged tables which were written as native files by
+`collect-columns partial`, each holding the columns of a subset of the
+tables. The shards are memory mapped and their values are only read when
+the combined rows are written, so only the features are held in memory.
+"""
+
+import mmap
+import sys
+from array import array
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional
+
+from .formats import TYPECODES, read_native_header
+from .merged_table import MISSING, decode_strings
+
+
+class Shard(object):
+    """
+    The value columns of a native file, memory mapped. Annotation columns
+    are ignored. Use as a context manager, or call close.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        with path.open("rb") as handle:
+            header, start = read_native_header(handle)
+            self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = header
+        self.views = []  # type: List[memoryview]
+        self.data = self._view(self._view(memoryview(self.map))[start:])
+        self.features = decode_strings(self._block(header["features"]),
+                                       header["rows"])
+        strings = decode_strings(self._block(header["strings"]),
+                                 header["strings"]["count"])
+        self.column_names = []  # type: List[str]
+        self.getters = []  # type: List[Callable[[int], object]]
+        for description in header["columns"]:
+            if description["annotation"]:
+                continue
+            self.column_names.append(description["name"])
+            if description["type"] == "string":
+                self.getters.append(self._string_getter(
+                    self._numbers("i", description["values"]), strings))
+            else:
+                self.getters.append(self._numeric_getter(
+                    self._numbers(TYPECODES[description["type"]],
+                                  description["values"]),
+                    self._block(description["mask"])))
+
+    def _view(self, view: memoryview) -> memoryview:
+        self.views.append(view)
+        return view
+
+    def _block(self, description: dict) -> memoryview:
+        offset = description["offset"]
+        return self._view(self.data[offset:offset + description["length"]])
+
+    def _numbers(self, typecode: str, description: dict):
+        block = self._block(description)
+        if self.header["byteorder"] == sys.byteorder:
+            return self._view(block.cast(typecode))
+        values = array(typecode)
+        values.frombytes(block)
+        values.byteswap()
+        return values
+
+    @staticmethod
+    def _string_getter(codes, strings: List[str]
+                       ) -> Callable[[int], Optional[str]]:
+        def get(row: int) -> Optional[str]:
+            code = codes[row]
+            return None if code == MISSING else strings[code]
+        return get
+
+    @staticmethod
+    def _numeric_getter(values, mask) -> Callable[[int], object]:
+        def get(row: int):
+            return values[row] if mask[row] else None
+        return get
+
+    def values(self, row: int) -> list:
+        """Return the values of a row, None for missing values."""
+        return [get(row) for get in self.getters]
+
+    def close(self):
+        self.getters = []
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def combined_features(shards: List[Shard]) -> List[str]:
+    """
+    List the features of the shards in the order they are first
+    encountered, which is the order a single merge of all tables would
+    have if the shards hold consecutive subsets of the tables.
+    """
+    rows = {}
+    row = rows.setdefault
+    for shard in shards:
+        for feature in shard.features:
+            row(feature, len(rows))
+    return list(rows)
+
+
+def combine_shards(shards: List[Shard], features: List[str]
+                   ) -> Iterator[list]:
+    """
+    Yield the rows of the combined table for the given features, in the
+    given order. Each row is a list starting with the feature id and
+    followed by the values of the columns of each shard. Features which
+    are not in a shard have no value in its columns. Missing values are
+    None.
+    """
+    positions = {feature: i for i, feature in enumerate(features)}
+    # For each shard, the row of each feature or -1.
+    shard_rows = []
+    for shard in shards:
+        rows = array("l", [-1]) * len(features)
+        for row, feature in enumerate(shard.features):
+            position = positions.get(feature)
+            if position is not None:
+                rows[position] = row
+        shard_rows.append(rows)
+    missing = [[None] * len(shard.getters) for shard in shards]
+    for position, feature in enumerate(features):
+        values = [feature]
+        for shard, rows, empty in zip(shards, shard_rows, missing):
+            row = rows[position]
+            values.extend(empty if row < 0 else shard.values(row))
+        yield values
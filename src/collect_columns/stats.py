@@ -0,0 +1,114 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Instrumentation of a run: the wall time and peak memory use of each
+stage and the number of records read from each input.
+"""
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from .merged_table import ParsedTable
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Return the peak resident set size of this process in bytes, or None on
+    platforms without the resource module, such as Windows.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunStats(object):
+    """
+    Collects statistics on a run, which can be written as JSON.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.inputs = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time the code run in this context as a stage with the given name.
+        """
+        start = time.perf_counter()
+        yield
+        self.stages.append({"stage": name,
+                            "seconds": time.perf_counter() - start,
+                            "peak_rss": peak_rss()})
+
+    def add_input(self, path: Path, name: str, table: ParsedTable):
+        """
+        Record the number of records and duplicate feature ids in a parsed
+        input table and the size of its file.
+        :param path: The path to the table.
+        :param name: The name of the table's column.
+        :param table: The parsed table.
+        """
+        self.add_input_counts(path, name, len(table.indices),
+                              len(table.features))
+
+    def add_input_counts(self, path: Path, name: str, records: int,
+                         features: int):
+        """
+        Record the number of records and features of an input table which
+        was read without a ParsedTable, such as a sorted table which was
+        streamed, and the size of its file.
+        :param path: The path to the table.
+        :param name: The name of the table's column.
+        :param records: The number of records read.
+        :param features: The number of distinct feature ids.
+        """
+        self.inputs.append({"path": str(path), "name": name,
+                            "bytes": path.stat().st_size,
+                            "records": records,
+                            "features": features,
+                            "duplicates": records - features})
+
+    def to_dict(self) -> dict:
+        seconds = time.perf_counter() - self.start
+        records = sum(table["records"] for table in self.inputs)
+        return {"seconds": seconds, "peak_rss": peak_rss(),
+                "records": records,
+                "records_per_second": records / seconds if seconds else None,
+                "stages": self.stages, "inputs": self.inputs}
+
+    def write(self, output):
+        """Write the statistics as JSON to a path or an open file."""
+        if isinstance(output, Path):
+            with output.open("w") as output_file:
+                json.dump(self.to_dict(), output_file, indent=2)
+                output_file.write("\n")
+        else:
+            json.dump(self.to_dict(), output, indent=2)
+            output.write("\n")
@@ -0,0 +1,257 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+from pathlib import Path
+import shutil
+import sys
+
+import gffutils
+import pytest
+
+from collect_columns.annotation import (AttributeIndex, AttributeTokenizer,
+                                        cached_attribute_index,
+                                        read_additional_attributes)
+from collect_columns.cache import cache_path, evict
+from collect_columns.collect_columns import main
+
+
+datadir = Path(__file__).parent / Path("data")
+gtf = datadir / Path("merged.gtf")
+
+
+@pytest.mark.parametrize("text", [
+    'gene_id "G1"; exon_number 1; tag "basic"; tag "CCDS"; gene_name "a b";',
+    'gene_id "G1,G2"; note "x;y";',
+    'gene_id ""; level 2',
+    'gene_id G1; level 2;',
+    'gene_id "B"; product "protein X, isoform 2"; tag a,b;',
+    'gene_id "B"; tag "a,b"; tag "c";'])
+def test_attribute_tokenizer_matches_gffutils(text):
+    line = "chr1\tsource\texon\t1\t2\t.\t+\t.\t" + text
+    expected = dict(gffutils.feature.feature_from_line(line).attributes)
+    tokenizer = AttributeTokenizer()
+    assert tokenizer.all(text) == expected
+    for key, values in expected.items():
+        assert tokenizer.values(text, key) == values
+
+
+def test_attribute_tokenizer_gtf_file():
+    tokenizer = AttributeTokenizer()
+    with gtf.open() as gtf_file:
+        for line in gtf_file:
+            if line.startswith("#"):
+                continue
+            text = line.rstrip("\n").split("\t")[8]
+            expected = dict(
+                gffutils.feature.feature_from_line(line).attributes)
+            # gffutils does not handle two spaces between attributes.
+            if "" not in expected:
+                assert tokenizer.all(text) == expected
+
+
+def test_attribute_tokenizer_key_boundaries():
+    tokenizer = AttributeTokenizer()
+    text = 'ref_gene_id "g_1"; gene_id "MSTRG.1";'
+    assert tokenizer.values(text, "gene_id") == ["MSTRG.1"]
+    assert tokenizer.values(text, "gene_name") == []
+    assert tokenizer.values('gene_id "g";  gene_name "n";',
+                            "gene_name") == ["n"]
+
+
+def test_attribute_tokenizer_key_in_value():
+    tokenizer = AttributeTokenizer()
+    text = 'gene_id "B"; gene_name "b" ; note "has gene_name inside";'
+    assert tokenizer.values(text, "gene_name") == ["b"]
+    assert tokenizer.values('note "a gene_name "; gene_id "B";',
+                            "gene_name") == []
+
+
+def test_read_additional_attributes_gff3(tmpdir):
+    gff = tmpdir.join("annotation.gff3")
+    gff.write("##gff-version 3\n"
+              "chr1\tsource\tgene\t1\t2\t.\t+\t.\t"
+              "ID=gene1;Name=A,B\n")
+    assert read_additional_attributes(Path(gff.strpath), "ID",
+                                      ["Name"]) == {"gene1": {"Name": "A;B"}}
+
+
+def test_read_additional_attributes_feature_types():
+    features = ["MSTRG.1", "MSTRG.4"]
+    assert read_additional_attributes(
+        gtf, "gene_id", ["ref_gene_id", "transcript_id"], features,
+        feature_types=["transcript"]) == read_additional_attributes(
+        gtf, "gene_id", ["ref_gene_id", "transcript_id"], features)
+    assert read_additional_attributes(
+        gtf, "gene_id", ["ref_gene_id"], features,
+        feature_types=["gene"]) == {}
+
+
+def test_read_additional_attributes_early_exit(tmpdir):
+    local_gtf = tmpdir.join("early_exit.gtf")
+    local_gtf.write(
+        'chr1\tS\tgene\t1\t9\t.\t+\t.\tgene_id "a"; gene_name "A";\n'
+        'chr1\tS\texon\t1\t9\t.\t+\t.\tgene_id "a"; gene_name "X";\n'
+        'chr1\tS\tgene\t1\t9\t.\t+\t.\tgene_id "b"; gene_name "B";\n'
+        'chr1\tS\tgene\t1\t9\t.\t+\t.\tgene_id "a"; gene_name "Y";\n')
+    path = Path(local_gtf.strpath)
+    assert read_additional_attributes(
+        path, "gene_id", ["gene_name"], {"a", "b"}, feature_types=["gene"],
+        early_exit=True) == {"a": {"gene_name": "A"},
+                             "b": {"gene_name": "B"}}
+    assert read_additional_attributes(
+        path, "gene_id", ["gene_name"], {"a", "b"},
+        feature_types=["gene"]) == {"a": {"gene_name": "A;Y"},
+                                    "b": {"gene_name": "B"}}
+    assert read_additional_attributes(
+        path, "gene_id", ["gene_name"], {"a"}, early_exit=True) == {
+        "a": {"gene_name": "A"}}
+
+
+def test_attribute_index_matches_scan(tmpdir):
+    features = ["MSTRG.1", "MSTRG.4", "MSTRG.7"]
+    index_path = Path(tmpdir.strpath) / "index.sqlite"
+    with AttributeIndex.build(gtf, "gene_id", index_path) as index:
+        assert index.lookup(["ref_gene_id", "transcript_id"],
+                            features) == read_additional_attributes(
+            gtf, "gene_id", ["ref_gene_id", "transcript_id"], features)
+        assert index.lookup(["gene_name"]) == read_additional_attributes(
+            gtf, "gene_id", ["gene_name"])
+        assert index.get("MSTRG.7") is None
+        assert index.get("MSTRG.1")["transcript_id"] == ["t_1_2", "t_1_1"]
+
+
+def test_cached_attribute_index_reused(tmpdir):
+    cache_dir = Path(tmpdir.strpath) / "cache"
+    local_gtf = Path(tmpdir.strpath) / "local.gtf"
+    shutil.copy(str(gtf), str(local_gtf))
+    with cached_attribute_index(local_gtf, "gene_id", cache_dir,
+                                10 ** 9) as index:
+        first_path = index.path
+    with cached_attribute_index(local_gtf, "gene_id", cache_dir,
+                                10 ** 9) as index:
+        assert index.path == first_path
+    with cached_attribute_index(local_gtf, "gene_name", cache_dir,
+                                10 ** 9) as index:
+        assert index.path != first_path
+    # A modified file gets a new index.
+    with local_gtf.open("a") as gtf_file:
+        gtf_file.write('chr1\tx\tgene\t1\t2\t.\t+\t.\tgene_id "new";\n')
+    with cached_attribute_index(local_gtf, "gene_id", cache_dir,
+                                10 ** 9) as index:
+        assert index.path != first_path
+        assert index.get("new") == {"gene_id": ["new"]}
+    with cached_attribute_index(local_gtf, "gene_id", cache_dir, 10 ** 9,
+                                ["exon"]) as index:
+        assert index.get("new") is None
+        assert index.get("MSTRG.1")["exon_number"] == ["1", "2", "3"]
+    assert len(list(cache_dir.iterdir())) == 4
+
+
+def test_evict_least_recently_used(tmpdir):
+    cache_dir = Path(tmpdir.strpath)
+    entries = [cache_path(cache_dir, name, ".sqlite")
+               for name in ["old", "middle", "new"]]
+    for i, entry in enumerate(entries):
+        entry.write_bytes(b"x" * 10)
+        os.utime(str(entry), (i, i))
+    evict(cache_dir, 20, ".sqlite")
+    assert sorted(cache_dir.iterdir()) == sorted(entries[1:])
+    evict(cache_dir, 0, ".sqlite", keep=entries[1])
+    assert list(cache_dir.iterdir()) == [entries[1]]
+
+
+def test_evict_only_removes_entries(tmpdir):
+    cache_dir = Path(tmpdir.strpath)
+    foreign = [cache_dir / "notes.txt", cache_dir / "a.tsv",
+               cache_dir / ("0" * 64), cache_dir / ("g" * 64 + ".sqlite"),
+               cache_path(cache_dir, "parsed", ".parsed")]
+    for path in foreign:
+        path.write_bytes(b"x" * 10)
+        os.utime(str(path), (0, 0))
+    entry = cache_path(cache_dir, "index", ".sqlite")
+    entry.write_bytes(b"x" * 10)
+    evict(cache_dir, 0, ".sqlite")
+    assert sorted(cache_dir.iterdir()) == sorted(foreign)
+    # Without a suffix, only files named like entries are removed.
+    evict(cache_dir, 0)
+    assert sorted(cache_dir.iterdir()) == sorted(foreign[:4])
+
+
+def test_main_gtf_cache_shared_directory(tmpdir):
+    sample = tmpdir.join("sample.tsv")
+    sample.write("MSTRG.1\t1\n")
+    notes = tmpdir.join("notes.txt")
+    notes.write("keep me")
+    sys.argv = ["script", tmpdir.join("output.tsv").strpath, sample.strpath,
+                "-g", str(gtf), "-a", "gene_name", "--gtf-cache",
+                tmpdir.strpath, "--gtf-cache-size", "0"]
+    main()
+    assert notes.read() == "keep me"
+    assert sample.read() == "MSTRG.1\t1\n"
+    assert tmpdir.join("output.tsv").read() == (
+        "feature\tgene_name\tsample.tsv\nMSTRG.1\tgene_1;gene_7\t1\n")
+
+
+def test_main_gtf_cache(tmpdir):
+    sample1 = str(datadir / Path("semicolon") / Path("sample1.csv"))
+    sample2 = str(datadir / Path("semicolon") / Path("sample2.csv"))
+    cache_dir = tmpdir.join("cache")
+    expected_result = set([
+        "feature;ref_gene_id;transcript_id;sample1.csv;sample2.csv\n",
+        "gene_1;g_1;t_1_2;1;10\n",
+        "gene_2;g_2;t_2_1;2;20\n",
+        "gene_3;g_3;t_3_1;3;30\n",
+        "gene_4;g_4;\"t_4_2;t_4_1\";4;40\n",
+        "gene_5;g_5;t_5_1;5;\n",
+        "gene_6;g_6;t_6_1;;60\n"])
+    for flags in ([], ["--sorted-inputs"]):
+        output_file = tmpdir.join("output.tsv")
+        sys.argv = ["script", output_file.strpath, sample1, sample2, "-f",
+                    "1", "-c", "0", "-s", ";", "-H", "-g", str(gtf), "-a",
+                    "ref_gene_id", "transcript_id", "-F", "gene_name",
+                    "--gtf-cache", cache_dir.strpath] + flags
+        main()
+        with output_file.open() as out_file:
+            assert set(out_file.readlines()) == expected_result
+    assert len(cache_dir.listdir()) == 1
+
+
+def test_main_gtf_cache_quoted_values(tmpdir):
+    local_gtf = tmpdir.join("quoted.gtf")
+    local_gtf.write(
+        'chr1\tS\tgene\t1\t9\t.\t+\t.\tgene_id "A"; '
+        'product "protein X, isoform 2";\n'
+        'chr1\tS\tgene\t1\t9\t.\t+\t.\tgene_id "B"; gene_name "b" ; '
+        'product "none"; note "has gene_name inside";\n')
+    sample = tmpdir.join("sample.tsv")
+    sample.write("A\t1\nB\t2\n")
+    outputs = []
+    for flags in ([], ["--gtf-cache", tmpdir.join("cache").strpath]):
+        output_file = tmpdir.join("output{}.tsv".format(len(outputs)))
+        sys.argv = ["script", output_file.strpath, sample.strpath, "-n",
+                    "s1", "-g", local_gtf.strpath, "-a", "gene_name",
+                    "product"] + flags
+        main()
+        outputs.append(output_file.read())
+    assert outputs[0] == outputs[1] == (
+        "feature\tgene_name\tproduct\ts1\n"
+        "A\t\tprotein X, isoform 2\t1\n"
+        "B\tb\tnone\t2\n")
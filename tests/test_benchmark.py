@@ -0,0 +1,109 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from pathlib import Path
+
+from collect_columns.annotation import read_additional_attributes
+from collect_columns.benchmark import (_read_attributes_with_gffutils,
+                                       benchmark_cohort, benchmark_gtf,
+                                       benchmark_read, benchmark_startup,
+                                       benchmark_sum_on_duplicate_id,
+                                       benchmark_threads,
+                                       write_cohort,
+                                       write_featurecounts_table, write_gtf,
+                                       write_sparse_tables)
+
+
+def test_write_sparse_tables(tmpdir):
+    tables = write_sparse_tables(Path(tmpdir.strpath), 3, 10, 4)
+    assert len(tables) == 3
+    for table in tables:
+        lines = table.read_text().splitlines()
+        assert len(lines) == 4
+        assert len(set(line.split("\t")[0] for line in lines)) == 4
+
+
+def test_benchmark_sum_on_duplicate_id():
+    results = benchmark_sum_on_duplicate_id([1, 2], 10, 5)
+    assert [count for count, _ in results] == [1, 2]
+
+
+def test_benchmark_threads():
+    results = benchmark_threads([1, 2], 2, 10)
+    assert [threads for threads, _ in results] == [1, 2]
+
+
+def test_write_gtf(tmpdir):
+    gtf = Path(tmpdir.strpath) / "annotation.gtf"
+    assert write_gtf(gtf, 2, 2, 3) == 1 + 2 * (1 + 2 * (1 + 3))
+    features = {"ENSG00000000000.1", "ENSG00000000001.1"}
+    attributes = ["gene_name", "transcript_id", "tag"]
+    expected = {feature: {attr: ";".join(values[attr]) for attr in attributes}
+                for feature, values in _read_attributes_with_gffutils(
+                    gtf, "gene_id", attributes, features).items()}
+    assert read_additional_attributes(gtf, "gene_id", attributes,
+                                      features) == expected
+    assert expected["ENSG00000000001.1"]["transcript_id"] == (
+        "ENST00000000002.1;ENST00000000003.1")
+
+
+def test_benchmark_gtf():
+    results = benchmark_gtf(2, 2, ["gene_name"])
+    assert [method for method, _, _ in results] == ["gffutils", "tokenizer"]
+
+
+def test_write_featurecounts_table(tmpdir):
+    table = Path(tmpdir.strpath) / "sample.featureCounts"
+    assert write_featurecounts_table(table, 3) == 5
+    lines = table.read_text().splitlines()
+    assert len(lines) == 5
+    assert all(len(line.split("\t")) == 7 for line in lines[1:])
+
+
+def test_benchmark_read():
+    results = benchmark_read(10)
+    assert [method for method, _, _ in results] == ["csv", "parse_table"]
+
+
+def test_write_cohort(tmpdir):
+    tables, records = write_cohort(Path(tmpdir.strpath), 3, 100,
+                                   duplicate_rate=0.5, sparsity=0.5)
+    assert len(tables) == 3
+    lines = [table.read_text().splitlines() for table in tables]
+    assert all(table_lines[0] == "gene_id\tcount" for table_lines in lines)
+    assert sum(len(table_lines) - 1 for table_lines in lines) == records
+    features = [line.split("\t")[0] for line in lines[0][1:]]
+    assert len(set(features)) < 100
+    assert len(set(features)) < len(features)
+
+
+def test_benchmark_cohort():
+    results = benchmark_cohort(2, 10, 0.1, 0.1, ["gene_name"])
+    assert [stage for stage, _, _, _ in results] == [
+        "main", "merge", "annotate", "write"]
+    assert all(peak > 0 for _, _, peak, _ in results)
+    assert results[-1][3] == 10
+
+
+def test_benchmark_startup():
+    results = benchmark_startup(1)
+    assert [step for step, _ in results] == ["import", "run",
+                                             "run_annotated"]
+    assert all(seconds > 0 for _, seconds in results)
@@ -18,10 +18,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import csv
+import os
 from pathlib import Path
+import sys
+import threading
 from warnings import catch_warnings
 
-from collect_columns.collect_columns import collect_columns
+import pytest
+
+from collect_columns.collect_columns import (can_split_table,
+                                             collect_columns, main,
+                                             parse_columns, parse_table,
+                                             read_table)
 
 
 datadir = Path(__file__).parent / Path("data")
@@ -59,8 +68,8 @@ def test_collect_columns_stringtie():
     with catch_warnings(record=True) as warnings:
         result = collect_columns(tables, 0, 7, "\t", ["sample1", "sample2"],
                                  True, False)
-        assert "duplicate value for row MSTRG.6 in sample2, will overwrite " \
-               "previous value" == str(warnings[0].message)
+        assert "duplicate values for 1 row in sample2, only the last value " \
+               "is kept: MSTRG.6" == str(warnings[0].message)
     assert result == expected_result
 
 
@@ -105,3 +114,119 @@ def test_collect_columns_sum_on_duplicate_id_missing_values():
         "gene_6": {"sample2": "60.0"}}
     result = collect_columns(tables, 1, 0, ";", ["sample1", "sample2"], True, True)
     assert result == expected_result
+
+
+def _read_with_csv(table, feature_column, value_column, sep, has_header):
+    with table.open() as table_file:
+        records = list(csv.reader(table_file, delimiter=sep))
+    return [(record[feature_column], record[value_column])
+            for record in records[1 if has_header else 0:]]
+
+
+@pytest.mark.parametrize(["table", "feature_column", "value_column", "sep",
+                          "has_header"], [
+    (Path("htseq") / "sample1.fragments_per_gene", 0, 1, "\t", False),
+    (Path("stringtie") / "sample1.abundance", 0, 7, "\t", True),
+    (Path("stringtie") / "sample1.abundance", 8, 1, "\t", True),
+    (Path("semicolon") / "sample1.csv", 1, 0, ";", True)])
+def test_read_table_split(table, feature_column, value_column, sep,
+                          has_header):
+    table = datadir / table
+    assert can_split_table(table, feature_column, value_column)
+    assert list(read_table(table, feature_column, value_column, sep,
+                           has_header)) == _read_with_csv(
+        table, feature_column, value_column, sep, has_header)
+
+
+def test_read_table_line_endings(tmpdir):
+    table = Path(tmpdir.strpath) / "table.tsv"
+    table.write_bytes(b"id\tcount\r\na\t1\r\nb\t2")
+    assert can_split_table(table, 0, 1)
+    assert list(read_table(table, 0, 1, "\t", True)) == [("a", "1"),
+                                                         ("b", "2")]
+    assert list(read_table(table, 1, 0, "\t", True)) == [("1", "a"),
+                                                         ("2", "b")]
+
+
+def test_read_table_quoted_fields(tmpdir):
+    table = Path(tmpdir.strpath) / "table.tsv"
+    table.write_text('a\t"1\t2"\nb\t3\n')
+    assert not can_split_table(table, 0, 1)
+    assert list(read_table(table, 0, 1, "\t", False)) == [("a", "1\t2"),
+                                                          ("b", "3")]
+
+
+def test_read_table_empty(tmpdir):
+    table = Path(tmpdir.strpath) / "table.tsv"
+    table.write_text("")
+    assert not can_split_table(table, 0, 1)
+    assert list(read_table(table, 0, 1, "\t", False)) == []
+
+
+def pipe(tmpdir, name: str, text: str) -> Path:
+    """A FIFO, like a process substitution, which writes text once."""
+    path = Path(tmpdir.strpath) / name
+    os.mkfifo(str(path))
+
+    def write():
+        with path.open("w") as fifo_file:
+            fifo_file.write(text)
+
+    threading.Thread(target=write, daemon=True).start()
+    return path
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"),
+                    reason="FIFOs are not available")
+@pytest.mark.parametrize("flags", [
+    [], ["-H", "-c", "count"], ["--detect-sorted-inputs"], ["--prefetch", "1"],
+    ["--parse-cache", "cache"]])
+def test_main_pipe_tables(tmpdir, flags):
+    output = tmpdir.join("output.tsv")
+    if "--parse-cache" in flags:
+        flags = flags[:1] + [tmpdir.join("cache").strpath]
+    header = "id\tcount\n" if "-H" in flags else ""
+    tables = [pipe(tmpdir, "s1", header + "a\t1\nb\t2\n"),
+              pipe(tmpdir, "s2", header + "b\t3\nc\t4\n")]
+    assert not can_split_table(tables[0], 0, 1)
+    sys.argv = ["script", output.strpath] + [str(table) for table in tables]
+    sys.argv += ["-n", "s1", "s2"] + flags
+    main()
+    assert output.read() == "feature\ts1\ts2\na\t1\t\nb\t2\t3\nc\t\t4\n"
+
+
+def test_parse_table_split(tmpdir):
+    table = Path(tmpdir.strpath) / "table.tsv"
+    table.write_text("g\u00e9ne\t1.5\nb\t2\ng\u00e9ne\t3\n")
+    parsed = parse_table(table, 0, 1, "\t", False, True)
+    assert parsed.features == ["g\u00e9ne", "b"]
+    assert list(parsed.indices) == [0, 1, 0]
+    assert list(parsed.values) == [1.5, 2.0, 3.0]
+    parsed = parse_table(table, 0, 1, "\t", False, False)
+    assert parsed.values == ["1.5", "2", "3"]
+
+
+@pytest.mark.parametrize("quoted", [False, True])
+def test_parse_columns(tmpdir, quoted):
+    table = Path(tmpdir.strpath) / "table.tsv"
+    table.write_text("id\tTPM\tNumReads\n"
+                     "a\t1.5\t{}\n"
+                     "b\t2\t3\n"
+                     "a\t3\t4\n".format('"5"' if quoted else "5"))
+    tpm, reads = parse_columns(table, 0, ["TPM", 2], "\t", True, True)
+    assert tpm.features == reads.features == ["a", "b"]
+    assert list(tpm.indices) == list(reads.indices) == [0, 1, 0]
+    assert list(tpm.values) == [1.5, 2.0, 3.0]
+    assert list(reads.values) == [5.0, 3.0, 4.0]
+    expected = parse_table(table, 0, 2, "\t", True, False)
+    result = parse_columns(table, 0, [1, 2], "\t", True, False)[1]
+    assert result.values == expected.values == ["5", "3", "4"]
+
+
+def test_parse_columns_unknown_name(tmpdir):
+    table = Path(tmpdir.strpath) / "table.tsv"
+    table.write_text("id\tTPM\na\t1\n")
+    with pytest.raises(ValueError, match="no column named FPKM"):
+        parse_columns(table, 0, ["FPKM"], "\t", True, True)
+    with pytest.raises(ValueError, match="with a header"):
+        parse_columns(table, 0, ["TPM"], "\t", False, True)
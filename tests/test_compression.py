@@ -0,0 +1,195 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import gzip
+import os
+from pathlib import Path
+import shutil
+import sys
+import threading
+
+import pytest
+
+from collect_columns import compression
+from collect_columns.collect_columns import (main, parse_args,
+                                             parse_combine_args)
+from collect_columns.compression import (compression_type, open_input,
+                                         open_output)
+
+
+datadir = Path(__file__).parent / Path("data")
+
+requires_zstd = pytest.mark.skipif(
+    shutil.which("zstd") is None and compression._zstandard() is None,
+    reason="zstd is not available")
+
+
+def gzip_file(source: Path, destination: Path):
+    with source.open("rb") as source_file:
+        with gzip.open(str(destination), "wb") as destination_file:
+            shutil.copyfileobj(source_file, destination_file)
+
+
+@pytest.fixture(params=["pigz", "thread"])
+def gzip_method(request, monkeypatch):
+    """
+    Run a test with a pigz subprocess and with a background thread. gzip,
+    which takes the same arguments, stands in for pigz if it is not
+    installed.
+    """
+    real_which = shutil.which
+    if request.param == "pigz":
+        pigz = real_which("pigz") or real_which("gzip")
+        if pigz is None:
+            pytest.skip("neither pigz nor gzip is installed")
+        monkeypatch.setattr(
+            compression.shutil, "which",
+            lambda name: pigz if name == "pigz" else real_which(name))
+    else:
+        monkeypatch.setattr(
+            compression.shutil, "which",
+            lambda name: None if name == "pigz" else real_which(name))
+    return request.param
+
+
+requires_fifo = pytest.mark.skipif(not hasattr(os, "mkfifo"),
+                                   reason="FIFOs are not available")
+
+
+def fifo(tmpdir, name: str, data: bytes) -> Path:
+    """
+    Create a FIFO, such as a process substitution, which is written to
+    by a background thread once it is opened for reading.
+    """
+    path = Path(tmpdir.strpath) / name
+    os.mkfifo(str(path))
+
+    def write():
+        with path.open("wb") as fifo_file:
+            fifo_file.write(data)
+
+    threading.Thread(target=write, daemon=True).start()
+    return path
+
+
+def test_compression_type(tmpdir):
+    plain = datadir / Path("htseq") / Path("sample1.fragments_per_gene")
+    compressed = Path(tmpdir.strpath) / "sample1.bgz"
+    gzip_file(plain, compressed)
+    assert compression_type(plain) is None
+    assert compression_type(compressed) == "gzip"
+
+
+def test_open_input_gzip(tmpdir, gzip_method):
+    plain = datadir / Path("stringtie") / Path("sample1.abundance")
+    compressed = Path(tmpdir.strpath) / "sample1.abundance.gz"
+    gzip_file(plain, compressed)
+    with open_input(compressed) as compressed_file:
+        assert compressed_file.read() == plain.read_text()
+
+
+def test_open_input_close_early(tmpdir, gzip_method, monkeypatch):
+    monkeypatch.setattr(compression, "CHUNK_SIZE", 16)
+    monkeypatch.setattr(compression, "MAX_CHUNKS", 1)
+    compressed = Path(tmpdir.strpath) / "large.gz"
+    with gzip.open(str(compressed), "wt") as compressed_file:
+        compressed_file.write("feature\tvalue\n" * 10000)
+    with open_input(compressed) as compressed_file:
+        assert compressed_file.readline() == "feature\tvalue\n"
+
+
+def test_open_output_gzip(tmpdir, gzip_method):
+    output = Path(tmpdir.strpath) / "output.tsv.gz"
+    with open_output(output) as output_file:
+        output_file.write("a\tb\r\n")
+    with gzip.open(str(output), "rb") as output_file:
+        assert output_file.read() == b"a\tb\r\n"
+
+
+@requires_zstd
+def test_zstd_round_trip(tmpdir):
+    output = Path(tmpdir.strpath) / "output.tsv.zst"
+    with open_output(output) as output_file:
+        output_file.write("a\tb\n" * 1000)
+    assert compression_type(output) == "zstd"
+    with open_input(output) as output_file:
+        assert output_file.read() == "a\tb\n" * 1000
+
+
+def test_main_compressed(tmpdir, gzip_method):
+    tables = []
+    for name in ("sample1.abundance", "sample2.abundance"):
+        table = Path(tmpdir.strpath) / (name + ".gz")
+        gzip_file(datadir / Path("stringtie") / Path(name), table)
+        tables.append(str(table))
+    gtf = Path(tmpdir.strpath) / "merged.gtf.gz"
+    gzip_file(datadir / Path("merged.gtf"), gtf)
+    plain_output = tmpdir.join("output.tsv")
+    compressed_output = tmpdir.join("output.tsv.gz")
+    for output in (plain_output, compressed_output):
+        sys.argv = ["script", output.strpath] + tables + [
+            "-c", "7", "-H", "-g", str(gtf), "-a", "ref_gene_id",
+            "gene_name", "-S"]
+        main()
+    with gzip.open(compressed_output.strpath, "rt") as output_file:
+        assert output_file.read() == plain_output.read()
+    assert "MSTRG.6\tg_6\tgene_6\t89926.898438\t9927.898438\n" in (
+        plain_output.readlines())
+
+
+def test_parse_args_missing_compressor(monkeypatch, capsys):
+    monkeypatch.setattr(compression.shutil, "which", lambda name: None)
+    monkeypatch.setattr(compression, "_zstandard", lambda: None)
+    for output in ("output.tsv.bgz", "output.tsv.zst"):
+        for argv in (["script", output, "input"],
+                     ["script", "output.tsv", "input", "-S", "--totals",
+                      output]):
+            sys.argv = argv
+            with pytest.raises(SystemExit):
+                parse_args()
+            assert "{}: writing".format(output) in capsys.readouterr().err
+        with pytest.raises(SystemExit):
+            parse_combine_args([output, "shard.ccm"])
+    sys.argv = ["script", "output.tsv.gz", "input"]
+    assert parse_args().output == Path("output.tsv.gz")
+
+
+@requires_fifo
+@pytest.mark.parametrize("compressed", [False, True])
+def test_open_input_pipe(tmpdir, gzip_method, compressed):
+    text = "a\t1\nb\t2\n" * 1000
+    data = gzip.compress(text.encode()) if compressed else text.encode()
+    with open_input(fifo(tmpdir, "input", data)) as input_file:
+        assert input_file.read() == text
+
+
+@requires_fifo
+def test_main_pipe_inputs(tmpdir):
+    gtf = datadir / Path("merged.gtf")
+    sample = tmpdir.join("sample.tsv")
+    sample.write("MSTRG.1\t1\nMSTRG.2\t2\n")
+    output = tmpdir.join("output.tsv")
+    sys.argv = ["script", output.strpath, sample.strpath, "-n", "s1",
+                "-g", str(fifo(tmpdir, "gtf", gtf.read_bytes())),
+                "-a", "gene_name", "--features-file",
+                str(fifo(tmpdir, "features", b"MSTRG.1\n"))]
+    main()
+    assert output.read() == ("feature\tgene_name\ts1\n"
+                             "MSTRG.1\tgene_1;gene_7\t1\n")
@@ -0,0 +1,269 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from array import array
+import gzip
+from pathlib import Path
+import sys
+
+import pytest
+
+from collect_columns.collect_columns import main, merge_tables, parse_args
+from collect_columns import formats
+from collect_columns.formats import (output_format, read_native,
+                                     write_matrix_market, write_merged_text,
+                                     write_native, write_text)
+from collect_columns.merged_table import (MergedTable, NumericColumn,
+                                          SparseColumn)
+
+
+datadir = Path(__file__).parent / Path("data")
+
+
+def example_table():
+    table = MergedTable()
+    table.add_table("s1", [("a", "1"), ("b", "2")], True)
+    table.add_table("s2", [("c", "x"), ("a", "y")], False)
+    table.add_values("gene_name", {"a": "A", "c": "C;D"})
+    return table
+
+
+def test_output_format():
+    assert output_format(Path("out.ccm")) == "native"
+    assert output_format(Path("out.parquet")) == "parquet"
+    assert output_format(Path("out.arrow")) == "feather"
+    assert output_format(Path("out.tsv.gz")) == "text"
+    assert output_format(Path("out.mtx")) == "mtx"
+    assert output_format(Path("out.mtx.gz")) == "mtx"
+
+
+def test_native_round_trip(tmpdir):
+    table = example_table()
+    output = Path(tmpdir.strpath) / "table.ccm"
+    write_native(table, output, ["gene_name"], ["s1", "s2", "s3"])
+    result, annotation_names, column_names = read_native(output)
+    assert annotation_names == ["gene_name"]
+    assert column_names == ["s1", "s2", "s3"]
+    assert result.features == ["a", "b", "c"]
+    assert list(result.iter_rows(["gene_name", "s1", "s2", "s3"])) == [
+        ["a", "A", 1.0, "y", None],
+        ["b", None, 2.0, None, None],
+        ["c", "C;D", None, "x", None]]
+    # The table can be extended after reading.
+    result.add_table("s4", [("d", "4")], False)
+    assert result.to_dict()["d"] == {"s4": "4"}
+
+
+def test_native_empty_table(tmpdir):
+    output = Path(tmpdir.strpath) / "empty.ccm"
+    write_native(MergedTable(), output, [], ["s1"])
+    result, _, column_names = read_native(output)
+    assert len(result) == 0
+    assert column_names == ["s1"]
+
+
+def test_native_rejects_nul(tmpdir):
+    table = MergedTable()
+    table.add_table("s1", [("a\0b", "1")], False)
+    with pytest.raises(ValueError, match="NUL"):
+        write_native(table, Path(tmpdir.strpath) / "table.ccm", [], ["s1"])
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".feather"])
+def test_arrow_formats(tmpdir, extension):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.feather
+    import pyarrow.parquet
+    output = tmpdir.join("output" + extension)
+    sample1 = str(datadir / Path("stringtie") / Path("sample1.abundance"))
+    sample2 = str(datadir / Path("stringtie") / Path("sample2.abundance"))
+    gtf = str(datadir / Path("merged.gtf"))
+    sys.argv = ["script", output.strpath, sample1, sample2, "-c", "7", "-H",
+                "-g", gtf, "-a", "gene_name", "-S", "-n", "s1", "s2"]
+    main()
+    if extension == ".parquet":
+        result = pyarrow.parquet.read_table(output.strpath)
+    else:
+        result = pyarrow.feather.read_table(output.strpath)
+    assert result.column_names == ["feature", "gene_name", "s1", "s2"]
+    assert result.schema.field("s1").type == pyarrow.float64()
+    assert result.schema.field("gene_name").type == pyarrow.string()
+    rows = result.to_pylist()
+    assert rows[0] == {"feature": "MSTRG.1", "gene_name": "gene_1;gene_7",
+                       "s1": 185151.953125, "s2": 85151.953125}
+    assert rows[5]["s2"] == 9927.898438
+
+
+def test_arrow_missing_values(tmpdir):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    from collect_columns.formats import write_arrow
+    output = Path(tmpdir.strpath) / "table.parquet"
+    write_arrow(example_table(), output, ["gene_name"], ["s1", "s2", "s3"],
+                "parquet")
+    result = pyarrow.parquet.read_table(str(output))
+    assert result.to_pydict() == {
+        "feature": ["a", "b", "c"], "gene_name": ["A", None, "C;D"],
+        "s1": [1.0, 2.0, None], "s2": ["y", None, "x"],
+        "s3": [None, None, None]}
+
+
+def test_main_native(tmpdir):
+    tables = [datadir / Path("semicolon") / Path("sample1.csv"),
+              datadir / Path("semicolon") / Path("sample2.csv")]
+    output = tmpdir.join("output.ccm")
+    sys.argv = ["script", output.strpath] + [str(t) for t in tables] + [
+        "-f", "1", "-c", "0", "-s", ";", "-H", "--detect-sorted-inputs"]
+    main()
+    result, annotation_names, column_names = read_native(Path(output.strpath))
+    assert annotation_names == []
+    assert column_names == ["sample1.csv", "sample2.csv"]
+    # Binary outputs store numbers rather than strings by default.
+    assert isinstance(result.columns["sample1.csv"], NumericColumn)
+    assert result.to_dict() == merge_tables(
+        tables, 1, 0, ";", column_names, True, False,
+        value_type="float").to_dict()
+
+
+def test_parse_args_sorted_inputs_binary_output(capsys):
+    sys.argv = ["script", "output.ccm", "input", "--sorted-inputs"]
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert "--sorted-inputs can only be used with text output" in (
+        capsys.readouterr().err)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_matrix_market(tmpdir, sparse):
+    table = MergedTable()
+    table.add_table("s1", [("a", "1"), ("b", "0")], True)
+    table.add_table("s2", [("c", "2.5"), ("a", "3")], True)
+    if sparse:
+        table.columns = {name: SparseColumn.from_values(
+            column.present_rows(), array(column.values.typecode, (
+                column.get(row) for row in column.present_rows())))
+            for name, column in table.columns.items()}
+    table.add_values("gene_name", {"a": "A", "c": "C"})
+    output = Path(tmpdir.strpath) / "counts.mtx"
+    write_matrix_market(table, output, ["gene_name"], ["s1", "s2"])
+    assert output.read_text() == ("%%MatrixMarket matrix coordinate real "
+                                  "general\n"
+                                  "3 2 3\n"
+                                  "1 1 1.0\n"
+                                  "1 2 3.0\n"
+                                  "3 2 2.5\n")
+    features = Path(tmpdir.strpath) / "counts.features.tsv"
+    assert features.read_text() == "a\tA\nb\t\nc\tC\n"
+    samples = Path(tmpdir.strpath) / "counts.samples.tsv"
+    assert samples.read_text() == "s1\ns2\n"
+
+
+def text_table():
+    table = MergedTable()
+    table.add_table("counts", [("a", "1"), ("b,c", "-2"), ('d"e', "3")], True)
+    table.add_table("tpm", [("a", "0.5"), ("f\ng", "-0.0"), ("b,c", "0")],
+                    True)
+    table.add_table("names", [("a", "x, y"), ("h", ""), ("b,c", 'say "hi"')],
+                    False)
+    table.add_table("signed", [("a", "-0"), ("b,c", "0")], True)
+    table.add_table("zeros", [("a", "0"), ("h", "7")], True)
+    column = table.columns["zeros"]
+    table.columns["zeros"] = SparseColumn.from_values(
+        column.present_rows(), array("d", (
+            column.get(row) for row in column.present_rows())))
+    return table
+
+
+@pytest.mark.parametrize(["sep", "background"], [
+    ("\t", False), (",", False), (".", False), ("1", False), ("\t", True)])
+def test_write_merged_text(tmpdir, monkeypatch, sep, background):
+    monkeypatch.setattr(formats, "BATCH_ROWS", 2)
+    table = text_table()
+    names = ["signed", "counts", "tpm", "missing", "zeros"]
+    expected = Path(tmpdir.strpath) / "expected.tsv"
+    write_text(expected, ["feature", "names"] + names,
+               table.iter_rows(["names"] + names), sep)
+    output = Path(tmpdir.strpath) / "output.tsv"
+    write_merged_text(output, table, ["names"], names, sep, background)
+    assert output.read_bytes() == expected.read_bytes()
+
+
+def test_write_merged_text_empty(tmpdir):
+    expected = Path(tmpdir.strpath) / "expected.tsv"
+    output = Path(tmpdir.strpath) / "output.tsv"
+    for names in ([], ["s1"]):
+        write_text(expected, ["feature"] + names,
+                   MergedTable().iter_rows(names), "\t")
+        write_merged_text(output, MergedTable(), [], names, "\t")
+        assert output.read_bytes() == expected.read_bytes()
+    table = MergedTable()
+    table.add_table("s1", [("a", "1")], True)
+    write_text(expected, ["feature"], table.iter_rows([]), "\t")
+    write_merged_text(output, table, [], [], "\t")
+    assert output.read_bytes() == expected.read_bytes()
+
+
+def test_main_sparse(tmpdir):
+    sample1 = tmpdir.join("sample1.tsv")
+    sample1.write("a\t0\nb\t4\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("c\t0\na\t2\n")
+    output = tmpdir.join("output.tsv")
+    base = ["script", output.strpath, sample1.strpath, sample2.strpath,
+            "-n", "s1", "s2", "--value-type", "int"]
+    sys.argv = base + ["--sparse"]
+    main()
+    assert output.read() == "feature\ts1\ts2\na\t0\t2\nb\t4\t0\nc\t0\t0\n"
+    matrix = tmpdir.join("output.mtx.gz")
+    sys.argv = base + ["--sparse"]
+    sys.argv[1] = matrix.strpath
+    main()
+    with gzip.open(matrix.strpath, "rt") as matrix_file:
+        assert matrix_file.read() == ("%%MatrixMarket matrix coordinate "
+                                      "integer general\n"
+                                      "3 2 2\n"
+                                      "2 1 4\n"
+                                      "1 2 2\n")
+    assert tmpdir.join("output.features.tsv").read() == "a\nb\nc\n"
+
+
+def test_main_matrix_market_append_to_text(tmpdir):
+    existing = tmpdir.join("existing.tsv")
+    existing.write("feature\ts1\na\t1\nb\t\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("b\t0\nc\t2\n")
+    matrix = tmpdir.join("output.mtx")
+    for flags in ([], ["--sparse"]):
+        sys.argv = ["script", matrix.strpath, sample2.strpath, "-n", "s2",
+                    "--value-type", "int", "--append-to",
+                    existing.strpath] + flags
+        main()
+        assert matrix.read() == ("%%MatrixMarket matrix coordinate integer "
+                                 "general\n"
+                                 "3 2 2\n"
+                                 "1 1 1\n"
+                                 "3 2 2\n")
+
+
+def test_parse_args_sparse_requires_numbers(capsys):
+    sys.argv = ["script", "output.mtx", "input"]
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert "require numeric values" in capsys.readouterr().err
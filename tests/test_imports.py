@@ -0,0 +1,37 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from collect_columns.benchmark import import_profile
+
+# Modules which take long to import and are only needed for some options.
+# Importing the command line tool should not load them, as it is often run
+# many times on small tables.
+LAZY_MODULES = ["gffutils", "sqlite3", "multiprocessing",
+                "concurrent.futures", "numpy", "pyarrow", "zstandard",
+                "resource"]
+
+
+def test_entry_point_imports():
+    _, modules = import_profile("collect_columns.collect_columns")
+    loaded = [module for module in modules
+              if any(module == lazy or module.startswith(lazy + ".")
+                     for lazy in LAZY_MODULES)]
+    assert loaded == []
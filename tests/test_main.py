@@ -101,6 +101,19 @@ def test_main_stringtie_sum(tmpdir):
     assert result == expected_result
 
 
+def test_main_threads(tmpdir):
+    sample1 = str(datadir / Path("htseq") / Path("sample1.fragments_per_gene"))
+    sample2 = str(datadir / Path("htseq") / Path("sample2.fragments_per_gene"))
+    serial_output = tmpdir.join("serial.tsv")
+    parallel_output = tmpdir.join("parallel.tsv")
+    sys.argv = ["script", serial_output.strpath, sample1, sample2]
+    main()
+    sys.argv = ["script", parallel_output.strpath, sample1, sample2, "-j",
+                "2"]
+    main()
+    assert serial_output.read() == parallel_output.read()
+
+
 def test_main_semicolon(tmpdir):
     sample1 = str(datadir / Path("semicolon") / Path("sample1.csv"))
     sample2 = str(datadir / Path("semicolon") / Path("sample2.csv"))
@@ -124,6 +137,29 @@ def test_main_semicolon(tmpdir):
     assert result == expected_result
 
 
+def test_main_feature_type_early_exit(tmpdir):
+    sample1 = str(datadir / Path("stringtie") / Path("sample1.abundance"))
+    gtf = str(datadir / Path("merged.gtf"))
+    expected_result = set([
+        "feature\tref_gene_id\tsample1.abundance\n",
+        # The second transcript of MSTRG.1 is read before MSTRG.6 has
+        # been found.
+        "MSTRG.1\tg_1;g_7\t185151.953125\n",
+        "MSTRG.2\tg_2\t100160.070312\n",
+        "MSTRG.3\tg_3\t91229.078125\n",
+        "MSTRG.4\tg_4\t184648.109375\n",
+        "MSTRG.5\tg_5\t104290.078125\n",
+        "MSTRG.6\tg_6\t89926.898438\n"])
+    output_file = tmpdir.join("output.tsv")
+    sys.argv = ["script", output_file.strpath, sample1, "-c", "7", "-H",
+                "-g", gtf, "-a", "ref_gene_id", "-t", "transcript",
+                "--early-exit"]
+    main()
+    with output_file.open() as out_file:
+        result = set(out_file.readlines())
+    assert result == expected_result
+
+
 def test_parse_args_a_but_no_g(capsys):
     with pytest.raises(SystemExit):
         sys.argv = ["script", "output", "input", "-a", "attribute"]
@@ -140,13 +176,14 @@ def test_parse_args_defaults():
     assert args.table == [Path("input")]
     assert args.output == Path("output")
     assert args.feature_column == 0
-    assert args.value_column == 1
+    assert args.value_column == [1]
     assert args.sep == "\t"
     assert args.names is None
     assert args.header is False
     assert args.gtf is None
     assert args.additional_attributes is None
     assert args.feature_attribute == "gene_id"
+    assert args.threads == 1
 
 
 def test_collect_columns_incorrect_number_of_names():
@@ -156,3 +193,296 @@ def test_collect_columns_incorrect_number_of_names():
     with pytest.raises(ValueError, match="The number of names did not match "
                                          "the number of inputs."):
         main()
+
+
+def test_main_append_to_text(tmpdir):
+    sample1 = str(datadir / Path("htseq") / Path("sample1.fragments_per_gene"))
+    sample2 = str(datadir / Path("htseq") / Path("sample2.fragments_per_gene"))
+    existing = tmpdir.join("existing.tsv")
+    appended = tmpdir.join("appended.tsv")
+    expected = tmpdir.join("expected.tsv")
+    sys.argv = ["script", existing.strpath, sample1, "-n", "s1"]
+    main()
+    sys.argv = ["script", appended.strpath, sample2, "-n", "s2",
+                "--append-to", existing.strpath]
+    main()
+    sys.argv = ["script", expected.strpath, sample1, sample2, "-n", "s1",
+                "s2"]
+    main()
+    assert appended.read() == expected.read()
+
+
+def test_main_append_to_text_derived_values(tmpdir):
+    sample1 = tmpdir.join("sample1.tsv")
+    sample1.write("a\t1\nb\t3\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("a\t2\nc\t4\n")
+    existing = tmpdir.join("existing.tsv")
+    appended = tmpdir.join("appended.tsv")
+    expected = tmpdir.join("expected.tsv")
+    sys.argv = ["script", existing.strpath, sample1.strpath, "-n", "s1"]
+    main()
+    flags = ["--value-type", "int", "--min-count", "2", "--totals"]
+    sys.argv = ["script", appended.strpath, sample2.strpath, "-n", "s2",
+                "--append-to", existing.strpath] + flags + [
+                tmpdir.join("appended_totals.tsv").strpath]
+    main()
+    sys.argv = ["script", expected.strpath, sample1.strpath,
+                sample2.strpath, "-n", "s1", "s2"] + flags + [
+                tmpdir.join("expected_totals.tsv").strpath]
+    main()
+    assert appended.read() == expected.read()
+    assert (tmpdir.join("appended_totals.tsv").read() ==
+            tmpdir.join("expected_totals.tsv").read() ==
+            "column\ttotal\ns1\t4\ns2\t6\n")
+
+    # Annotation columns which are not given with -a are value columns.
+    annotated = tmpdir.join("annotated.tsv")
+    annotated.write("feature\tgene_name\ts1\na\tA\t1\n")
+    sys.argv = ["script", appended.strpath, sample2.strpath, "-n", "s2",
+                "--append-to", annotated.strpath, "--value-type", "int",
+                "--min-count", "1"]
+    with pytest.raises(ValueError, match="Column gene_name is not numeric"):
+        main()
+
+
+def test_main_append_to_native(tmpdir):
+    from collect_columns.formats import read_native
+    sample1 = str(datadir / Path("stringtie") / Path("sample1.abundance"))
+    gtf = str(datadir / Path("merged.gtf"))
+    new_sample = tmpdir.join("new_sample.tsv")
+    new_sample.write("MSTRG.2\t5\nMSTRG.99\t7\n")
+    output = tmpdir.join("output.ccm")
+    sys.argv = ["script", output.strpath, sample1, "-c", "7", "-H", "-S",
+                "-n", "s1", "-g", gtf, "-a", "gene_name"]
+    main()
+    # The output may replace the table it appends to.
+    sys.argv = ["script", output.strpath, new_sample.strpath, "-S",
+                "-n", "s2", "-g", gtf, "-a", "gene_name",
+                "--append-to", output.strpath]
+    main()
+    table, annotation_names, column_names = read_native(Path(output.strpath))
+    assert annotation_names == ["gene_name"]
+    assert column_names == ["s1", "s2"]
+    rows = list(table.iter_rows(["gene_name", "s1", "s2"]))
+    assert len(rows) == 7
+    assert rows[1] == ["MSTRG.2", "gene_2", 100160.070312, 5.0]
+    assert rows[6] == ["MSTRG.99", None, None, 7.0]
+
+    sys.argv = ["script", output.strpath, new_sample.strpath, "-n", "s1",
+                "--append-to", output.strpath]
+    with pytest.raises(ValueError, match="already has a column named s1"):
+        main()
+
+
+@pytest.mark.parametrize(["value_type", "expected"], [
+    ([], "feature\ts1\ts2\na\t1.0\t2.0\nb\t3.0\t\nc\t\t4.0\n"),
+    (["--value-type", "int"], "feature\ts1\ts2\na\t1\t2\nb\t3\t\nc\t\t4\n")])
+def test_main_append_to_native_value_type(tmpdir, value_type, expected):
+    sample1 = tmpdir.join("sample1.tsv")
+    sample1.write("a\t1\nb\t3\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("a\t2\nc\t4\n")
+    existing = tmpdir.join("existing.ccm")
+    appended = tmpdir.join("appended.tsv")
+    sys.argv = ["script", existing.strpath, sample1.strpath,
+                "-n", "s1"] + value_type
+    main()
+    # The new column gets the type of the existing one.
+    sys.argv = ["script", appended.strpath, sample2.strpath, "-n", "s2",
+                "--append-to", existing.strpath]
+    main()
+    assert appended.read() == expected
+
+
+def test_main_append_text_to_native(tmpdir):
+    from collect_columns.formats import read_native
+    from collect_columns.merged_table import NumericColumn
+    sample1 = tmpdir.join("sample1.tsv")
+    sample1.write("a\t1\nb\t3\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("a\t2\nc\t4\n")
+    existing = tmpdir.join("existing.tsv")
+    appended = tmpdir.join("appended.ccm")
+    sys.argv = ["script", existing.strpath, sample1.strpath, "-n", "s1"]
+    main()
+    sys.argv = ["script", appended.strpath, sample2.strpath, "-n", "s2",
+                "--append-to", existing.strpath]
+    main()
+    table, _, column_names = read_native(Path(appended.strpath))
+    assert column_names == ["s1", "s2"]
+    # The values read back from text are stored as floats, like the new
+    # ones.
+    assert all(isinstance(table.columns[name], NumericColumn) and
+               table.columns[name].values.typecode == "d"
+               for name in column_names)
+    assert list(table.iter_rows(column_names)) == [
+        ["a", 1.0, 2.0], ["b", 3.0, None], ["c", None, 4.0]]
+
+
+def test_main_profile(tmpdir, capsys):
+    import json
+    sample1 = str(datadir / Path("stringtie") / Path("sample1.abundance"))
+    sample2 = str(datadir / Path("stringtie") / Path("sample2.abundance"))
+    gtf = str(datadir / Path("merged.gtf"))
+    output_file = tmpdir.join("output.tsv")
+    profile = tmpdir.join("profile.json")
+    sys.argv = ["script", output_file.strpath, sample1, sample2, "-c", "7",
+                "-H", "-S", "-g", gtf, "-a", "gene_name", "--profile",
+                profile.strpath, "--verbose-stats"]
+    main()
+    stats = json.loads(profile.read())
+    assert json.loads(capsys.readouterr().err)["inputs"] == stats["inputs"]
+    assert [stage["stage"] for stage in stats["stages"]] == [
+        "merge", "annotate", "write"]
+    assert all(stage["seconds"] >= 0 and stage["peak_rss"] > 0
+               for stage in stats["stages"])
+    assert [(table["records"], table["duplicates"])
+            for table in stats["inputs"]] == [(6, 0), (7, 1)]
+    assert stats["inputs"][0]["bytes"] == Path(sample1).stat().st_size
+    assert stats["records"] == 13
+
+
+def test_main_profile_without_resource(tmpdir, monkeypatch):
+    import json
+    # The resource module is not available on Windows.
+    monkeypatch.setitem(sys.modules, "resource", None)
+    sample1 = str(datadir / Path("stringtie") / Path("sample1.abundance"))
+    output_file = tmpdir.join("output.tsv")
+    profile = tmpdir.join("profile.json")
+    sys.argv = ["script", output_file.strpath, sample1, "-c", "7", "-H",
+                "-S", "--profile", profile.strpath]
+    main()
+    stats = json.loads(profile.read())
+    assert stats["peak_rss"] is None
+    assert all(stage["peak_rss"] is None for stage in stats["stages"])
+
+
+def test_main_profile_sorted_inputs(tmpdir):
+    import json
+    sample1 = tmpdir.join("sample1.tsv")
+    sample1.write("a\t1\nb\t2\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("a\t1\na\t3\nc\t2\n")
+    output_file = tmpdir.join("output.tsv")
+    profile = tmpdir.join("profile.json")
+    sys.argv = ["script", output_file.strpath, sample1.strpath,
+                sample2.strpath, "-n", "s1", "s2", "-S", "--sorted-inputs",
+                "--profile", profile.strpath]
+    main()
+    stats = json.loads(profile.read())
+    assert [stage["stage"] for stage in stats["stages"]] == [
+        "merge_and_write"]
+    assert [(table["name"], table["records"], table["features"],
+             table["duplicates"], table["bytes"])
+            for table in stats["inputs"]] == [
+        ("s1", 2, 2, 0, sample1.size()), ("s2", 3, 2, 1, sample2.size())]
+    assert stats["records"] == 5
+    assert stats["records_per_second"] > 0
+
+
+@pytest.mark.parametrize("flags", [[], ["--sorted-inputs"]])
+def test_main_on_duplicate(tmpdir, flags):
+    sample1 = tmpdir.join("sample1.tsv")
+    sample1.write("a\t1\na\t4\nb\t2\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("b\t3\nb\t1\nb\t2\nc\t5\n")
+    output_file = tmpdir.join("output.tsv")
+    duplicates_file = tmpdir.join("duplicates.tsv")
+    sys.argv = ["script", output_file.strpath, sample1.strpath,
+                sample2.strpath, "-n", "s1", "s2", "--on-duplicate", "max",
+                "--duplicates-file", duplicates_file.strpath] + flags
+    main()
+    assert output_file.read() == ("feature\ts1\ts2\n"
+                                  "a\t4.0\t\n"
+                                  "b\t2.0\t3.0\n"
+                                  "c\t\t5.0\n")
+    assert duplicates_file.read() == ("column\tfeature\trecords\n"
+                                      "s1\ta\t2\n"
+                                      "s2\tb\t3\n")
+
+
+def test_parse_args_sum_on_duplicate_conflict(capsys):
+    sys.argv = ["script", "output", "input", "-S", "--on-duplicate", "first"]
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert "-S cannot be combined with --on-duplicate first" in (
+        capsys.readouterr().err)
+
+
+def test_main_value_type_derived(tmpdir):
+    sample1 = tmpdir.join("sample1.tsv")
+    sample1.write("id\tlength\tcount\na\t1000\t10\nb\t2000\t0\nc\t500\t30\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("id\tlength\tcount\na\t1000\t30\nc\t500\t10\n")
+    output_file = tmpdir.join("output.tsv")
+    totals_file = tmpdir.join("totals.tsv")
+    base = ["script", output_file.strpath, sample1.strpath, sample2.strpath,
+            "-H", "-c", "2", "-n", "s1", "s2", "--value-type", "int"]
+    sys.argv = base + ["--totals", totals_file.strpath, "--min-count", "5"]
+    main()
+    assert output_file.read() == ("feature\ts1\ts2\n"
+                                  "a\t10\t30\n"
+                                  "c\t30\t10\n")
+    assert totals_file.read() == "column\ttotal\ns1\t40\ns2\t40\n"
+    sys.argv = base + ["--normalize", "cpm", "--min-count", "20",
+                       "--min-samples", "2"]
+    main()
+    assert output_file.read() == "feature\ts1\ts2\n"
+    sys.argv = base + ["--normalize", "tpm", "--length-column", "1"]
+    main()
+    assert output_file.read() == ("feature\ts1\ts2\n"
+                                  "a\t142857.14285714287\t600000.0\n"
+                                  "b\t0.0\t\n"
+                                  "c\t857142.8571428572\t400000.0\n")
+
+
+@pytest.mark.parametrize(["flags", "message"], [
+    (["--min-count", "1"], "require numeric values"),
+    (["--value-type", "string", "-S"], "cannot be added up"),
+    (["-S", "--normalize", "tpm"], "requires --length-column"),
+    (["-S", "--totals", "t", "--sorted-inputs"], "cannot be used with")])
+def test_parse_args_derived_values_errors(capsys, flags, message):
+    sys.argv = ["script", "output", "input"] + flags
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert message in capsys.readouterr().err
+
+
+def test_main_multiple_value_columns(tmpdir):
+    sample1 = tmpdir.join("sample1.tsv")
+    sample1.write("id\tlength\tcount\na\t1000\t10\nb\t2000\t0\n")
+    sample2 = tmpdir.join("sample2.tsv")
+    sample2.write("id\tcount\tlength\na\t30\t1000\n")
+    output_file = tmpdir.join("output.tsv")
+    base = ["script", output_file.strpath, sample1.strpath, sample2.strpath,
+            "-H", "-c", "count", "length", "-n", "s1", "s2"]
+    sys.argv = base
+    main()
+    assert output_file.read() == (
+        "feature\tcount_s1\tcount_s2\tlength_s1\tlength_s2\n"
+        "a\t10\t30\t1000\t1000\n"
+        "b\t0\t\t2000\t\n")
+    sys.argv = base + ["--separate-outputs"]
+    main()
+    assert tmpdir.join("output.count.tsv").read() == ("feature\ts1\ts2\n"
+                                                      "a\t10\t30\n"
+                                                      "b\t0\t\n")
+    assert tmpdir.join("output.length.tsv").read() == ("feature\ts1\ts2\n"
+                                                       "a\t1000\t1000\n"
+                                                       "b\t2000\t\n")
+
+
+@pytest.mark.parametrize(["flags", "message"], [
+    (["-c", "TPM"], "by name with -H"),
+    (["-c", "1", "2", "--sorted-inputs"], "a single value column"),
+    (["-c", "1", "2", "--separate-outputs", "--append-to", "t"],
+     "cannot be used with --append-to"),
+    (["-c", "7", "7"], "each value column can only be given once"),
+    (["-H", "-c", "TPM", "1", "TPM"],
+     "each value column can only be given once")])
+def test_parse_args_value_column_errors(capsys, flags, message):
+    sys.argv = ["script", "output", "input"] + flags
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert message in capsys.readouterr().err
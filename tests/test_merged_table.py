@@ -0,0 +1,329 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from pathlib import Path
+from warnings import catch_warnings
+
+import pytest
+
+from collect_columns import collect_columns as collect_columns_module
+from collect_columns.collect_columns import (add_additional_attributes,
+                                             collect_columns, merge_tables,
+                                             parse_table)
+from collect_columns.merged_table import MergedTable, ParsedTable
+
+
+datadir = Path(__file__).parent / Path("data")
+
+
+def test_merged_table_rows():
+    table = MergedTable()
+    table.add_table("s1", [("a", "1"), ("b", "2")], False)
+    table.add_table("s2", [("c", "3"), ("a", "4")], False)
+    assert table.features == ["a", "b", "c"]
+    assert list(table.iter_rows(["s1", "s2"])) == [
+        ["a", "1", "4"],
+        ["b", "2", None],
+        ["c", None, "3"]]
+
+
+def test_merged_table_shares_string_values():
+    table = MergedTable()
+    table.add_table("s1", [("a", "0"), ("b", "0")], False)
+    table.add_table("s2", [("a", "0"), ("b", "1")], False)
+    assert table.pool.strings == ["0", "1"]
+
+
+def test_merged_table_sum_on_duplicate_id():
+    table = MergedTable()
+    table.add_table("s1", [("a", "1"), ("b", "2"), ("a", "0.5")], True)
+    assert list(table.iter_rows(["s1"])) == [["a", 1.5], ["b", 2.0]]
+    assert table.to_dict() == {"a": {"s1": "1.5"}, "b": {"s1": "2.0"}}
+
+
+def test_merged_table_duplicate_warning():
+    table = MergedTable()
+    with catch_warnings(record=True) as warnings:
+        table.add_table("s1", [("a", "1"), ("a", "2")], False)
+        assert ("duplicate values for 1 row in s1, only the last value is "
+                "kept: a" == str(warnings[0].message))
+    assert table.to_dict() == {"a": {"s1": "2"}}
+
+
+def test_merged_table_to_numpy():
+    numpy = pytest.importorskip("numpy")
+    table = MergedTable()
+    table.add_table("s1", [("a", "1"), ("b", "2")], True)
+    table.add_table("s2", [("c", "3")], True)
+    matrix = table.to_numpy(["s1", "s2"])
+    assert matrix.shape == (3, 2)
+    assert numpy.isnan(matrix[2, 0])
+    assert matrix[2, 1] == 3.0
+
+
+def test_merge_tables_matches_collect_columns():
+    tables = [datadir / Path("semicolon") / Path("sample1.csv"),
+              datadir / Path("semicolon") / Path("sample2.csv")]
+    for sum_on_duplicate_id in (False, True):
+        merged = merge_tables(tables, 1, 0, ";", ["sample1", "sample2"],
+                              True, sum_on_duplicate_id)
+        assert merged.to_dict() == collect_columns(
+            tables, 1, 0, ";", ["sample1", "sample2"], True,
+            sum_on_duplicate_id)
+
+
+def test_add_additional_attributes_merged_table():
+    gtf = datadir / Path("merged.gtf")
+    table = MergedTable()
+    table.add_table("sample1", [("MSTRG.1", "1"), ("MSTRG.7", "7")], False)
+    add_additional_attributes(table, gtf, "gene_id", ["gene_name"])
+    assert list(table.iter_rows(["gene_name", "sample1"])) == [
+        ["MSTRG.1", "gene_1;gene_7", "1"],
+        ["MSTRG.7", None, "7"]]
+
+
+def test_merged_table_to_dict_skips_missing_values():
+    table = MergedTable()
+    table.add_table("s1", [("a", "1")], True)
+    table.add_table("s2", [("b", "2")], True)
+    table.add_table("s3", [("c", "3"), ("a", "4")], False)
+    assert table.to_dict() == {"a": {"s1": "1.0", "s3": "4"},
+                               "b": {"s2": "2.0"},
+                               "c": {"s3": "3"}}
+
+
+def test_merge_tables_threads():
+    tables = [datadir / Path("stringtie") / Path("sample1.abundance"),
+              datadir / Path("stringtie") / Path("sample2.abundance"),
+              datadir / Path("stringtie") / Path("sample2.abundance")]
+    names = ["sample1", "sample2", "sample3"]
+    for sum_on_duplicate_id in (False, True):
+        with catch_warnings(record=True) as warnings:
+            merged = merge_tables(tables, 0, 7, "\t", names, True,
+                                  sum_on_duplicate_id, threads=2)
+        assert merged.to_dict() == collect_columns(
+            tables, 0, 7, "\t", names, True, sum_on_duplicate_id)
+        assert list(merged.columns) == names
+        if not sum_on_duplicate_id:
+            assert [str(warning.message) for warning in warnings] == [
+                "duplicate values for 1 row in sample2, only the last "
+                "value is kept: MSTRG.6",
+                "duplicate values for 1 row in sample3, only the last "
+                "value is kept: MSTRG.6"]
+
+
+@pytest.mark.parametrize(["records", "numeric"], [
+    ([("a", "1"), ("b", "2.5"), ("a", "3")], True),
+    ([("a", "1"), ("b", "2"), ("a", "3")], "q"),
+    ([("a", "1"), ("b", "x"), ("a", ""), ("é", "ü")], False)])
+def test_parsed_table_bytes_round_trip(records, numeric):
+    if numeric == "q":
+        table = ParsedTable.from_records(records, True, typecode="q")
+    else:
+        table = ParsedTable.from_records(records, numeric)
+    result = ParsedTable.from_bytes(table.to_bytes())
+    assert result.features == table.features
+    assert result.indices == table.indices
+    assert result.values == table.values
+
+
+def test_parsed_table_bytes_empty():
+    result = ParsedTable.from_bytes(
+        ParsedTable.from_records([], False).to_bytes())
+    assert result.features == []
+    assert result.values == []
+
+
+def test_parse_table_cache(tmpdir, monkeypatch):
+    cache_dir = Path(tmpdir.strpath) / "cache"
+    cache_dir.mkdir()
+    table = datadir / Path("stringtie") / Path("sample1.abundance")
+    copy = Path(tmpdir.strpath) / "copy.abundance"
+    copy.write_bytes(table.read_bytes())
+    expected = parse_table(table, 0, 7, "\t", True, True, cache_dir)
+    assert len(list(cache_dir.iterdir())) == 1
+
+    def fail(*args):
+        raise AssertionError("table was parsed again")
+
+    # A table with the same contents is loaded from the cache.
+    monkeypatch.setattr(collect_columns_module, "_parse_columns", fail)
+    result = parse_table(copy, 0, 7, "\t", True, True, cache_dir)
+    assert result.features == expected.features
+    assert result.values == expected.values
+    with pytest.raises(AssertionError):
+        parse_table(copy, 0, 6, "\t", True, True, cache_dir)
+
+
+def test_merge_tables_cache(tmpdir):
+    cache_dir = Path(tmpdir.strpath) / "cache"
+    tables = [datadir / Path("htseq") / Path("sample1.fragments_per_gene"),
+              datadir / Path("htseq") / Path("sample2.fragments_per_gene")]
+    expected = merge_tables(tables, 0, 1, "\t", ["s1", "s2"], False, False)
+    for _ in range(2):
+        result = merge_tables(tables, 0, 1, "\t", ["s1", "s2"], False,
+                              False, cache_dir=cache_dir)
+        assert result.to_dict() == expected.to_dict()
+    assert len(list(cache_dir.iterdir())) == 2
+    merge_tables(tables, 0, 1, "\t", ["s1", "s2"], False, False,
+                 cache_dir=cache_dir, cache_size=0)
+    assert list(cache_dir.iterdir()) == []
+
+
+def test_merge_tables_cache_shared_directory(tmpdir):
+    # The tables themselves, and other files, are not cache entries.
+    cache_dir = Path(tmpdir.strpath)
+    tables = []
+    for name in ("a.tsv", "b.tsv"):
+        table = cache_dir / name
+        table.write_text("x\t1\ny\t2\n")
+        tables.append(table)
+    notes = cache_dir / "notes.txt"
+    notes.write_text("keep me")
+    index = cache_dir / ("0" * 64 + ".sqlite")
+    index.write_text("index")
+    merge_tables(tables, 0, 1, "\t", ["a", "b"], False, False,
+                 cache_dir=cache_dir, cache_size=0)
+    assert sorted(cache_dir.iterdir()) == sorted(tables + [notes, index])
+
+
+@pytest.mark.parametrize(["policy", "expected"], [
+    ("last", {"a": "3", "b": "2", "c": "4"}),
+    ("first", {"a": "1", "b": "2", "c": "5"}),
+    ("sum", {"a": "6.0", "b": "2.0", "c": "9.0"}),
+    ("max", {"a": "3.0", "b": "2.0", "c": "5.0"}),
+    ("mean", {"a": "2.0", "b": "2.0", "c": "4.5"})])
+def test_merged_table_on_duplicate(policy, expected):
+    records = [("a", "1"), ("b", "2"), ("c", "5"), ("a", "2"), ("a", "3"),
+               ("c", "4")]
+    table = MergedTable()
+    with catch_warnings(record=True) as warnings:
+        table.add_table("s1", records, False, policy)
+    assert {feature: values["s1"] for feature, values
+            in table.to_dict().items()} == expected
+    assert table.features == ["a", "b", "c"]
+    assert table.duplicates == [("s1", "a", 3), ("s1", "c", 2)]
+    if policy in ("last", "first"):
+        assert [str(warning.message) for warning in warnings] == [
+            "duplicate values for 2 rows in s1, only the {} value is kept: "
+            "a, c".format(policy)]
+    else:
+        assert warnings == []
+
+
+def test_merged_table_on_duplicate_error():
+    table = MergedTable()
+    with pytest.raises(ValueError, match="duplicate values for 1 row in s1: "
+                                         "a"):
+        table.add_table("s1", [("a", "1"), ("a", "2")], False, "error")
+    table.add_table("s1", [("a", "1"), ("b", "2")], False, "error")
+    assert table.duplicates == []
+
+
+def test_merged_table_duplicate_warning_truncated():
+    records = [(str(i), "1") for i in range(7)] * 2
+    with catch_warnings(record=True) as warnings:
+        MergedTable().add_table("s1", records, False)
+    assert str(warnings[0].message) == (
+        "duplicate values for 7 rows in s1, only the last value is kept: "
+        "0, 1, 2, 3, 4, ...")
+
+
+def test_merged_table_int_values():
+    table = MergedTable()
+    table.add_parsed_table("s1", ParsedTable.from_records(
+        [("a", "1"), ("b", "2"), ("a", "3")], True, typecode="q"), False,
+        "sum")
+    table.add_parsed_table("s2", ParsedTable.from_records(
+        [("a", "1"), ("a", "2")], True, typecode="q"), False, "mean")
+    assert table.columns["s1"].values.typecode == "q"
+    assert table.columns["s2"].values.typecode == "d"
+    assert list(table.iter_rows(["s1", "s2"])) == [["a", 4, 1.5],
+                                                   ["b", 2, None]]
+    assert table.totals(["s1", "s2"]) == [6, 1.5]
+
+
+def numeric_table():
+    table = MergedTable()
+    table.add_table("s1", [("a", "10"), ("b", "0"), ("c", "30")], True)
+    table.add_table("s2", [("a", "5"), ("c", "15")], True)
+    table.add_values("name", {"a": "A", "b": "B"})
+    return table
+
+
+def test_merged_table_filter_rows():
+    table = numeric_table()
+    assert table.filter_rows(["s1", "s2"], 10, 1) == [0, 2]
+    assert table.filter_rows(["s1", "s2"], 10, 2) == [2]
+    assert table.filter_rows(["s1", "s2"], 0, 2) == [0, 2]
+    with pytest.raises(TypeError):
+        table.filter_rows(["name"], 1, 1)
+
+
+def test_merged_table_normalize():
+    table = numeric_table()
+    table.normalize(["s1", "s2"], "cpm")
+    assert list(table.iter_rows(["s1", "s2"])) == [
+        ["a", 250000.0, 250000.0], ["b", 0.0, None],
+        ["c", 750000.0, 750000.0]]
+    table = numeric_table()
+    table.normalize(["s1"], "tpm", {"a": 1.0, "b": 1.0, "c": 3.0})
+    assert [row[1] for row in table.iter_rows(["s1"])] == [
+        500000.0, 0.0, 500000.0]
+    with pytest.raises(ValueError, match="No length is known for c"):
+        table.normalize(["s1"], "tpm", {"a": 1.0, "b": 1.0})
+
+
+def test_merged_table_select_rows():
+    table = numeric_table().select_rows([2, 1])
+    assert table.features == ["c", "b"]
+    assert list(table.iter_rows(["name", "s1", "s2"])) == [
+        ["c", None, 30.0, 15.0], ["b", "B", 0.0, None]]
+
+
+def sparse_table():
+    table = MergedTable()
+    for name, records in (("s1", [("a", "10"), ("b", "0"), ("c", "30")]),
+                          ("s2", [("a", "5"), ("c", "15")])):
+        table.add_parsed_table(
+            name, ParsedTable.from_records(records, True), True, sparse=True)
+    table.add_values("name", {"a": "A", "b": "B"})
+    return table
+
+
+def test_merged_table_sparse():
+    table = sparse_table()
+    assert list(table.columns["s1"].rows) == [0, 2]
+    assert list(table.columns["s2"].rows) == [0, 2]
+    assert list(table.iter_rows(["s1", "s2"])) == [
+        ["a", 10.0, 5.0], ["b", 0.0, 0.0], ["c", 30.0, 15.0]]
+    assert table.totals(["s1", "s2"]) == [40.0, 20.0]
+    assert table.filter_rows(["s1", "s2"], 10, 1) == [0, 2]
+    assert table.filter_rows(["s1", "s2"], 0, 2) == [0, 1, 2]
+    selected = table.select_rows([2, 1])
+    assert list(selected.iter_rows(["name", "s1"])) == [
+        ["c", None, 30.0], ["b", "B", 0.0]]
+    assert list(selected.columns["s1"].rows) == [0]
+    table.normalize(["s1"], "tpm", {"a": 1.0, "b": 1.0, "c": 3.0})
+    assert [row[1] for row in table.iter_rows(["s1"])] == [
+        500000.0, 0.0, 500000.0]
+    with pytest.raises(ValueError, match="require numeric values"):
+        table.add_parsed_table("s3", ParsedTable.from_records(
+            [("a", "x")], False), False, sparse=True)
@@ -0,0 +1,98 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import gzip
+import threading
+import time
+from pathlib import Path
+
+from collect_columns.collect_columns import merge_tables, parse_columns
+from collect_columns.prefetch import read_ahead
+
+
+class SlowReader(object):
+    """Reads files like a slow network file system would."""
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, path: Path) -> bytes:
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        return path.read_bytes()
+
+
+def test_read_ahead(tmpdir):
+    paths = []
+    for i in range(6):
+        path = Path(tmpdir.strpath) / "table{}.tsv".format(i)
+        path.write_text("feature\t{}\n".format(i))
+        paths.append(path)
+    reader = SlowReader(0.05)
+    contents = list(read_ahead(paths, 3, reader))
+    assert contents == [path.read_bytes() for path in paths]
+    assert 1 < reader.max_active <= 3
+
+
+def test_read_ahead_stops_early(tmpdir):
+    paths = []
+    for i in range(6):
+        path = Path(tmpdir.strpath) / "table{}.tsv".format(i)
+        path.write_text(str(i))
+        paths.append(path)
+    reader = SlowReader(0.01)
+    files = read_ahead(paths, 2, reader)
+    assert next(files) == b"0"
+    files.close()
+    assert reader.active == 0
+
+
+def test_parse_columns_data(tmpdir):
+    contents = b"id\tcount\na\t1\nb\t\"2\"\n"
+    table = Path(tmpdir.strpath) / "table.tsv.gz"
+    with gzip.open(str(table), "wb") as table_file:
+        table_file.write(contents)
+    # The given contents are parsed, also when they are compressed.
+    for data in (contents, table.read_bytes()):
+        parsed, = parse_columns(table, 0, ["count"], "\t", True, True,
+                                data=data)
+        assert parsed.features == ["a", "b"]
+        assert list(parsed.values) == [1.0, 2.0]
+
+
+def test_merge_tables_prefetch(tmpdir):
+    tables = []
+    for i in range(4):
+        table = Path(tmpdir.strpath) / "table{}.tsv".format(i)
+        table.write_text("a\t{}\nb\t{}\n".format(i, i * 2))
+        tables.append(table)
+    names = ["s0", "s1", "s2", "s3"]
+    expected = merge_tables(tables, 0, 1, "\t", names, False, False)
+    merged = merge_tables(tables, 0, 1, "\t", names, False, False,
+                          prefetch=2)
+    assert merged.to_dict() == expected.to_dict()
+    assert list(merged.columns) == names
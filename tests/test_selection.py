@@ -0,0 +1,123 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import gzip
+from pathlib import Path
+import sys
+
+import pytest
+
+from collect_columns.collect_columns import (main, merge_tables, parse_args,
+                                             parse_table)
+from collect_columns.selection import FeatureSelection
+
+
+datadir = Path(__file__).parent / Path("data")
+records = [("MSTRG.1", "1"), ("MSTRG.12", "2"), ("__no_feature", "3")]
+
+
+def test_feature_selection_features():
+    selection = FeatureSelection(["MSTRG.1", "__no_feature"])
+    assert list(selection.filter(records)) == [records[0], records[2]]
+
+
+def test_feature_selection_pattern():
+    selection = FeatureSelection(pattern=r"^MSTRG\.1")
+    assert list(selection.filter(records)) == records[:2]
+
+
+def test_feature_selection_both():
+    selection = FeatureSelection(["MSTRG.1", "__no_feature"], "MSTRG")
+    assert list(selection.filter(records)) == [records[0]]
+
+
+def test_feature_selection_bytes():
+    selection = FeatureSelection(["géne"], "ne$")
+    byte_records = [("géne".encode(), b"1"), (b"gene", b"2")]
+    assert list(selection.filter(byte_records, "utf-8")) == [
+        byte_records[0]]
+
+
+def test_feature_selection_unicode_pattern(tmpdir):
+    selection = FeatureSelection(pattern=r"^\w+$")
+    byte_records = [("gène1".encode(), b"1"), (b"gene-2", b"2")]
+    assert list(selection.filter(byte_records, "utf-8")) == [
+        byte_records[0]]
+    assert list(selection.filter([("gène1", "1")])) == [("gène1", "1")]
+    table = tmpdir.join("r1.tsv")
+    table.write_text("gène1\t1\ngene-2\t2\n", encoding="utf-8")
+    compressed = tmpdir.join("r1.tsv.gz")
+    with gzip.open(compressed.strpath, "wt", encoding="utf-8") as gz_file:
+        gz_file.write("gène1\t1\ngene-2\t2\n")
+    for pattern in (r"^\w+$", r"(?u)^\w+$"):
+        selection = FeatureSelection(pattern=pattern)
+        for path in (table, compressed):
+            assert parse_table(Path(path.strpath), 0, 1, "\t", False, False,
+                               selection=selection).features == ["gène1"]
+
+
+def test_feature_selection_from_file(tmpdir):
+    features_file = tmpdir.join("features.txt")
+    features_file.write("MSTRG.1\n\nMSTRG.2 \n")
+    selection = FeatureSelection.from_file(Path(features_file.strpath))
+    assert selection.features == {"MSTRG.1", "MSTRG.2"}
+    assert selection.key() == FeatureSelection(
+        ["MSTRG.2", "MSTRG.1"]).key()
+    assert selection.key() != FeatureSelection(["MSTRG.1"]).key()
+
+
+def test_merge_tables_selection(tmpdir):
+    tables = [datadir / Path("htseq") / Path("sample1.fragments_per_gene"),
+              datadir / Path("htseq") / Path("sample2.fragments_per_gene")]
+    selection = FeatureSelection(pattern="^__")
+    merged = merge_tables(tables, 0, 1, "\t", ["s1", "s2"], False, False,
+                          selection=selection)
+    assert merged.features == ["__no_feature", "__ambiguous",
+                               "__too_low_aQual", "__not_aligned",
+                               "__alignment_not_unique"]
+    cache_dir = Path(tmpdir.strpath)
+    parse_table(tables[0], 0, 1, "\t", False, False, cache_dir,
+                selection=selection)
+    assert parse_table(tables[0], 0, 1, "\t", False, False,
+                       cache_dir).features[0] == "MSTRG.1"
+    assert len(list(cache_dir.iterdir())) == 2
+
+
+@pytest.mark.parametrize("flags", [[], ["--sorted-inputs"]])
+def test_main_features_file(tmpdir, flags):
+    sample1 = str(datadir / Path("stringtie") / Path("sample1.abundance"))
+    sample2 = str(datadir / Path("stringtie") / Path("sample2.abundance"))
+    features_file = tmpdir.join("features.txt")
+    features_file.write("MSTRG.2\nMSTRG.5\nMSTRG.6\n")
+    output_file = tmpdir.join("output.tsv")
+    sys.argv = ["script", output_file.strpath, sample1, sample2, "-c", "7",
+                "-H", "-S", "-n", "s1", "s2", "--features-file",
+                features_file.strpath, "--feature-regex", "[25]$"] + flags
+    main()
+    assert output_file.read() == ("feature\ts1\ts2\n"
+                                  "MSTRG.2\t100160.070312\t160.070312\n"
+                                  "MSTRG.5\t104290.078125\t4290.078125\n")
+
+
+def test_parse_args_invalid_feature_regex(capsys):
+    sys.argv = ["script", "output", "input", "--feature-regex", "("]
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert "invalid --feature-regex" in capsys.readouterr().err
@@ -0,0 +1,119 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from pathlib import Path
+import sys
+
+import pytest
+
+from collect_columns.collect_columns import main
+from collect_columns.shards import Shard, combine_shards, combined_features
+
+
+datadir = Path(__file__).parent / Path("data")
+TABLES = ["MSTRG.3\t3\nMSTRG.1\t1\n",
+          "MSTRG.2\t2\nMSTRG.3\t4\nMSTRG.3\t5\n",
+          "MSTRG.6\t6\n",
+          "MSTRG.1\t7\nMSTRG.4\t8\n"]
+
+
+def write_tables(tmpdir):
+    tables = []
+    for i, contents in enumerate(TABLES):
+        table = tmpdir.join("table{}.tsv".format(i))
+        table.write(contents)
+        tables.append(table.strpath)
+    return tables
+
+
+@pytest.mark.parametrize("flags", [
+    [],
+    ["--value-type", "int"],
+    ["-S"],
+    ["-S", "--sort", "natural"],
+    ["-a", "gene_name", "-g", str(datadir / Path("merged.gtf")),
+     "--sort", "gtf-order"]])
+def test_partial_combine(tmpdir, flags):
+    tables = write_tables(tmpdir)
+    names = ["s0", "s1", "s2", "s3"]
+    # Options for the combine step are not accepted by partial.
+    combine_flags = [flag for flag in flags
+                     if flag not in ("--value-type", "int", "-S")]
+    parse_flags = [flag for flag in flags if flag not in combine_flags]
+    single = tmpdir.join("single.tsv")
+    sys.argv = ["script", single.strpath] + tables + ["-n"] + names + flags
+    main()
+    shards = []
+    for i in (0, 2):
+        shard = tmpdir.join("shard{}.ccm".format(i))
+        sys.argv = (["script", "partial", shard.strpath] + tables[i:i + 2] +
+                    ["-n"] + names[i:i + 2] + parse_flags)
+        main()
+        shards.append(shard.strpath)
+    combined = tmpdir.join("combined.tsv")
+    sys.argv = ["script", "combine", combined.strpath] + shards + combine_flags
+    main()
+    assert combined.read() == single.read()
+
+
+def test_combine_shards(tmpdir):
+    tables = write_tables(tmpdir)
+    shard_paths = []
+    for i in (0, 2):
+        shard = tmpdir.join("shard{}.ccm".format(i))
+        sys.argv = ["script", "partial", shard.strpath] + tables[i:i + 2] + [
+            "-n", "a{}".format(i), "b{}".format(i), "--value-type", "float"]
+        main()
+        shard_paths.append(Path(shard.strpath))
+    with Shard(shard_paths[0]) as first, Shard(shard_paths[1]) as second:
+        assert first.column_names == ["a0", "b0"]
+        features = combined_features([first, second])
+        assert features == ["MSTRG.3", "MSTRG.1", "MSTRG.2", "MSTRG.6",
+                            "MSTRG.4"]
+        assert list(combine_shards([first, second], features[:3])) == [
+            ["MSTRG.3", 3.0, 5.0, None, None],
+            ["MSTRG.1", 1.0, None, None, 7.0],
+            ["MSTRG.2", None, 2.0, None, None]]
+
+
+@pytest.mark.parametrize(["flags", "message"], [
+    (["-a", "gene_name", "-g", "merged.gtf"], "-a cannot be used"),
+    (["--sort", "lexical"], "--sort cannot be used"),
+    (["--output-format", "text"], "--output-format text cannot be used")])
+def test_partial_unsupported_options(capsys, flags, message):
+    sys.argv = ["script", "partial", "shard.ccm", "input"] + flags
+    with pytest.raises(SystemExit):
+        main()
+    assert message in capsys.readouterr().err
+
+
+def test_combine_repeated_names(tmpdir):
+    tables = write_tables(tmpdir)
+    shards = []
+    for i in (0, 2):
+        shard = tmpdir.join("shard{}.ccm".format(i))
+        sys.argv = ["script", "partial", shard.strpath] + tables[i:i + 2] + [
+            "-n", "a", "b"]
+        main()
+        shards.append(shard.strpath)
+    sys.argv = ["script", "combine", tmpdir.join("out.tsv").strpath] + shards
+    with pytest.raises(ValueError, match="columns named: a, b"):
+        main()
@@ -0,0 +1,102 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from pathlib import Path
+import sys
+
+import pytest
+
+from collect_columns.annotation import read_feature_order
+from collect_columns.collect_columns import (main, natural_key, parse_args,
+                                             sort_table)
+from collect_columns.merged_table import MergedTable
+
+
+datadir = Path(__file__).parent / Path("data")
+
+
+def example_table():
+    table = MergedTable()
+    table.add_table("s1", [("gene10", "1"), ("gene2", "2"), ("Gene3", "3"),
+                           ("gene2a", "4")], False)
+    return table
+
+
+def test_natural_key():
+    assert sorted(["gene10", "gene2", "gene2a", "g1", "10", "9b"],
+                  key=natural_key) == ["9b", "10", "g1", "gene2", "gene2a",
+                                       "gene10"]
+
+
+@pytest.mark.parametrize(["method", "expected"], [
+    ("lexical", ["Gene3", "gene10", "gene2", "gene2a"]),
+    ("natural", ["Gene3", "gene2", "gene2a", "gene10"])])
+def test_sort_table(method, expected):
+    table = sort_table(example_table(), method)
+    assert table.features == expected
+    assert [row[1] for row in table.iter_rows(["s1"])] == [
+        example_table().to_dict()[feature]["s1"] for feature in expected]
+
+
+def test_sort_table_gtf_order():
+    table = sort_table(example_table(), "gtf-order",
+                       {"gene2a": 0, "gene10": 1, "other": 2})
+    assert table.features == ["gene2a", "gene10", "gene2", "Gene3"]
+
+
+def test_read_feature_order():
+    gtf = datadir / Path("merged.gtf")
+    assert read_feature_order(gtf, "ref_gene_id") == {
+        "g_1": 0, "g_7": 1, "g_2": 2, "g_3": 3, "g_4": 4, "g_5": 5, "g_6": 6}
+    assert read_feature_order(gtf, "gene_id", ["MSTRG.6", "MSTRG.2"]) == {
+        "MSTRG.2": 0, "MSTRG.6": 1}
+
+
+def test_main_sort_gtf_order(tmpdir):
+    sample = tmpdir.join("sample.tsv")
+    sample.write("MSTRG.6\t6\nMSTRG.10\t10\nMSTRG.1\t1\nMSTRG.4\t4\n")
+    gtf = str(datadir / Path("merged.gtf"))
+    output_file = tmpdir.join("output.tsv")
+    sys.argv = ["script", output_file.strpath, sample.strpath, "-n", "s1",
+                "--sort", "gtf-order", "-g", gtf, "-a", "gene_name"]
+    main()
+    assert output_file.read() == ("feature\tgene_name\ts1\n"
+                                  "MSTRG.1\tgene_1;gene_7\t1\n"
+                                  "MSTRG.4\tgene_4\t4\n"
+                                  "MSTRG.6\tgene_6\t6\n"
+                                  "MSTRG.10\t\t10\n")
+    sys.argv = ["script", output_file.strpath, sample.strpath, "-n", "s1",
+                "--sort", "natural"]
+    main()
+    assert output_file.read() == ("feature\ts1\n"
+                                  "MSTRG.1\t1\n"
+                                  "MSTRG.4\t4\n"
+                                  "MSTRG.6\t6\n"
+                                  "MSTRG.10\t10\n")
+
+
+@pytest.mark.parametrize(["flags", "message"], [
+    (["--sort", "gtf-order"], "requires -g"),
+    (["--sort", "natural", "--sorted-inputs"], "only be used with --sort")])
+def test_parse_args_sort_errors(capsys, flags, message):
+    sys.argv = ["script", "output", "input"] + flags
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert message in capsys.readouterr().err
@@ -0,0 +1,144 @@
+# Copyright (c) 2019 Leiden University Medical Center
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from pathlib import Path
+import sys
+from warnings import catch_warnings
+
+import pytest
+
+from collect_columns.collect_columns import (collect_columns, main,
+                                             stream_sorted_tables,
+                                             tables_are_sorted)
+
+
+datadir = Path(__file__).parent / Path("data")
+
+
+def rows_to_dict(rows, names):
+    return {row[0]: {name: str(value)
+                     for name, value in zip(names, row[1:])
+                     if value is not None}
+            for row in rows}
+
+
+def test_stream_sorted_tables_semicolon():
+    tables = [datadir / Path("semicolon") / Path("sample1.csv"),
+              datadir / Path("semicolon") / Path("sample2.csv")]
+    names = ["sample1", "sample2"]
+    rows = list(stream_sorted_tables(tables, 1, 0, ";", names, True, False))
+    assert rows[-2:] == [["gene_5", "5", None], ["gene_6", None, "60"]]
+    assert rows_to_dict(rows, names) == collect_columns(
+        tables, 1, 0, ";", names, True, False)
+
+
+def test_stream_sorted_tables_stringtie():
+    tables = [datadir / Path("stringtie") / Path("sample1.abundance"),
+              datadir / Path("stringtie") / Path("sample2.abundance")]
+    names = ["sample1", "sample2"]
+    with catch_warnings(record=True) as warnings:
+        rows = list(stream_sorted_tables(tables, 0, 7, "\t", names, True,
+                                         False))
+        assert "duplicate values for 1 row in sample2, only the last value " \
+               "is kept: MSTRG.6" == str(warnings[0].message)
+    assert rows_to_dict(rows, names) == collect_columns(
+        tables, 0, 7, "\t", names, True, False)
+
+
+def test_stream_sorted_tables_sum_on_duplicate_id():
+    tables = [datadir / Path("stringtie") / Path("sample1.abundance"),
+              datadir / Path("stringtie") / Path("sample2.abundance")]
+    names = ["sample1", "sample2"]
+    rows = list(stream_sorted_tables(tables, 0, 7, "\t", names, True, True))
+    assert rows_to_dict(rows, names) == collect_columns(
+        tables, 0, 7, "\t", names, True, True)
+
+
+def test_stream_sorted_tables_unsorted(tmpdir):
+    table = tmpdir.join("unsorted.tsv")
+    table.write("b\t1\na\t2\n")
+    with pytest.raises(ValueError, match="is not sorted by feature id: a "
+                                         "comes after b."):
+        list(stream_sorted_tables([Path(table.strpath)], 0, 1, "\t", ["s"],
+                                  False, False))
+
+
+def test_tables_are_sorted(tmpdir):
+    sorted_table = tmpdir.join("sorted.tsv")
+    sorted_table.write("a\t1\na\t2\nb\t3\n")
+    unsorted_table = tmpdir.join("unsorted.tsv")
+    unsorted_table.write("b\t1\na\t2\n")
+    assert tables_are_sorted([Path(sorted_table.strpath)], 0, "\t", False)
+    assert not tables_are_sorted([Path(sorted_table.strpath),
+                                  Path(unsorted_table.strpath)],
+                                 0, "\t", False)
+
+
+def test_main_sorted_inputs(tmpdir):
+    sample1 = str(datadir / Path("semicolon") / Path("sample1.csv"))
+    sample2 = str(datadir / Path("semicolon") / Path("sample2.csv"))
+    gtf = str(datadir / Path("merged.gtf"))
+    expected_result = [
+        "feature;ref_gene_id;transcript_id;sample1.csv;sample2.csv\n",
+        "gene_1;g_1;t_1_2;1;10\n",
+        "gene_2;g_2;t_2_1;2;20\n",
+        "gene_3;g_3;t_3_1;3;30\n",
+        "gene_4;g_4;\"t_4_2;t_4_1\";4;40\n",
+        "gene_5;g_5;t_5_1;5;\n",
+        "gene_6;g_6;t_6_1;;60\n"]
+    for flag in ("--sorted-inputs", "--detect-sorted-inputs"):
+        output_file = tmpdir.join("output.tsv")
+        sys.argv = ["script", output_file.strpath, sample1, sample2, "-f",
+                    "1", "-c", "0", "-s", ";", "-H", "-g", gtf, "-a",
+                    "ref_gene_id", "transcript_id", "-F", "gene_name", flag]
+        main()
+        with output_file.open() as out_file:
+            assert out_file.readlines() == expected_result
+
+
+def test_main_detect_sorted_inputs_unsorted(tmpdir):
+    table = tmpdir.join("unsorted.tsv")
+    table.write("b\t1\na\t2\n")
+    output_file = tmpdir.join("output.tsv")
+    sys.argv = ["script", output_file.strpath, table.strpath,
+                "--detect-sorted-inputs"]
+    main()
+    with output_file.open() as out_file:
+        assert out_file.readlines() == [
+            "feature\tunsorted.tsv\n", "b\t1\n", "a\t2\n"]
+
+
+@pytest.mark.parametrize(["flags", "expected"], [
+    (["-S", "--value-type", "int"], ["a\t3\n", "b\t3\n"]),
+    (["-S"], ["a\t3.0\n", "b\t3.0\n"]),
+    (["--value-type", "float"], ["a\t2.0\n", "b\t3.0\n"]),
+    (["--on-duplicate", "mean", "--value-type", "int"],
+     ["a\t1.5\n", "b\t3.0\n"])])
+def test_main_sorted_inputs_value_type(tmpdir, flags, expected):
+    table = tmpdir.join("sorted.tsv")
+    table.write("a\t1\na\t2\nb\t3\n")
+    output_file = tmpdir.join("output.tsv")
+    for sorted_flags in ([], ["--sorted-inputs"], ["--detect-sorted-inputs"]):
+        sys.argv = ["script", output_file.strpath, table.strpath,
+                    "-n", "s"] + flags + sorted_flags
+        with catch_warnings(record=True):
+            main()
+        with output_file.open() as out_file:
+            assert out_file.readlines() == ["feature\ts\n"] + expected